@@ -0,0 +1,116 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from app import clock
+from app.models import Conversation
+
+
+class ActivityTracker:
+    """Ghi nhận last_activity của conversation trong bộ nhớ, không I/O trên đường nóng.
+
+    touch() chỉ cập nhật dict; flush() định kỳ ghi tất cả giá trị đã thay đổi
+    bằng một lệnh UPDATE hàng loạt, idle reaper đọc trực tiếp từ tracker thay
+    vì quét bảng conversations.
+    """
+
+    def __init__(self):
+        # conversation_id -> timestamp hoạt động gần nhất
+        self._last_activity: Dict[int, float] = {}
+        # Các conversation có giá trị chưa ghi xuống database
+        self._dirty: Set[int] = set()
+        # Conversation đã kết thúc nhưng last_activity cuối chưa được ghi
+        self._ended: Dict[int, float] = {}
+
+    def __len__(self):
+        return len(self._last_activity)
+
+    def touch(self, conversation_id: int, timestamp: Optional[float] = None):
+        self._last_activity[conversation_id] = clock.time() if timestamp is None else timestamp
+        self._dirty.add(conversation_id)
+
+    def forget(self, conversation_id: int):
+        """Ngừng theo dõi conversation đã kết thúc.
+
+        last_activity chưa ghi vẫn được flush lần sau, nếu không database giữ giá
+        trị cũ và ArchiveService archive conversation sớm hơn thời gian lưu giữ.
+        """
+        timestamp = self._last_activity.pop(conversation_id, None)
+        if conversation_id in self._dirty:
+            self._dirty.discard(conversation_id)
+            if timestamp is not None:
+                self._ended[conversation_id] = timestamp
+
+    def get_last_activity(self, conversation_id: int) -> Optional[float]:
+        return self._last_activity.get(conversation_id)
+
+    def seed(self, db: Session) -> int:
+        """Nạp last_activity của các conversation đang active từ database (khi khởi động)"""
+        rows = db.query(Conversation.id, Conversation.last_activity).filter(
+            Conversation.is_active == True
+        ).all()
+
+        for conversation_id, last_activity in rows:
+            if last_activity is None:
+                timestamp = clock.time()
+            elif last_activity.tzinfo is None:
+                timestamp = last_activity.replace(tzinfo=timezone.utc).timestamp()
+            else:
+                timestamp = last_activity.timestamp()
+            # Giá trị lấy từ database nên không cần đánh dấu dirty
+            self._last_activity.setdefault(conversation_id, timestamp)
+        return len(rows)
+
+    def _take_dirty(self) -> List[dict]:
+        pending = self._ended
+        pending.update((conversation_id, self._last_activity[conversation_id])
+                       for conversation_id in self._dirty if conversation_id in self._last_activity)
+        self._dirty = set()
+        self._ended = {}
+        return [
+            {"id": conversation_id, "last_activity": datetime.fromtimestamp(timestamp, timezone.utc)}
+            for conversation_id, timestamp in pending.items()
+        ]
+
+    @staticmethod
+    def _write(db: Session, params: List[dict]):
+        try:
+            db.execute(update(Conversation), params)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    async def flush(self) -> int:
+        """Ghi các last_activity đã thay đổi bằng một lệnh UPDATE (executemany theo id)"""
+        from app.database import run_db
+
+        params = self._take_dirty()
+        if not params:
+            return 0
+
+        try:
+            await run_db(self._write, params)
+        except Exception:
+            # Giữ lại để ghi ở lần flush sau
+            for row in params:
+                if row["id"] in self._last_activity:
+                    self._dirty.add(row["id"])
+                else:
+                    self._ended.setdefault(row["id"], row["last_activity"].timestamp())
+            raise
+
+        return len(params)
+
+    def find_idle(self, idle_seconds: float, now: Optional[float] = None) -> List[int]:
+        """Các conversation không có hoạt động trong idle_seconds giây"""
+        cutoff = (clock.time() if now is None else now) - idle_seconds
+        return [
+            conversation_id
+            for conversation_id, timestamp in self._last_activity.items()
+            if timestamp < cutoff
+        ]
+
+
+# Global activity tracker instance
+activity_tracker = ActivityTracker()
@@ -0,0 +1,113 @@
+import gzip
+import json
+from datetime import timedelta
+from typing import List
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+from app import clock
+from app.log import get_logger
+from app.models import Conversation, Message, MessageArchive
+
+logger = get_logger(__name__)
+
+
+def _serialize_message(message: Message) -> dict:
+    return {
+        "id": message.id,
+        "conversation_id": message.conversation_id,
+        "sender_id": message.sender_id,
+        "content": message.content,
+        "message_type": message.message_type,
+        "created_at": message.created_at.isoformat() if message.created_at else None
+    }
+
+
+def compress_segment(messages: List[dict]) -> bytes:
+    return gzip.compress(json.dumps(messages, ensure_ascii=False).encode("utf-8"))
+
+
+def decompress_segment(payload: bytes) -> List[dict]:
+    return json.loads(gzip.decompress(payload).decode("utf-8"))
+
+
+class ArchiveService:
+    """Chuyển tin nhắn của conversation đã kết thúc sang bảng lưu trữ nén"""
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def find_archivable_conversations(self, retention: timedelta, limit: int) -> List[int]:
+        """Tìm conversation đã kết thúc, không được keep và quá thời gian lưu giữ mà vẫn còn tin nhắn"""
+        cutoff = clock.now() - retention
+
+        rows = self.db.query(Message.conversation_id).join(
+            Conversation, Conversation.id == Message.conversation_id
+        ).filter(
+            Conversation.is_active == False,
+            or_(Conversation.user1_keep == False, Conversation.user2_keep == False),
+            Conversation.last_activity < cutoff
+        ).distinct().limit(limit).all()
+
+        return [row[0] for row in rows]
+
+    def archive_conversation(self, conversation_id: int) -> int:
+        """Nén toàn bộ tin nhắn của một conversation vào archive và xóa khỏi bảng messages"""
+        messages = self.db.query(Message).filter(
+            Message.conversation_id == conversation_id
+        ).order_by(Message.created_at.asc(), Message.id.asc()).all()
+
+        if not messages:
+            return 0
+
+        serialized = [_serialize_message(message) for message in messages]
+
+        archive = self.db.query(MessageArchive).filter(
+            MessageArchive.conversation_id == conversation_id
+        ).first()
+
+        if archive:
+            # Đã có segment từ lần trước (tin nhắn đến muộn), gộp lại
+            serialized = decompress_segment(archive.payload) + serialized
+            archive.payload = compress_segment(serialized)
+            archive.message_count = len(serialized)
+            archive.last_message_at = messages[-1].created_at
+        else:
+            archive = MessageArchive(
+                conversation_id=conversation_id,
+                message_count=len(serialized),
+                first_message_at=messages[0].created_at,
+                last_message_at=messages[-1].created_at,
+                codec="gzip",
+                payload=compress_segment(serialized)
+            )
+            self.db.add(archive)
+
+        self.db.query(Message).filter(
+            Message.id.in_([message.id for message in messages])
+        ).delete(synchronize_session=False)
+
+        # Ghi archive và xóa tin nhắn trong cùng một transaction
+        self.db.commit()
+        return len(messages)
+
+    def archive_expired_conversations(self, retention: timedelta, batch_size: int = 100) -> int:
+        """Chạy một lượt archive, trả về số tin nhắn đã chuyển sang archive"""
+        archived = 0
+        for conversation_id in self.find_archivable_conversations(retention, batch_size):
+            try:
+                archived += self.archive_conversation(conversation_id)
+            except Exception as e:
+                logger.error("archive_conversation_failed", conversation_id=conversation_id, error=str(e))
+                self.db.rollback()
+        return archived
+
+    def get_archived_messages(self, conversation_id: int) -> List[dict]:
+        """Đọc tin nhắn đã archive của conversation (rỗng nếu chưa archive)"""
+        archive = self.db.query(MessageArchive).filter(
+            MessageArchive.conversation_id == conversation_id
+        ).first()
+
+        if not archive:
+            return []
+
+        return decompress_segment(archive.payload)
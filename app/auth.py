@@ -3,8 +3,14 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
 import bcrypt
-from app.database import get_db
+import hashlib
+import threading
+import time
+from app.config import settings
+from app.database import DBSession, get_db
 from app.models import User
 import os
 from dotenv import load_dotenv
@@ -18,6 +24,103 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 security = HTTPBearer()
 
+class PrincipalCache:
+    """Cache user đã xác thực theo username, giới hạn số entry (LRU) và thời gian sống (TTL).
+    
+    User trong cache đã được tách khỏi session (detached) nên chỉ dùng để đọc;
+    endpoint cần sửa user phải nạp lại từ database rồi gọi invalidate().
+    Cache hit bỏ qua lần tra user qua run_db (và bước chuyển sang thread pool
+    database) của get_current_user. Thao tác vẫn giữ lock để an toàn nếu được
+    gọi từ thread database.
+    """
+    
+    def __init__(self, ttl: float = 600, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # username -> (thời điểm nạp, user)
+        self._entries: "OrderedDict[str, Tuple[float, User]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, username: str) -> Optional[User]:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(username)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[username]
+            self.misses += 1
+            return None
+    
+    def put(self, username: str, user: User):
+        with self._lock:
+            self._entries[username] = (time.monotonic(), user)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, username: str):
+        """Bỏ user khỏi cache (sau khi sửa hồ sơ hoặc đăng xuất)"""
+        with self._lock:
+            if self._entries.pop(username, None) is not None:
+                self.invalidations += 1
+    
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+# Global principal cache instance
+principal_cache = PrincipalCache(settings.USER_CACHE_TTL, settings.USER_CACHE_MAX_SIZE)
+
+class TokenDenylist:
+    """JWT đã đăng xuất, bị từ chối tới khi hết hạn (exp).
+    
+    Lưu theo SHA-256 của token nên áp dụng được cả cho token cũ; entry tự bị bỏ
+    khi token hết hạn vì lúc đó jwt.decode đã từ chối.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        # fingerprint -> exp (epoch seconds)
+        self._entries: Dict[str, float] = {}
+    
+    @staticmethod
+    def _fingerprint(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+    
+    def revoke(self, token: str, expires_at: float):
+        now = time.time()
+        with self._lock:
+            self._entries[self._fingerprint(token)] = expires_at
+            for fingerprint in [key for key, exp in self._entries.items() if exp <= now]:
+                del self._entries[fingerprint]
+    
+    def is_revoked(self, token: str) -> bool:
+        with self._lock:
+            return self._fingerprint(token) in self._entries
+
+# Global token denylist instance
+token_denylist = TokenDenylist()
+
 def hash_password(password: str) -> str:
     """Hash password sử dụng bcrypt"""
     salt = bcrypt.gensalt()
@@ -47,7 +150,22 @@ def verify_token(token: str) -> dict:
     except JWTError:
         return None
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)) -> User:
+def get_user_by_username(db: Session, username: str) -> Optional[User]:
+    return db.query(User).filter(User.username == username).first()
+
+def _load_principal(db: Session, user_id: Optional[int], username: str) -> Optional[User]:
+    # Token mới có claim uid nên cache miss chỉ cần lookup theo primary key
+    if user_id is not None:
+        user = db.get(User, user_id)
+    else:
+        user = get_user_by_username(db, username)
+    if user is None or user.username != username:
+        return None
+    
+    db.expunge(user)
+    return user
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: DBSession = Depends(get_db)) -> User:
     """Lấy user hiện tại từ JWT token"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -57,24 +175,43 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     
     token = credentials.credentials
     payload = verify_token(token)
-    if payload is None:
+    if payload is None or token_denylist.is_revoked(token):
         raise credentials_exception
     
     username: str = payload.get("sub")
     if username is None:
         raise credentials_exception
     
-    user = db.query(User).filter(User.username == username).first()
+    user = principal_cache.get(username)
+    if user is not None:
+        return user
+    
+    user = await db.run(_load_principal, payload.get("uid"), username)
     if user is None:
         raise credentials_exception
     
+    principal_cache.put(username, user)
     return user
 
-def authenticate_user(db: Session, username: str, password: str) -> User:
-    """Xác thực user với username và password"""
-    user = db.query(User).filter(User.username == username).first()
+def revoke_token(token: str):
+    """Thu hồi JWT khi đăng xuất: mọi request sau đó (kể cả xin vé WebSocket) bị 401"""
+    payload = verify_token(token)
+    if payload is not None:
+        token_denylist.revoke(token, payload["exp"])
+
+async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    """User hiện tại, 403 nếu không nằm trong ADMIN_USERNAMES"""
+    if current_user.username not in settings.ADMIN_USERNAMES:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Chỉ admin mới được truy cập")
+    return current_user
+
+async def authenticate_user(db: DBSession, username: str, password: str) -> User:
+    """Xác thực user với username và password (bcrypt chạy trong password hasher)"""
+    from app.hashing import password_hasher
+    
+    user = await db.run(get_user_by_username, username)
     if not user:
         return None
-    if not verify_password(password, user.password_hash):
+    if not await password_hasher.verify(password, user.password_hash):
         return None
     return user 
\ No newline at end of file
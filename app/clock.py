@@ -0,0 +1,137 @@
+import asyncio
+import heapq
+import itertools
+import time as _time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+# Đồng hồ dùng cho countdown, expiry và các background job.
+# Code gọi clock.now() / clock.time() / await clock.sleep() thay vì datetime.now(),
+# time.time(), asyncio.sleep(); benchmark thay bằng SimulatedClock qua set_clock().
+
+
+class SystemClock:
+    """Đồng hồ thật"""
+
+    def time(self) -> float:
+        return _time.time()
+
+    def now(self) -> datetime:
+        return datetime.now(timezone.utc)
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+    async def wait(self, event: asyncio.Event, timeout: Optional[float]):
+        """Chờ event được set hoặc hết timeout giây (None = chờ mãi)"""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class SimulatedClock:
+    """Đồng hồ ảo chỉ chạy khi gọi advance(), để mô phỏng hàng giờ trong vài giây.
+
+    sleep()/wait() đăng ký deadline theo thời gian ảo; advance() đánh thức các
+    sleeper theo đúng thứ tự deadline nên code lập lịch thật chạy y như trong
+    production. drain (tùy chọn) chờ các việc chạy ngoài event loop, ví dụ
+    wait_db_idle trong app/database.py, và trả về True nếu đã phải chờ.
+    """
+
+    def __init__(self, start: Optional[float] = None, drain: Optional[Callable[[], Awaitable[bool]]] = None):
+        self._now = _time.time() if start is None else start
+        self._sleepers: List[Tuple[float, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._drain = drain
+
+    def time(self) -> float:
+        return self._now
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self._now, timezone.utc)
+
+    def _register(self, seconds: float) -> asyncio.Future:
+        # Deadline tính ngay lúc gọi, không phụ thuộc khi nào task được chạy tiếp
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self._now + seconds, next(self._counter), future))
+        return future
+
+    async def sleep(self, seconds: float):
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+        await self._register(seconds)
+
+    async def wait(self, event: asyncio.Event, timeout: Optional[float]):
+        if event.is_set():
+            return
+        if timeout is None:
+            await event.wait()
+            return
+
+        sleeper = self._register(timeout)
+        waiter = asyncio.ensure_future(event.wait())
+        try:
+            await asyncio.wait({sleeper, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            sleeper.cancel()
+            waiter.cancel()
+
+    async def advance(self, seconds: float, settle_steps: int = 20):
+        """Tiến đồng hồ seconds giây, cho các task vừa được đánh thức chạy xong từng bước"""
+        target = self._now + seconds
+        # Cho các task đang chạy dở đăng ký sleeper trước khi thời gian trôi
+        await self._settle(settle_steps)
+        while self._sleepers and self._sleepers[0][0] <= target:
+            deadline, _, future = heapq.heappop(self._sleepers)
+            if future.done():
+                continue
+            self._now = max(self._now, deadline)
+            future.set_result(None)
+            await self._settle(settle_steps)
+        self._now = target
+        await self._settle(settle_steps)
+
+    async def _settle(self, steps: int):
+        await settle(steps)
+        if self._drain is not None:
+            while await self._drain():
+                await settle(steps)
+
+
+async def settle(steps: int = 20):
+    """Nhường event loop vài vòng để các task sẵn sàng chạy tới lần chờ kế tiếp"""
+    for _ in range(steps):
+        await asyncio.sleep(0)
+
+
+_clock = SystemClock()
+
+
+def set_clock(new_clock):
+    """Thay đồng hồ toàn cục (benchmark/mô phỏng), trả về đồng hồ cũ"""
+    global _clock
+    previous = _clock
+    _clock = new_clock
+    return previous
+
+
+def get_clock():
+    return _clock
+
+
+def time() -> float:
+    return _clock.time()
+
+
+def now() -> datetime:
+    return _clock.now()
+
+
+async def sleep(seconds: float):
+    await _clock.sleep(seconds)
+
+
+async def wait(event: asyncio.Event, timeout: Optional[float]):
+    await _clock.wait(event, timeout)
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -6,27 +7,90 @@ load_dotenv()
 class Settings:
     # Database settings
     DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./mapmo.db")
+    DB_WORKERS = int(os.getenv("DB_WORKERS", 8))  # threads chạy truy vấn database, không chặn event loop
     
+    # SQLite settings (SQLITE_PROFILE=legacy: một pool chung, không đặt pragma)
+    SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "production")
+    SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))  # ms chờ lock trước khi báo "database is locked"
+    SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))  # bytes
+    SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", 16 * 1024))  # KiB page cache mỗi connection
+    SQLITE_WRITER_TIMEOUT = 30  # seconds chờ connection ghi (dùng chung trong process)
+    
+    # Migration settings (AUTO_MIGRATE=false khi deploy đã chạy `alembic upgrade head` ở bước release)
+    AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "true").lower() == "true"
+    DB_MIGRATION_LOCK_KEY = 727071  # key cho pg_advisory_lock khi chạy migration
+
     # WebSocket settings
     WEBSOCKET_PING_INTERVAL = 30  # seconds
     WEBSOCKET_PING_TIMEOUT = 10   # seconds
     WEBSOCKET_MAX_CONNECTIONS = 1000
+    WS_TICKET_TTL = 60  # seconds, hạn dùng vé kết nối WebSocket
+    
+    # Countdown settings
+    COUNTDOWN_DURATION = int(os.getenv("COUNTDOWN_DURATION", 300))  # seconds trước khi conversation tự kết thúc
     
     # Message processing settings
     MESSAGE_BATCH_SIZE = 10
     MESSAGE_PROCESSING_INTERVAL = 0.1  # seconds
     TYPING_DEBOUNCE_DELAY = 1.0  # seconds
+    MESSAGE_RETRY_DELAY = 1.0  # seconds chờ trước khi ghi lại batch bị lỗi
+    MESSAGE_MAX_RETRIES = 5
+    
+    # Message WAL settings (để trống MESSAGE_WAL_PATH để tắt)
+    MESSAGE_WAL_PATH = os.getenv("MESSAGE_WAL_PATH")
+    MESSAGE_WAL_FSYNC_INTERVAL = 0.005  # seconds gom các append vào một lần fsync
+    MESSAGE_WAL_BATCH_INTERVAL = 1.0  # seconds giữa các lần ghi database khi bật WAL
+    MESSAGE_WAL_COMPACT_BYTES = 1024 * 1024
+    REPLAY_BUFFER_SIZE = 200  # events giữ lại mỗi conversation để replay khi reconnect
+    
+    # ID generator settings (mỗi process/worker cần một WORKER_ID riêng, 0-31). Không đặt
+    # WORKER_ID thì mỗi process tự giữ một id còn trống bằng lock file trên máy; chạy
+    # nhiều máy dùng chung database thì phải đặt WORKER_ID khác nhau cho từng process
+    WORKER_ID = int(os.environ["WORKER_ID"]) if os.getenv("WORKER_ID") else None
+    WORKER_ID_LOCK_PREFIX = os.getenv("WORKER_ID_LOCK_PREFIX", os.path.join(tempfile.gettempdir(), "mapmo-worker-"))
+    MAX_CLOCK_BACKWARD_MS = 10  # đồng hồ lùi quá mức này thì từ chối sinh id thay vì chờ
+    
+    # Password hashing settings (bcrypt chạy trong thread pool riêng)
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+    PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", 32))  # quá số này trả về 503
     
     # Cache settings
     CONVERSATION_CACHE_TTL = 300  # 5 minutes
     USER_CACHE_TTL = 600  # 10 minutes
+    USER_CACHE_MAX_SIZE = 10000  # users giữ trong principal cache
     
     # Performance settings
     MAX_MESSAGES_PER_CONVERSATION = 1000
+    BOOTSTRAP_MESSAGE_LIMIT = 50  # tin nhắn mới nhất trả về khi mở phòng chat
     CLEANUP_INTERVAL = 30  # seconds
     
+    # Activity tracker settings
+    ACTIVITY_FLUSH_INTERVAL = 30  # seconds giữa các lần ghi last_activity xuống database
+    CONVERSATION_IDLE_TIMEOUT = 15 * 60  # seconds không hoạt động thì kết thúc conversation cả 2 đã keep
+    IDLE_REAP_INTERVAL = 60  # seconds
+    
+    # Presence settings
+    PRESENCE_FLUSH_INTERVAL = 5  # seconds giữa các lần ghi users.state xuống database
+    SEARCHING_COUNT_PUSH_INTERVAL = 1.0  # seconds, tối đa một lần gửi số người đang tìm kiếm
+    
+    # Archive settings
+    ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", 7))
+    ARCHIVE_INTERVAL = 3600  # seconds
+    ARCHIVE_BATCH_SIZE = 100  # conversations mỗi lượt
+    
+    # Background job settings (job singleton chỉ chạy ở một worker)
+    JOB_ELECTION_INTERVAL = 5.0  # seconds giữa các lần thử lấy leader lock
+    # Lock file của SQLite, mặc định cạnh file database (<db>.jobs.lock)
+    JOB_LEADER_LOCK_PATH = os.getenv("JOB_LEADER_LOCK_PATH")
+    JOB_LEADER_LOCK_KEY = 727070  # key cho pg_try_advisory_lock
+    
+    # Export settings
+    EXPORT_CHUNK_SIZE = 500  # rows đọc mỗi lần từ database khi export
+    
     # Security settings
     SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here")
+    # Username được gọi /api/admin/*, phân cách bằng dấu phẩy; để trống thì không ai là admin
+    ADMIN_USERNAMES = frozenset(name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip())
     ALGORITHM = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES = 30
     
@@ -0,0 +1,192 @@
+import time
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import update
+from sqlalchemy.orm import Session, aliased
+from app.config import settings
+from app.models import Conversation, ConversationStateMixin, User
+
+
+class ConversationState(ConversationStateMixin):
+    """Bản sao trong bộ nhớ của các field conversation mà REST và WebSocket cần trên đường nóng"""
+
+    def __init__(self, conversation: Conversation, nicknames: Dict[int, Optional[str]] = None):
+        self.id = conversation.id
+        self.user1_id = conversation.user1_id
+        self.user2_id = conversation.user2_id
+        self.conversation_type = conversation.conversation_type
+        self.user1_keep = bool(conversation.user1_keep)
+        self.user2_keep = bool(conversation.user2_keep)
+        self.is_active = bool(conversation.is_active)
+        self.countdown_start_time = conversation.countdown_start_time
+        # user_id -> nickname của 2 người trong conversation
+        self.nicknames: Dict[int, Optional[str]] = nicknames or {}
+        self.loaded_at = time.monotonic()
+
+    def get_match_payload(self, user_id: int) -> dict:
+        """Thông tin match (match_found / /search) nhìn từ phía user_id"""
+        other_user_id = self.get_other_user_id(user_id)
+        return {
+            "conversation_id": self.id,
+            "conversation_type": self.conversation_type,
+            "chat_url": f"/chat/{self.id}",
+            "matched_user": {
+                "id": other_user_id,
+                "nickname": self.nicknames.get(other_user_id)
+            },
+            "countdown": self.get_countdown_state()
+        }
+
+
+class ConversationStore:
+    """Trạng thái conversation đang active, dùng chung cho REST và WebSocket handler.
+
+    Đọc (participants, keep, deadline, type) chỉ là một lookup trong dict; ghi keep
+    đi thẳng xuống database (write-through) rồi cập nhật bộ nhớ. Entry được nạp lại
+    sau CONVERSATION_CACHE_TTL để thấy thay đổi do worker khác ghi.
+
+    Kèm index user_id -> conversation đang active để reconnect, /search và
+    match notification tìm conversation của user trong O(1), không cần SQL.
+    Index được nạp đầy đủ khi khởi động và cập nhật ở mọi chỗ tạo/kết thúc
+    conversation nên là nguồn sự thật cho process này.
+    """
+
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self._states: Dict[int, ConversationState] = {}
+        self._by_user: Dict[int, int] = {}
+
+    def __len__(self):
+        return len(self._states)
+
+    def put(self, conversation: Conversation,
+            nicknames: Dict[int, Optional[str]] = None) -> Optional[ConversationState]:
+        """Ghi đè trạng thái từ model (sau khi tạo hoặc đọc từ database)"""
+        if not conversation.is_active:
+            self.discard(conversation.id)
+            return None
+
+        previous = self._states.get(conversation.id)
+        if nicknames is None and previous is not None:
+            nicknames = previous.nicknames
+
+        state = ConversationState(conversation, nicknames)
+        self._states[conversation.id] = state
+        self._by_user[state.user1_id] = state.id
+        self._by_user[state.user2_id] = state.id
+        return state
+
+    def discard(self, conversation_id: int):
+        """Bỏ conversation đã kết thúc khỏi store và index theo user"""
+        state = self._states.pop(conversation_id, None)
+        if state is None:
+            return
+        for user_id in (state.user1_id, state.user2_id):
+            # User có thể đã sang conversation mới, chỉ xóa nếu index còn trỏ tới conversation này
+            if self._by_user.get(user_id) == conversation_id:
+                del self._by_user[user_id]
+
+    def set_nickname(self, user_id: int, nickname: Optional[str]):
+        """Cập nhật nickname trong conversation đang active của user (khi sửa hồ sơ)"""
+        state = self.find_by_user(user_id)
+        if state is not None:
+            state.nicknames[user_id] = nickname
+
+    def _query_with_nicknames(self, db: Session):
+        user1 = aliased(User)
+        user2 = aliased(User)
+        return db.query(Conversation, user1.nickname, user2.nickname).outerjoin(
+            user1, user1.id == Conversation.user1_id
+        ).outerjoin(
+            user2, user2.id == Conversation.user2_id
+        )
+
+    def _put_row(self, row: Tuple[Conversation, Optional[str], Optional[str]]) -> Optional[ConversationState]:
+        conversation, user1_nickname, user2_nickname = row
+        return self.put(conversation, {
+            conversation.user1_id: user1_nickname,
+            conversation.user2_id: user2_nickname
+        })
+
+    async def get(self, conversation_id: int) -> Optional[ConversationState]:
+        """Lấy trạng thái conversation đang active, nạp từ database nếu chưa có hoặc đã quá TTL"""
+        state = self._states.get(conversation_id)
+        if state is not None and time.monotonic() - state.loaded_at < self.ttl:
+            return state
+        return await self._load(conversation_id)
+
+    async def _load(self, conversation_id: int) -> Optional[ConversationState]:
+        from app.database import run_db
+
+        row = await run_db(self._fetch_row, conversation_id)
+
+        if not row:
+            self.discard(conversation_id)
+            return None
+        return self._put_row(row)
+
+    def _fetch_row(self, db: Session, conversation_id: int) -> Optional[Tuple[Conversation, Optional[str], Optional[str]]]:
+        return self._query_with_nicknames(db).filter(Conversation.id == conversation_id).first()
+
+    def find_by_user(self, user_id: int) -> Optional[ConversationState]:
+        """Conversation đang active của user (O(1), không query database)"""
+        conversation_id = self._by_user.get(user_id)
+        if conversation_id is None:
+            return None
+        return self._states.get(conversation_id)
+
+    def connected_user_ids(self) -> List[int]:
+        """Các user đang trong một conversation active"""
+        return list(self._by_user)
+
+    async def set_keep(self, conversation_id: int, user_id: int, keep_status: bool) -> Optional[ConversationState]:
+        """Cập nhật keep của user: một lệnh UPDATE xuống database rồi cập nhật bộ nhớ.
+
+        UPDATE ... RETURNING trả về cả 2 cờ keep hiện tại trong database nên
+        trạng thái both_kept đúng kể cả khi người kia keep qua worker khác.
+        """
+        from app.database import run_db
+
+        state = await self.get(conversation_id)
+        if state is None or not state.has_user(user_id):
+            return None
+
+        column = "user1_keep" if user_id == state.user1_id else "user2_keep"
+        row = await run_db(self._write_keep, conversation_id, column, keep_status)
+
+        if row is None:
+            self.discard(conversation_id)
+            return None
+
+        state.user1_keep = bool(row.user1_keep)
+        state.user2_keep = bool(row.user2_keep)
+        state.is_active = bool(row.is_active)
+        if not state.is_active:
+            self.discard(conversation_id)
+        return state
+
+    @staticmethod
+    def _write_keep(db: Session, conversation_id: int, column: str, keep_status: bool):
+        try:
+            row = db.execute(
+                update(Conversation)
+                .where(Conversation.id == conversation_id)
+                .values(**{column: keep_status})
+                .returning(Conversation.user1_keep, Conversation.user2_keep, Conversation.is_active)
+                .execution_options(synchronize_session=False)
+            ).first()
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return row
+
+    def seed(self, db: Session) -> int:
+        """Nạp các conversation đang active từ database (khi khởi động)"""
+        rows = self._query_with_nicknames(db).filter(Conversation.is_active == True).all()
+        for row in rows:
+            self._put_row(row)
+        return len(rows)
+
+
+# Global conversation store instance
+conversation_store = ConversationStore(settings.CONVERSATION_CACHE_TTL)
@@ -1,11 +1,71 @@
-from sqlalchemy import create_engine
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Set, TypeVar
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.elements import TextClause
 from app.config import settings
 
+T = TypeVar("T")
+
+
+def _is_sqlite_file(url: str) -> bool:
+    parsed = make_url(url)
+    return parsed.get_backend_name() == "sqlite" and parsed.database not in (None, "", ":memory:")
+
+
+def _sqlite_pragmas(query_only: bool = False):
+    """Listener "connect" đặt pragma cho mỗi connection SQLite mới"""
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            # WAL: reader không bị chặn bởi writer; NORMAL chỉ fsync khi checkpoint
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT)}")
+            cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+            # Số âm nghĩa là KiB thay vì số page
+            cursor.execute(f"PRAGMA cache_size=-{int(settings.SQLITE_CACHE_SIZE)}")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+            if query_only:
+                cursor.execute("PRAGMA query_only=ON")
+        finally:
+            cursor.close()
+    return on_connect
+
+
+# SQLite production profile: một connection ghi duy nhất (các lệnh ghi xếp hàng
+# ở pool thay vì tranh lock của file) và một pool connection chỉ đọc riêng
+SQLITE_SPLIT = settings.SQLITE_PROFILE == "production" and _is_sqlite_file(settings.DATABASE_URL)
+
 # Tối ưu hóa engine với connection pooling và các cấu hình hiệu suất
-if "sqlite" in settings.DATABASE_URL:
+if SQLITE_SPLIT:
+    engine = create_engine(
+        settings.DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=settings.SQLITE_WRITER_TIMEOUT,
+        echo=settings.ENABLE_SQL_LOGGING
+    )
+    event.listen(engine, "connect", _sqlite_pragmas())
+    read_engine = create_engine(
+        settings.DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        pool_size=settings.DB_WORKERS,
+        # Session giữ connection đọc tới khi request xong nên không giới hạn overflow:
+        # connection SQLite rẻ, còn số truy vấn đồng thời đã bị giới hạn bởi db_executor
+        max_overflow=-1,
+        echo=settings.ENABLE_SQL_LOGGING
+    )
+    event.listen(read_engine, "connect", _sqlite_pragmas(query_only=True))
+elif "sqlite" in settings.DATABASE_URL:
     engine = create_engine(
         settings.DATABASE_URL, 
         connect_args={"check_same_thread": False},
@@ -16,6 +76,7 @@ if "sqlite" in settings.DATABASE_URL:
         pool_recycle=3600,  # Recycle connections every hour
         echo=settings.ENABLE_SQL_LOGGING  # Set to True for SQL debugging
     )
+    read_engine = engine
 else:
     # PostgreSQL configuration
     engine = create_engine(
@@ -27,9 +88,37 @@ else:
         pool_recycle=3600,
         echo=settings.ENABLE_SQL_LOGGING
     )
+    read_engine = engine
+
+
+class RoutingSession(Session):
+    """Session gửi lệnh ghi (flush, INSERT/UPDATE/DELETE, SQL thô) qua engine ghi,
+    lệnh đọc qua read_engine.
+
+    Sau lệnh ghi đầu tiên, mọi lệnh tới khi commit/rollback đều đi qua engine
+    ghi để đọc thấy dữ liệu chưa commit của chính transaction đó.
+    """
+
+    _writing = False
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if read_engine is engine:
+            return engine
+        if self._writing or self._flushing or getattr(clause, "is_dml", False) or isinstance(clause, TextClause):
+            self._writing = True
+            return engine
+        return read_engine
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _reset_routing(session: RoutingSession, transaction):
+    if transaction.parent is None:
+        session._writing = False
+
 
 # Tối ưu hóa session với các cấu hình hiệu suất
 SessionLocal = sessionmaker(
+    class_=RoutingSession,
     autocommit=False, 
     autoflush=False, 
     bind=engine,
@@ -38,9 +127,86 @@ SessionLocal = sessionmaker(
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+# Mọi truy vấn từ code async chạy trong thread pool này; số thread giới hạn số
+# truy vấn đồng thời, nên để DB_WORKERS nhỏ hơn pool_size của engine
+db_executor = ThreadPoolExecutor(max_workers=settings.DB_WORKERS, thread_name_prefix="db")
+# Các lệnh đang chạy hoặc chờ thread trong db_executor
+_in_flight: Set[asyncio.Future] = set()
+
+
+async def run_in_db_thread(func: Callable[..., T], *args) -> T:
+    """Chạy hàm đồng bộ có I/O database trong db_executor, event loop không bị chặn"""
+    future = asyncio.get_running_loop().run_in_executor(db_executor, functools.partial(func, *args))
+    _in_flight.add(future)
+    future.add_done_callback(_in_flight.discard)
+    return await future
+
+
+async def wait_db_idle() -> bool:
+    """Chờ các lệnh database đang chạy xong, trả về False nếu không có lệnh nào.
+
+    Dùng cho mô phỏng với SimulatedClock: thời gian ảo chỉ trôi tiếp khi các
+    task đang chờ database đã chạy tới lần chờ kế tiếp.
+    """
+    if not _in_flight:
+        return False
+    await asyncio.wait(set(_in_flight))
+    return True
+
+
+def get_db_stats() -> dict:
+    stats = {"workers": settings.DB_WORKERS, "in_flight": len(_in_flight), "writer_in_use": engine.pool.checkedout()}
+    if read_engine is not engine:
+        stats["readers_in_use"] = read_engine.pool.checkedout()
+    return stats
+
+
+async def run_db(func: Callable[..., T], *args) -> T:
+    """Chạy func(db, *args) với session riêng trong db_executor.
+
+    func chỉ được đụng tới database; trạng thái trong bộ nhớ (presence,
+    conversation store, ...) cập nhật ở event loop sau khi await xong.
+    """
+    def task():
+        db = SessionLocal()
+        try:
+            return func(db, *args)
+        finally:
+            db.close()
+
+    return await run_in_db_thread(task)
+
+
+class DBSession:
+    """Session dùng cho một request/một lượt job, mọi lệnh chạy trong db_executor.
+
+    Các lệnh db.run() được await lần lượt nên session không bao giờ bị dùng
+    đồng thời từ hai thread.
+    """
+
+    def __init__(self):
+        self.session: Session = SessionLocal()
+        self._used = False
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        """Chạy func(session, *args) trong db_executor"""
+        self._used = True
+        return await run_in_db_thread(func, self.session, *args)
+
+    async def close(self):
+        # Session chưa chạy lệnh nào thì không giữ connection, đóng ngay tại chỗ
+        if self._used:
+            await run_in_db_thread(self.session.close)
+        else:
+            self.session.close()
+
+    async def __aenter__(self) -> "DBSession":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def get_db():
+    async with DBSession() as db:
         yield db
-    finally:
-        db.close() 
\ No newline at end of file
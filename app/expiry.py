@@ -0,0 +1,169 @@
+import asyncio
+import heapq
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import and_, not_, update
+from sqlalchemy.orm import Session
+from app import clock
+from app.config import settings
+from app.log import get_logger
+from app.models import Conversation
+
+logger = get_logger(__name__)
+
+# Số giây chờ trước khi thử kết thúc lại các conversation bị lỗi
+EXPIRY_RETRY_DELAY = 5
+
+
+class ExpiryScheduler:
+    """Lập lịch kết thúc conversation đúng lúc countdown hết bằng min-heap các deadline.
+
+    Thay cho việc quét toàn bộ conversation định kỳ: mỗi lần create/keep/end
+    chỉ tốn O(log n), task nền ngủ tới deadline gần nhất rồi xử lý tất cả
+    conversation đã tới hạn trong một lần.
+    """
+
+    def __init__(self):
+        # (deadline timestamp, conversation_id); entry cũ được bỏ qua khi pop (lazy deletion)
+        self._heap: List[Tuple[float, int]] = []
+        # Deadline hiện hành của từng conversation
+        self._deadlines: Dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._on_expire: Optional[Callable[[List[int]], Awaitable[None]]] = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, conversation_id: int, deadline: datetime):
+        """Đặt (hoặc cập nhật) deadline cho conversation"""
+        timestamp = deadline.timestamp()
+        self._deadlines[conversation_id] = timestamp
+        heapq.heappush(self._heap, (timestamp, conversation_id))
+
+        # Đánh thức task nền nếu deadline mới sớm hơn deadline nó đang chờ
+        if self._heap[0] == (timestamp, conversation_id):
+            self._wakeup.set()
+
+    def cancel(self, conversation_id: int):
+        """Hủy deadline (conversation kết thúc hoặc cả 2 đã keep)"""
+        self._deadlines.pop(conversation_id, None)
+
+    def seed(self, db: Session) -> int:
+        """Nạp deadline của các conversation đang active từ database (khi khởi động)"""
+        conversations = db.query(Conversation).filter(
+            Conversation.is_active == True
+        ).all()
+
+        count = 0
+        for conversation in conversations:
+            if not conversation.both_kept():
+                self.schedule(conversation.id, conversation.get_countdown_deadline())
+                count += 1
+        return count
+
+    def start(self, on_expire: Callable[[List[int]], Awaitable[None]]):
+        """Bắt đầu task nền, on_expire nhận danh sách conversation_id đã tới hạn"""
+        self._on_expire = on_expire
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _pop_due(self, now: float) -> List[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            timestamp, conversation_id = heapq.heappop(self._heap)
+            if self._deadlines.get(conversation_id) == timestamp:
+                del self._deadlines[conversation_id]
+                due.append(conversation_id)
+        return due
+
+    def _next_deadline(self) -> Optional[float]:
+        # Bỏ các entry đã bị hủy hoặc đã được đặt lại deadline khác
+        while self._heap:
+            timestamp, conversation_id = self._heap[0]
+            if self._deadlines.get(conversation_id) == timestamp:
+                return timestamp
+            heapq.heappop(self._heap)
+        return None
+
+    async def _run(self):
+        while True:
+            try:
+                due = self._pop_due(clock.time())
+                if due:
+                    try:
+                        await self._on_expire(due)
+                    except Exception as e:
+                        # Thử lại sau vài giây thay vì bỏ mất các deadline đã pop
+                        logger.error("expire_conversations_failed", count=len(due), error=str(e))
+                        retry_at = datetime.fromtimestamp(clock.time() + EXPIRY_RETRY_DELAY, timezone.utc)
+                        for conversation_id in due:
+                            self.schedule(conversation_id, retry_at)
+                    continue
+
+                next_deadline = self._next_deadline()
+                timeout = None if next_deadline is None else max(0.0, next_deadline - clock.time())
+
+                self._wakeup.clear()
+                await clock.wait(self._wakeup, timeout)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("expiry_scheduler_failed", error=str(e))
+                await clock.sleep(1)
+
+
+def expire_conversations(db: Session, now: Optional[datetime] = None,
+                         conversation_ids: Optional[Iterable[int]] = None) -> List[Tuple[int, int, int]]:
+    """Kết thúc hàng loạt các conversation đã hết countdown mà chưa được cả 2 keep.
+
+    Chỉ dùng một câu lệnh UPDATE conversations ... RETURNING bất kể số conversation
+    hết hạn; trạng thái user do caller cập nhật qua presence. Điều kiện is_active
+    trong WHERE đảm bảo mỗi conversation chỉ được trả về một lần dù nhiều process
+    cùng chạy. conversation_ids giới hạn UPDATE trong các conversation đó (expiry
+    scheduler), None thì quét tất cả. Trả về danh sách (id, user1_id, user2_id).
+    """
+    if now is None:
+        now = clock.now()
+    cutoff = now - timedelta(seconds=settings.COUNTDOWN_DURATION)
+
+    conditions = [
+        Conversation.is_active == True,
+        Conversation.countdown_start_time <= cutoff,
+        not_(and_(Conversation.user1_keep == True, Conversation.user2_keep == True))
+    ]
+    if conversation_ids is not None:
+        conditions.append(Conversation.id.in_(list(conversation_ids)))
+
+    rows = db.execute(
+        update(Conversation)
+        .where(*conditions)
+        .values(is_active=False)
+        .returning(Conversation.id, Conversation.user1_id, Conversation.user2_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+    db.commit()
+    return [(row.id, row.user1_id, row.user2_id) for row in rows]
+
+
+def find_ended_conversations(db: Session, conversation_ids: Iterable[int]) -> List[Tuple[int, int, int]]:
+    """Trong các conversation_ids, những conversation đã kết thúc trong database.
+
+    Worker khác có thể đã kết thúc conversation trước (UPDATE của nó lấy mất row),
+    worker này vẫn phải dọn trạng thái trong bộ nhớ và báo cho socket của mình.
+    """
+    conversation_ids = list(conversation_ids)
+    if not conversation_ids:
+        return []
+
+    rows = db.query(Conversation.id, Conversation.user1_id, Conversation.user2_id).filter(
+        Conversation.id.in_(conversation_ids),
+        Conversation.is_active == False
+    ).all()
+    return [(row.id, row.user1_id, row.user2_id) for row in rows]
+
+
+# Global scheduler instance
+expiry_scheduler = ExpiryScheduler()
@@ -0,0 +1,99 @@
+import json
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional
+from app.archive import decompress_segment
+from app.models import Message, MessageArchive
+
+
+def _to_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Chuẩn hóa về UTC (database lưu thời gian UTC)"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _in_range(created_at: Optional[str], since: Optional[datetime], until: Optional[datetime]) -> bool:
+    if since is None and until is None:
+        return True
+    if not created_at:
+        return False
+    timestamp = _to_utc(datetime.fromisoformat(created_at))
+    if since is not None and timestamp < since:
+        return False
+    if until is not None and timestamp >= until:
+        return False
+    return True
+
+
+def iter_messages_ndjson(
+    conversation_ids: Optional[List[int]] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    chunk_size: int = 500
+) -> Iterator[str]:
+    """Stream tin nhắn (cả archive và bảng messages) dưới dạng NDJSON.
+
+    Đọc database theo từng chunk (yield_per) nên bộ nhớ không phụ thuộc vào
+    độ dài lịch sử. conversation_ids = None nghĩa là tất cả conversation.
+    Generator tự mở session riêng vì nó chạy sau khi request handler đã trả về.
+    """
+    from app.database import SessionLocal
+
+    since = _to_utc(since)
+    until = _to_utc(until)
+    db = SessionLocal()
+    buffer = []
+
+    try:
+        # Tin nhắn đã archive: mỗi segment giải nén một lần, lọc theo khoảng thời gian
+        archive_query = db.query(MessageArchive)
+        if conversation_ids is not None:
+            archive_query = archive_query.filter(MessageArchive.conversation_id.in_(conversation_ids))
+        if since is not None:
+            archive_query = archive_query.filter(MessageArchive.last_message_at >= since)
+        if until is not None:
+            archive_query = archive_query.filter(MessageArchive.first_message_at < until)
+
+        for archive in archive_query.order_by(MessageArchive.conversation_id).yield_per(1):
+            for message in decompress_segment(archive.payload):
+                if _in_range(message.get("created_at"), since, until):
+                    buffer.append(json.dumps(message, ensure_ascii=False) + "\n")
+            if len(buffer) >= chunk_size:
+                yield "".join(buffer)
+                buffer.clear()
+
+        # Tin nhắn còn trong bảng messages
+        message_query = db.query(
+            Message.id, Message.conversation_id, Message.sender_id,
+            Message.content, Message.message_type, Message.created_at
+        )
+        if conversation_ids is not None:
+            message_query = message_query.filter(Message.conversation_id.in_(conversation_ids))
+        if since is not None:
+            message_query = message_query.filter(Message.created_at >= since)
+        if until is not None:
+            message_query = message_query.filter(Message.created_at < until)
+
+        message_query = message_query.order_by(
+            Message.conversation_id, Message.created_at, Message.id
+        ).yield_per(chunk_size)
+
+        for row in message_query:
+            buffer.append(json.dumps({
+                "id": row.id,
+                "conversation_id": row.conversation_id,
+                "sender_id": row.sender_id,
+                "content": row.content,
+                "message_type": row.message_type,
+                "created_at": row.created_at.isoformat() if row.created_at else None
+            }, ensure_ascii=False) + "\n")
+            if len(buffer) >= chunk_size:
+                yield "".join(buffer)
+                buffer.clear()
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        db.close()
@@ -0,0 +1,96 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict
+from app.auth import hash_password, verify_password
+from app.config import settings
+from app.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class HasherOverloaded(Exception):
+    """Hàng đợi hash password đã đầy, request nên được trả về 503"""
+
+
+class PasswordHasher:
+    """Chạy bcrypt trong thread pool riêng để không chặn event loop.
+
+    bcrypt nhả GIL khi tính toán nên thread pool đủ cho việc này. Số việc đang
+    chạy + đang chờ bị giới hạn ở workers + max_queue; vượt quá thì ném
+    HasherOverloaded ngay thay vì xếp hàng vô hạn. Thời gian chờ trong hàng đợi
+    và thời gian hash của các lần gần nhất được giữ lại để báo metrics.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 32, samples: int = 1000):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        # Số việc đang chạy hoặc chờ, chỉ sửa từ event loop nên không cần lock
+        self._pending = 0
+        self._queue_waits: Deque[float] = deque(maxlen=samples)
+        self._durations: Deque[float] = deque(maxlen=samples)
+        self.completed = 0
+        self.rejected = 0
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def _run(self, func: Callable, *args):
+        if self._pending >= self.workers + self.max_queue:
+            self.rejected += 1
+            logger.warning("password_hasher_overloaded", pending=self._pending, every=5.0)
+            raise HasherOverloaded()
+
+        submitted = time.perf_counter()
+
+        def task():
+            started = time.perf_counter()
+            result = func(*args)
+            return result, started - submitted, time.perf_counter() - started
+
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(task)
+        self._pending += 1
+        # Giảm khi bcrypt thật sự xong (hoặc bị hủy trước khi chạy), không phải khi
+        # request thôi chờ: client ngắt kết nối không làm thread pool rảnh hơn
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        result, queue_wait, duration = await asyncio.wrap_future(future)
+
+        self._queue_waits.append(queue_wait)
+        self._durations.append(duration)
+        self.completed += 1
+        return result
+
+    def _release(self):
+        self._pending -= 1
+
+    @staticmethod
+    def _summarize(samples: Deque[float]) -> Dict[str, float]:
+        if not samples:
+            return {"avg_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+        ordered = sorted(samples)
+        return {
+            "avg_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+            "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2),
+            "max_ms": round(ordered[-1] * 1000, 2)
+        }
+
+    def get_stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "pending": self._pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queue_wait": self._summarize(self._queue_waits),
+            "hash_time": self._summarize(self._durations)
+        }
+
+
+# Global password hasher instance
+password_hasher = PasswordHasher(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_MAX_QUEUE)
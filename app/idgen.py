@@ -0,0 +1,109 @@
+import threading
+import time
+from typing import Optional
+from app.config import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock, chạy một process nên dùng worker 0
+    fcntl = None
+
+# Mốc thời gian riêng (2024-01-01 UTC) để phần timestamp ngắn hơn
+EPOCH_MS = 1704067200000
+
+# Bố cục id: | timestamp (41 bit) | worker (5 bit) | sequence (7 bit) |
+# Tổng 53 bit nên id vẫn là số nguyên chính xác trong JavaScript (Number.MAX_SAFE_INTEGER)
+TIMESTAMP_BITS = 41
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+WORKER_SHIFT = SEQUENCE_BITS
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+
+class ClockMovedBackwards(RuntimeError):
+    """Đồng hồ hệ thống lùi quá MAX_CLOCK_BACKWARD_MS, không sinh được id đơn điệu"""
+
+
+class SnowflakeGenerator:
+    """Sinh id tăng dần theo thời gian ngay trong process, không cần round trip tới database"""
+
+    def __init__(self, worker_id: int):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id phải nằm trong khoảng 0..{MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self.last_timestamp = -1
+        self.sequence = 0
+        self._lock = threading.Lock()
+
+    def _current_millis(self) -> int:
+        return int(time.time() * 1000) - EPOCH_MS
+
+    def next_id(self) -> int:
+        """Sinh id mới, đơn điệu tăng trong cùng một worker"""
+        with self._lock:
+            timestamp = self._current_millis()
+
+            # Đồng hồ bị lùi (NTP chỉnh giờ): tiếp tục dùng mốc cũ để id không bị giảm
+            if timestamp < self.last_timestamp:
+                timestamp = self.last_timestamp
+
+            if timestamp == self.last_timestamp:
+                self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+                if self.sequence == 0:
+                    timestamp = self._wait_next_millis()
+            else:
+                self.sequence = 0
+
+            self.last_timestamp = timestamp
+            return (timestamp << TIMESTAMP_SHIFT) | (self.worker_id << WORKER_SHIFT) | self.sequence
+
+    def _wait_next_millis(self) -> int:
+        """Hết sequence trong millisecond này: sleep tới millisecond sau thay vì quay vòng.
+
+        Đồng hồ lùi xa (phải chờ lâu, chặn cả event loop) thì báo lỗi ngay.
+        """
+        behind_ms = self.last_timestamp - self._current_millis()
+        if behind_ms > settings.MAX_CLOCK_BACKWARD_MS:
+            raise ClockMovedBackwards(f"đồng hồ lùi {behind_ms}ms, từ chối sinh message id")
+        time.sleep((max(behind_ms, 0) + 1) / 1000)
+        return max(self._current_millis(), self.last_timestamp + 1)
+
+
+def id_to_timestamp_ms(snowflake_id: int) -> int:
+    """Lấy lại thời điểm sinh id (epoch millis)"""
+    return (snowflake_id >> TIMESTAMP_SHIFT) + EPOCH_MS
+
+
+_worker_lock_file = None
+
+
+def allocate_worker_id(worker_id: Optional[int] = None) -> int:
+    """WORKER_ID đặt tường minh, hoặc id đầu tiên còn trống trong 0..MAX_WORKER_ID.
+
+    Giữ flock trên WORKER_ID_LOCK_PREFIX<id>.lock suốt đời process nên hai worker
+    trên cùng máy không bao giờ có cùng id; process chết thì hệ điều hành tự nhả.
+    """
+    global _worker_lock_file
+    if worker_id is not None:
+        return worker_id
+    if fcntl is None:
+        return 0
+
+    for candidate in range(MAX_WORKER_ID + 1):
+        lock_file = open(f"{settings.WORKER_ID_LOCK_PREFIX}{candidate}.lock", "a+")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        _worker_lock_file = lock_file
+        return candidate
+
+    raise RuntimeError(f"hết worker id (tối đa {MAX_WORKER_ID + 1} process), đặt WORKER_ID cho từng process")
+
+
+# Global generator instance cho Message id
+message_id_generator = SnowflakeGenerator(allocate_worker_id(settings.WORKER_ID))
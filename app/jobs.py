@@ -0,0 +1,237 @@
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from app import clock
+from app.config import settings
+from app.log import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock, chạy một process nên luôn là leader
+    fcntl = None
+
+logger = get_logger(__name__)
+
+
+class FileLeaderLock:
+    """Leader lock bằng flock trên một file (các worker chạy chung một máy)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def try_acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        if fcntl is None:
+            return True
+
+        lock_file = open(self.path, "a+")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        # Ghi pid của leader để tiện debug
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        self._file = lock_file
+        return True
+
+    def is_held(self) -> bool:
+        # flock chỉ mất khi process chết, lúc đó hệ điều hành tự nhả lock
+        return self._file is not None or fcntl is None
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class PostgresLeaderLock:
+    """Leader lock bằng pg_try_advisory_lock, giữ trên một connection riêng.
+
+    Lock gắn với session nên khi worker chết (connection đóng) Postgres tự nhả lock
+    và worker khác lấy được ở lượt bầu chọn tiếp theo.
+    """
+
+    def __init__(self, engine: Engine, key: int):
+        self.engine = engine
+        self.key = key
+        self._connection = None
+
+    def try_acquire(self) -> bool:
+        if self._connection is not None:
+            return self.is_held()
+
+        connection = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        acquired = connection.execute(
+            text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key}
+        ).scalar()
+
+        if not acquired:
+            connection.close()
+            return False
+
+        self._connection = connection
+        return True
+
+    def is_held(self) -> bool:
+        if self._connection is None:
+            return False
+        try:
+            self._connection.execute(text("SELECT 1"))
+            return True
+        except Exception:
+            # Mất connection nghĩa là đã mất lock
+            self._drop_connection()
+            return False
+
+    def release(self):
+        if self._connection is None:
+            return
+        try:
+            self._connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.key})
+        finally:
+            self._drop_connection()
+
+    def _drop_connection(self):
+        try:
+            self._connection.invalidate()
+            self._connection.close()
+        except Exception:
+            pass
+        self._connection = None
+
+
+def create_leader_lock(engine: Engine):
+    """Chọn loại leader lock theo database đang dùng"""
+    if engine.dialect.name == "postgresql":
+        return PostgresLeaderLock(engine, settings.JOB_LEADER_LOCK_KEY)
+    path = settings.JOB_LEADER_LOCK_PATH
+    if not path:
+        # Cạnh file database như lock migration (app/schema.py); database in-memory thì dùng thư mục tạm
+        database = engine.url.database
+        if database in (None, "", ":memory:"):
+            path = os.path.join(tempfile.gettempdir(), "mapmo-jobs.lock")
+        else:
+            path = f"{database}.jobs.lock"
+    return FileLeaderLock(path)
+
+
+class Job:
+    def __init__(self, name: str, interval: float, func: Callable[[], Awaitable[None]], singleton: bool):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.singleton = singleton
+        self.run_count = 0
+        self.last_run_at: Optional[datetime] = None
+        self.last_duration: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def get_stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "singleton": self.singleton,
+            "run_count": self.run_count,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+            "last_duration": self.last_duration,
+            "last_error": self.last_error
+        }
+
+
+class JobRunner:
+    """Chạy các background job định kỳ, job singleton chỉ chạy ở worker đang là leader.
+
+    Các worker liên tục thử lấy leader lock; khi leader chết lock được nhả và
+    worker khác tiếp quản trong vòng một election_interval.
+    """
+
+    def __init__(self, election_interval: float = 5.0):
+        self.election_interval = election_interval
+        self.jobs: Dict[str, Job] = {}
+        self.lock = None
+        self.is_leader = False
+        self._tasks = []
+
+    def register(self, name: str, interval: float, func: Callable[[], Awaitable[None]], singleton: bool = True):
+        """Đăng ký job (async function không tham số) chạy mỗi interval giây"""
+        self.jobs[name] = Job(name, interval, func, singleton)
+
+    def start(self, lock):
+        self.lock = lock
+        # Bầu chọn ngay để job đầu tiên không phải chờ một lượt election
+        self._elect()
+        self._tasks.append(asyncio.create_task(self._election_loop()))
+        for job in self.jobs.values():
+            self._tasks.append(asyncio.create_task(self._run_job(job)))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        if self.lock is not None and self.is_leader:
+            self.lock.release()
+        self.is_leader = False
+
+    def _elect(self):
+        try:
+            was_leader = self.is_leader
+            self.is_leader = self.lock.is_held() if was_leader else self.lock.try_acquire()
+            if self.is_leader != was_leader:
+                state = "acquired" if self.is_leader else "lost"
+                logger.info("job_leadership_changed", worker_pid=os.getpid(), state=state)
+        except Exception as e:
+            logger.error("job_leader_election_failed", error=str(e))
+            self.is_leader = False
+
+    async def _election_loop(self):
+        from app.database import run_in_db_thread
+
+        while True:
+            await asyncio.sleep(self.election_interval)
+            # Postgres advisory lock cần một round-trip, chạy trong thread database
+            await run_in_db_thread(self._elect)
+
+    async def _run_job(self, job: Job):
+        while True:
+            if job.singleton and not self.is_leader:
+                # Worker khác đang chạy job này, kiểm tra lại sau một lượt election
+                await clock.sleep(min(job.interval, self.election_interval))
+                continue
+
+            job.last_run_at = clock.now()
+            started = time.perf_counter()
+            try:
+                await job.func()
+                job.last_error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.last_error = str(e)
+                logger.error("job_failed", job=job.name, error=str(e))
+            job.last_duration = time.perf_counter() - started
+            job.run_count += 1
+
+            await clock.sleep(job.interval)
+
+    def get_stats(self) -> dict:
+        return {
+            "worker_pid": os.getpid(),
+            "is_leader": self.is_leader,
+            "jobs": {name: job.get_stats() for name, job in self.jobs.items()}
+        }
+
+
+# Global job runner instance
+job_runner = JobRunner(settings.JOB_ELECTION_INTERVAL)
@@ -0,0 +1,122 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# Tên attribute trên LogRecord chứa các field key=value
+_FIELDS_ATTR = "fields"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _format_value(value) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, (int, float, bool)):
+        return str(value).lower() if isinstance(value, bool) else str(value)
+    text = str(value)
+    if not text or any(char in text for char in ' ="\n'):
+        return json.dumps(text, ensure_ascii=False)
+    return text
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Định dạng record thành một dòng: time level logger event key=value ..."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        parts = [
+            self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            record.levelname,
+            record.name,
+            record.getMessage()
+        ]
+        fields = getattr(record, _FIELDS_ATTR, None)
+        if fields:
+            parts.extend(f"{key}={_format_value(value)}" for key, value in fields.items())
+        return " ".join(parts)
+
+
+def setup_logging(level: str = "INFO"):
+    """Cấu hình logger "app": record được đưa vào queue, thread riêng ghi ra stdout.
+
+    Gọi nhiều lần chỉ đổi level, không tạo thêm listener.
+    """
+    global _listener
+
+    app_logger = logging.getLogger("app")
+    app_logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+
+    if _listener is not None:
+        return
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(KeyValueFormatter())
+
+    app_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    app_logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+class StructuredLogger:
+    """Logger ghi event kèm các field key=value.
+
+    Kiểm tra level trước khi làm bất cứ việc gì nên log debug khi bị tắt gần như
+    không tốn chi phí. every=<giây> giới hạn mỗi call site (logger + event) một
+    record trong khoảng thời gian đó, sample=<tỉ lệ> chỉ ghi một phần record; số
+    record bị bỏ qua được báo trong field suppressed của record kế tiếp.
+    """
+
+    def __init__(self, name: str):
+        self._logger = logging.getLogger(name)
+        self._lock = threading.Lock()
+        # event -> (thời điểm ghi gần nhất, số record bị bỏ qua)
+        self._limits: Dict[str, Tuple[float, int]] = {}
+
+    def is_enabled_for(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def debug(self, event: str, every: float = None, sample: float = None, **fields):
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._log(logging.DEBUG, event, fields, every, sample)
+
+    def info(self, event: str, every: float = None, sample: float = None, **fields):
+        if self._logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, event, fields, every, sample)
+
+    def warning(self, event: str, every: float = None, sample: float = None, **fields):
+        if self._logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, event, fields, every, sample)
+
+    def error(self, event: str, every: float = None, sample: float = None, **fields):
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, event, fields, every, sample)
+
+    def _log(self, level: int, event: str, fields: dict, every: Optional[float], sample: Optional[float]):
+        if every is not None:
+            now = time.monotonic()
+            with self._lock:
+                last, suppressed = self._limits.get(event, (None, 0))
+                if last is not None and now - last < every:
+                    self._limits[event] = (last, suppressed + 1)
+                    return
+                self._limits[event] = (now, 0)
+            if suppressed:
+                fields["suppressed"] = suppressed
+        elif sample is not None and random.random() >= sample:
+            return
+
+        self._logger.log(level, event, extra={_FIELDS_ATTR: fields})
+
+
+def get_logger(name: str) -> StructuredLogger:
+    return StructuredLogger(name)
@@ -1,34 +1,67 @@
-from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, status, WebSocket, WebSocketDisconnect, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.security import HTTPAuthorizationCredentials
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional, Tuple
 import os
 import asyncio
 import random
 import json
 from datetime import datetime, timedelta
 
-from app.database import engine, get_db
-from app.models import Base, User, Conversation, Message
+from app import clock
+from app.database import DBSession, engine, get_db, get_db_stats, run_db
+from app.models import User, Conversation, Message
 from app.schemas import (
     UserCreate, UserLogin, UserProfile, UserResponse,
     MessageCreate, MessageResponse, ConversationResponse,
     SearchRequest, KeepRequest, EndRequest, SuccessResponse, ErrorResponse
 )
-from app.auth import hash_password, verify_password, create_access_token, get_current_user, authenticate_user
-from app.matching import MatchingService
+from app.auth import (
+    create_access_token, get_admin_user, get_current_user, get_user_by_username, authenticate_user,
+    principal_cache, revoke_token, security
+)
+from app.hashing import HasherOverloaded, password_hasher
+from app.tickets import ticket_verifier
+from app.static_assets import SHELL_CACHE_CONTROL, HashedStaticFiles, StaticBundle
+from app.serialization import (
+    MESSAGE_COLUMNS, FastJSONResponse, archived_message_rows, message_rows, success_response
+)
+from app.matching import MatchingService, get_user_conversation
+from app.archive import ArchiveService
+from app.export import iter_messages_ndjson
+from app.expiry import expire_conversations, expiry_scheduler, find_ended_conversations
+from app.jobs import create_leader_lock, job_runner
+from app.activity import activity_tracker
+from app.conversation_store import ConversationState, conversation_store
+from app.presence import presence
 from app.websocket_manager import WebSocketHandler, manager
+from app.message_wal import MessageWAL, replay_wal
+from app.schema import upgrade_database
+from app.config import settings
+from app.log import get_logger, setup_logging
+
+setup_logging(settings.LOG_LEVEL)
+logger = get_logger(__name__)
+
+# Tạo/cập nhật database tables bằng alembic migration (migrations/)
+if settings.AUTO_MIGRATE:
+    upgrade_database(engine)
 
-# Tạo database tables
-Base.metadata.create_all(bind=engine)
+def save(db: Session, *instances):
+    """Thêm các object vào session và commit (chạy trong thread database qua db.run)"""
+    try:
+        db.add_all(instances)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
 
-def create_default_users():
+async def create_default_users():
     """Tạo 3 tài khoản mặc định: user1, user2, user3 với mật khẩu 'password'"""
-    from app.database import SessionLocal
-    
-    db = SessionLocal()
+    db = DBSession()
     try:
         # Danh sách tên ngẫu nhiên
         random_names = [
@@ -66,12 +99,15 @@ def create_default_users():
         
         # Tạo 3 user mặc định
         default_users = ["user1", "user2", "user3"]
+        # Cùng mật khẩu nên chỉ cần hash một lần (khi có user cần tạo)
+        hashed_password = None
+        new_users = []
         
         for i, username in enumerate(default_users):
             # Kiểm tra xem user đã tồn tại chưa
-            existing_user = db.query(User).filter(User.username == username).first()
+            existing_user = await db.run(get_user_by_username, username)
             if existing_user:
-                print(f"✅ User {username} đã tồn tại, bỏ qua")
+                logger.debug("default_user_exists", username=username)
                 continue
             
             # Tạo thông tin ngẫu nhiên
@@ -89,7 +125,8 @@ def create_default_users():
             dob = datetime(birth_year, birth_month, birth_day)
             
             # Tạo user mới
-            hashed_password = hash_password("password")
+            if hashed_password is None:
+                hashed_password = await password_hasher.hash("password")
             new_user = User(
                 username=username,
                 password_hash=hashed_password,
@@ -102,17 +139,16 @@ def create_default_users():
                 state="waiting"
             )
             
-            db.add(new_user)
-            print(f"✅ Đã tạo user {username} với nickname: {nickname}")
+            new_users.append(new_user)
+            logger.info("default_user_created", username=username, nickname=nickname)
         
-        db.commit()
-        print("🎉 Hoàn thành tạo 3 tài khoản mặc định!")
+        await db.run(save, *new_users)
+        logger.info("default_users_ready", count=len(default_users))
         
     except Exception as e:
-        print(f"❌ Lỗi khi tạo default users: {e}")
-        db.rollback()
+        logger.error("default_users_failed", error=str(e))
     finally:
-        db.close()
+        await db.close()
 
 app = FastAPI(title="Mapmo.vn - Anonymous Web Chat", version="1.0.0")
 
@@ -125,8 +161,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Mount static files: nạp một lần khi khởi động, file có hash trong tên được cache vĩnh viễn
+static_bundle = StaticBundle("static")
+app.mount("/static", HashedStaticFiles(static_bundle), name="static")
+
+@app.exception_handler(HasherOverloaded)
+async def password_hasher_overloaded_handler(request: Request, exc: HasherOverloaded):
+    """Hàng đợi bcrypt đã đầy: từ chối ngay để client thử lại sau"""
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Máy chủ đang bận, vui lòng thử lại sau"},
+        headers={"Retry-After": "1"}
+    )
 
 # Constants
 INTERESTS_OPTIONS = [
@@ -145,151 +191,184 @@ GOAL_OPTIONS = [
     "Kết bạn mới thôi 🥰"
 ]
 
-# Background task để tự động xóa conversation hết countdown
-async def cleanup_expired_conversations():
-    """Background task để dọn dẹp các conversation hết hạn"""
-    while True:
-        try:
-            from app.database import SessionLocal
-            db = SessionLocal()
-            
-            try:
-                # Lấy tất cả conversation active
-                active_conversations = db.query(Conversation).filter(
-                    Conversation.is_active == True
-                ).all()
-                
-                for conversation in active_conversations:
-                    # Kiểm tra xem countdown đã hết thời gian chưa
-                    if conversation.is_countdown_expired() and not conversation.both_kept():
-                        print(f"⏰ Conversation {conversation.id} expired, ending...")
-                        
-                        # Broadcast countdown update trước khi kết thúc
-                        await manager.broadcast_countdown_update(conversation.id)
-                        
-                        # Kết thúc conversation
-                        conversation.is_active = False
-                        
-                        # Cập nhật trạng thái user về waiting
-                        user1 = db.query(User).filter(User.id == conversation.user1_id).first()
-                        user2 = db.query(User).filter(User.id == conversation.user2_id).first()
-                        
-                        if user1:
-                            user1.state = "waiting"
-                        if user2:
-                            user2.state = "waiting"
-                        
-                        # Gửi thông báo kết thúc cho cả 2 user
-                        end_message = {
-                            "type": "conversation_ended",
-                            "data": {
-                                "conversation_id": conversation.id,
-                                "reason": "countdown_expired",
-                                "redirect_url": "/"
-                            }
-                        }
-                        
-                        await manager.send_to_conversation(end_message, conversation.id)
-                        
-                        print(f"✅ Conversation {conversation.id} ended due to countdown expiration")
-                
-                db.commit()
-                
-            finally:
-                db.close()
-                
-        except Exception as e:
-            print(f"❌ Error in cleanup_expired_conversations: {e}")
+async def notify_conversations_expired(expired: List[Tuple[int, int, int]], reason: str = "countdown_expired"):
+    """Gửi conversation_ended cho các conversation vừa bị hệ thống kết thúc"""
+    for conversation_id, user1_id, user2_id in expired:
+        expiry_scheduler.cancel(conversation_id)
+        activity_tracker.forget(conversation_id)
+        conversation_store.discard(conversation_id)
+        presence.set_many((user1_id, user2_id), "waiting")
         
-        # Chạy mỗi 30 giây
-        await asyncio.sleep(30)
-
-async def broadcast_countdown_updates():
-    """Background task để broadcast countdown updates cho tất cả conversation active"""
-    while True:
-        try:
-            from app.database import SessionLocal
-            db = SessionLocal()
-            
-            try:
-                # Lấy tất cả conversation active
-                active_conversations = db.query(Conversation).filter(
-                    Conversation.is_active == True
-                ).all()
-                
-                for conversation in active_conversations:
-                    # Chỉ broadcast nếu có user đang kết nối
-                    if conversation.id in manager.conversation_connections:
-                        await manager.broadcast_countdown_update(conversation.id)
-                
-            finally:
-                db.close()
-                
-        except Exception as e:
-            print(f"❌ Error in broadcast_countdown_updates: {e}")
+        end_message = {
+            "type": "conversation_ended",
+            "data": {
+                "conversation_id": conversation_id,
+                "ended_by": "system",
+                "reason": reason,
+                "redirect_to_waiting": True,
+                "redirect_url": "/"
+            }
+        }
+        
+        await manager.send_to_conversation(end_message, conversation_id)
         
-        # Broadcast mỗi 10 giây
-        await asyncio.sleep(10)
+        manager.remove_from_conversation(conversation_id, user1_id)
+        manager.remove_from_conversation(conversation_id, user2_id)
+        manager.drop_replay_buffer(conversation_id)
+
+async def expire_due_conversations(conversation_ids: List[int]):
+    """Kết thúc các conversation khi expiry scheduler báo có deadline tới hạn.
+    
+    Mọi worker đều lập lịch các conversation active nên cùng nhận một deadline:
+    worker nhanh nhất kết thúc conversation trong database, các worker còn lại
+    không nhận được row nào từ UPDATE nhưng vẫn thấy conversation đã kết thúc và
+    dọn trạng thái / báo cho socket của mình.
+    """
+    def expire(db):
+        expired = expire_conversations(db, conversation_ids=conversation_ids)
+        expired_ids = {conversation_id for conversation_id, _, _ in expired}
+        ended_elsewhere = find_ended_conversations(
+            db, [conversation_id for conversation_id in conversation_ids if conversation_id not in expired_ids]
+        )
+        return expired, ended_elsewhere
+    
+    expired, ended_elsewhere = await run_db(expire)
+    
+    if expired:
+        logger.info("conversations_expired", count=len(expired))
+    
+    await notify_conversations_expired(expired + ended_elsewhere)
+
+def enable_message_wal():
+    """Ghi lại các message chưa commit từ WAL vào database và gắn WAL vào manager"""
+    from app.database import SessionLocal
+    
+    wal = MessageWAL(
+        settings.MESSAGE_WAL_PATH,
+        fsync_interval=settings.MESSAGE_WAL_FSYNC_INTERVAL,
+        compact_bytes=settings.MESSAGE_WAL_COMPACT_BYTES
+    )
+    
+    db = SessionLocal()
+    try:
+        recovered = replay_wal(wal, db)
+        logger.info("message_wal_enabled", path=settings.MESSAGE_WAL_PATH, recovered=recovered)
+    finally:
+        db.close()
+    
+    manager.wal = wal
+
+async def archive_ended_conversations():
+    """Job chuyển tin nhắn của conversation đã kết thúc sang archive"""
+    archived = await run_db(lambda db: ArchiveService(db).archive_expired_conversations(
+        timedelta(days=settings.ARCHIVE_RETENTION_DAYS),
+        batch_size=settings.ARCHIVE_BATCH_SIZE
+    ))
+    if archived:
+        logger.info("messages_archived", count=archived)
+
+async def flush_conversation_activity():
+    """Job ghi last_activity đã thay đổi trong activity tracker xuống database"""
+    await activity_tracker.flush()
+
+async def flush_presence():
+    """Job ghi trạng thái user đã thay đổi trong presence xuống database"""
+    await presence.flush()
+
+async def reap_idle_conversations():
+    """Job kết thúc các conversation cả 2 đã keep nhưng không hoạt động, danh sách lấy từ activity tracker"""
+    idle_ids = activity_tracker.find_idle(settings.CONVERSATION_IDLE_TIMEOUT)
+    if not idle_ids:
+        return
+    
+    idle_before = clock.now() - timedelta(seconds=settings.CONVERSATION_IDLE_TIMEOUT)
+    async with DBSession() as db:
+        ended = await MatchingService(db).cleanup_inactive_conversations(idle_ids, idle_before)
+        # Worker khác có thể đã kết thúc trước, vẫn phải dọn trạng thái của worker này
+        ended_ids = {conversation_id for conversation_id, _, _ in ended}
+        ended_elsewhere = await db.run(find_ended_conversations, [
+            conversation_id for conversation_id in idle_ids if conversation_id not in ended_ids
+        ])
+    
+    if ended:
+        logger.info("idle_conversations_ended", count=len(ended))
+    
+    await notify_conversations_expired(ended + ended_elsewhere, reason="inactive")
+
+def seed_conversation_state():
+    """Nạp deadline và last_activity của các conversation đang active vào bộ nhớ,
+    rồi dựng lại presence từ conversation store"""
+    from app.database import SessionLocal
+    
+    db = SessionLocal()
+    try:
+        scheduled = expiry_scheduler.seed(db)
+        logger.info("expiry_scheduler_seeded", conversations=scheduled)
+        activity_tracker.seed(db)
+        conversation_store.seed(db)
+        presence.rebuild(db, conversation_store.connected_user_ids())
+    finally:
+        db.close()
 
 # Startup event để bắt đầu background task
 @app.on_event("startup")
 async def startup_event():
     """Khởi động background task khi app start"""
-    print("🚀 Khởi động server...")
+    logger.info("server_starting")
     
     # Tạo 3 tài khoản mặc định
-    create_default_users()
+    await create_default_users()
     
-    # Bắt đầu background task
-    asyncio.create_task(cleanup_expired_conversations())
-    asyncio.create_task(broadcast_countdown_updates())
+    # Replay WAL còn sót lại từ lần chạy trước rồi bật WAL cho message queue
+    if settings.MESSAGE_WAL_PATH:
+        enable_message_wal()
     
-    print("✅ Server đã sẵn sàng!")
+    # Nạp deadline countdown từ database và bắt đầu expiry scheduler
+    seed_conversation_state()
+    expiry_scheduler.start(expire_due_conversations)
+    
+    # Job định kỳ chỉ chạy ở worker đang giữ leader lock; expiry scheduler vẫn chạy
+    # ở mọi worker: UPDATE ... RETURNING chỉ trả row cho worker kết thúc conversation
+    # trước, các worker khác dọn theo is_active trong database (expire_due_conversations)
+    job_runner.register("archive_messages", settings.ARCHIVE_INTERVAL, archive_ended_conversations)
+    # Activity tracker là bộ nhớ riêng của từng worker nên flush/reap chạy ở mọi worker
+    job_runner.register("flush_activity", settings.ACTIVITY_FLUSH_INTERVAL, flush_conversation_activity, singleton=False)
+    job_runner.register("flush_presence", settings.PRESENCE_FLUSH_INTERVAL, flush_presence, singleton=False)
+    job_runner.register("push_searching_count", settings.SEARCHING_COUNT_PUSH_INTERVAL, manager.push_searching_count, singleton=False)
+    job_runner.register("reap_idle_conversations", settings.IDLE_REAP_INTERVAL, reap_idle_conversations, singleton=False)
+    job_runner.start(create_leader_lock(engine))
+    
+    logger.info("server_ready")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Ghi nốt last_activity, trạng thái user và nhả leader lock để worker khác tiếp quản ngay"""
+    job_runner.stop()
+    await flush_conversation_activity()
+    await flush_presence()
 
 @app.get("/", response_class=HTMLResponse)
-async def read_root():
+async def read_root(request: Request):
     """Trang chủ - redirect đến login"""
-    with open("static/index.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    return static_bundle.shell.response(request.headers, SHELL_CACHE_CONTROL)
 
 @app.get("/chat/{conversation_id}", response_class=HTMLResponse)
-async def chat_room(conversation_id: int):
+async def chat_room(conversation_id: int, request: Request):
     """Endpoint để vào phòng chat cụ thể"""
-    # Trả về trang HTML cơ bản, JavaScript sẽ xử lý xác thực và load conversation
-    with open("static/index.html", "r", encoding="utf-8") as f:
-        html_content = f.read()
-    
-    # Thêm script để tự động load conversation khi user đã đăng nhập
-    script = f"""
-    <script>
-        // Tự động load conversation khi vào URL
-        window.addEventListener('load', function() {{
-            if (window.app) {{
-                window.app.loadConversationFromUrl({conversation_id});
-            }} else {{
-                // Nếu app chưa được khởi tạo, đợi một chút
-                setTimeout(function() {{
-                    if (window.app) {{
-                        window.app.loadConversationFromUrl({conversation_id});
-                    }}
-                }}, 100);
-            }}
-        }});
-    </script>
-    """
-    
-    # Chèn script vào cuối body
-    html_content = html_content.replace('</body>', f'{script}</body>')
-    
-    return HTMLResponse(content=html_content)
+    # Cùng HTML shell với trang chủ, JavaScript đọc conversation id từ URL,
+    # xử lý xác thực và load conversation
+    return static_bundle.shell.response(request.headers, SHELL_CACHE_CONTROL)
 
 @app.get("/api/me", response_model=UserResponse)
 async def get_current_user_info(current_user: User = Depends(get_current_user)):
     """Lấy thông tin user hiện tại"""
-    return UserResponse.from_orm(current_user)
+    user_info = UserResponse.from_orm(current_user)
+    # Cột state chỉ được ghi theo lô, presence mới là trạng thái hiện tại
+    user_info.state = presence.get(current_user.id)
+    return user_info
 
 @app.post("/register", response_model=SuccessResponse)
-async def register(user_data: UserCreate, db: Session = Depends(get_db)):
+async def register(user_data: UserCreate, db: DBSession = Depends(get_db)):
     """Đăng ký tài khoản mới"""
     # Kiểm tra password xác nhận
     if user_data.password != user_data.confirm_password:
@@ -299,7 +378,7 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         )
     
     # Kiểm tra username đã tồn tại chưa
-    existing_user = db.query(User).filter(User.username == user_data.username).first()
+    existing_user = await db.run(get_user_by_username, user_data.username)
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -307,16 +386,14 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         )
     
     # Tạo user mới
-    hashed_password = hash_password(user_data.password)
+    hashed_password = await password_hasher.hash(user_data.password)
     new_user = User(
         username=user_data.username,
         password_hash=hashed_password,
         state="waiting"
     )
     
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.run(save, new_user)
     
     return SuccessResponse(
         success=True,
@@ -325,9 +402,9 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
     )
 
 @app.post("/login", response_model=SuccessResponse)
-async def login(user_data: UserLogin, db: Session = Depends(get_db)):
+async def login(user_data: UserLogin, db: DBSession = Depends(get_db)):
     """Đăng nhập"""
-    user = authenticate_user(db, user_data.username, user_data.password)
+    user = await authenticate_user(db, user_data.username, user_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -335,7 +412,7 @@ async def login(user_data: UserLogin, db: Session = Depends(get_db)):
         )
     
     # Tạo access token
-    access_token = create_access_token(data={"sub": user.username})
+    access_token = create_access_token(data={"sub": user.username, "uid": user.id})
     
     return SuccessResponse(
         success=True,
@@ -347,29 +424,65 @@ async def login(user_data: UserLogin, db: Session = Depends(get_db)):
                 "id": user.id,
                 "username": user.username,
                 "nickname": user.nickname,
-                "state": user.state,
+                "state": presence.get(user.id),
                 "profile_completed": user.nickname is not None
             }
         }
     )
 
 @app.post("/logout", response_model=SuccessResponse)
-async def logout(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def logout(
+    current_user: User = Depends(get_current_user),
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: DBSession = Depends(get_db)
+):
     """Đăng xuất"""
     # Cập nhật trạng thái user về waiting
-    current_user.state = "waiting"
-    db.commit()
+    presence.set(current_user.id, "waiting")
+    # Token này không dùng được nữa (kể cả để xin vé WebSocket mới), vé đã cấp cũng bị thu hồi
+    revoke_token(credentials.credentials)
+    principal_cache.invalidate(current_user.username)
+    ticket_verifier.revoke_user(current_user.id)
     
     return SuccessResponse(
         success=True,
         message="Đăng xuất thành công"
     )
 
+@app.post("/api/ws-ticket", response_model=SuccessResponse)
+async def issue_ws_ticket(current_user: User = Depends(get_current_user)):
+    """Cấp vé ngắn hạn để mở kết nối WebSocket"""
+    ticket, expires = ticket_verifier.issue(current_user.id)
+    
+    return SuccessResponse(
+        success=True,
+        message="Cấp vé kết nối thành công",
+        data={
+            "ticket": ticket,
+            "expires_in": settings.WS_TICKET_TTL
+        }
+    )
+
+def update_user_profile(db: Session, user_id: int, profile_data: UserProfile) -> User:
+    """Ghi hồ sơ mới của user (chạy trong thread database)"""
+    user = db.get(User, user_id)
+    
+    # Cập nhật thông tin
+    user.nickname = profile_data.nickname
+    user.dob = profile_data.dob
+    user.gender = profile_data.gender
+    user.preference = profile_data.preference
+    user.goal = profile_data.goal
+    user.set_interests_list(profile_data.interests)
+    
+    save(db, user)
+    return user
+
 @app.put("/profile", response_model=SuccessResponse)
 async def update_profile(
     profile_data: UserProfile,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: DBSession = Depends(get_db)
 ):
     """Cập nhật hồ sơ người dùng"""
     # Kiểm tra số lượng sở thích
@@ -379,15 +492,10 @@ async def update_profile(
             detail="Chỉ được chọn tối đa 5 sở thích"
         )
     
-    # Cập nhật thông tin
-    current_user.nickname = profile_data.nickname
-    current_user.dob = profile_data.dob
-    current_user.gender = profile_data.gender
-    current_user.preference = profile_data.preference
-    current_user.goal = profile_data.goal
-    current_user.set_interests_list(profile_data.interests)
-    
-    db.commit()
+    # current_user lấy từ principal cache (detached), nạp lại bản ghi để cập nhật
+    user = await db.run(update_user_profile, current_user.id, profile_data)
+    principal_cache.invalidate(user.username)
+    conversation_store.set_nickname(user.id, user.nickname)
     
     return SuccessResponse(
         success=True,
@@ -406,7 +514,7 @@ async def get_profile_options():
 async def start_search(
     search_data: SearchRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: DBSession = Depends(get_db)
 ):
     """Bắt đầu tìm kiếm chat hoặc voice call"""
     try:
@@ -417,61 +525,32 @@ async def start_search(
                 detail="Vui lòng hoàn thành hồ sơ trước khi tìm kiếm"
             )
         
-        # Kiểm tra xem user đã có conversation active chưa
-        existing_conversation = db.query(Conversation).filter(
-            ((Conversation.user1_id == current_user.id) | (Conversation.user2_id == current_user.id)) &
-            (Conversation.is_active == True)
-        ).first()
+        # Kiểm tra xem user đã có conversation active chưa (index trong conversation store)
+        existing_conversation = conversation_store.find_by_user(current_user.id)
         
         if existing_conversation:
-            # User đã có conversation active, trả về thông tin conversation
-            other_user_id = existing_conversation.user2_id if existing_conversation.user1_id == current_user.id else existing_conversation.user1_id
-            other_user = db.query(User).filter(User.id == other_user_id).first()
-            
             # Đảm bảo user hiện tại có trạng thái "connected"
-            if current_user.state != "connected":
-                current_user.state = "connected"
-                db.commit()
-                print(f"🔄 Updated user {current_user.id} state from {current_user.state} to connected")
+            if presence.get(current_user.id) != "connected":
+                presence.set(current_user.id, "connected")
+                logger.debug("user_state_repaired", user_id=current_user.id, state="connected")
             
             # Thêm vào WebSocket connections nếu chưa có
             manager.add_to_conversation(existing_conversation.id, current_user.id)
             
-            # Gửi thông báo match qua WebSocket nếu user chưa nhận được
-            match_notification = {
-                "type": "match_found",
-                "data": {
-                    "conversation_id": existing_conversation.id,
-                    "conversation_type": existing_conversation.conversation_type,
-                    "chat_url": f"/chat/{existing_conversation.id}",
-                    "matched_user": {
-                        "id": other_user.id,
-                        "nickname": other_user.nickname
-                    }
-                }
-            }
-            
-            # Gửi thông báo match cho user hiện tại
-            await manager.send_personal_message(match_notification, current_user.id)
+            # Gửi thông báo match cho user hiện tại qua WebSocket nếu user chưa nhận được
+            match_data = existing_conversation.get_match_payload(current_user.id)
+            await manager.send_personal_message({"type": "match_found", "data": match_data}, current_user.id)
             
-            print(f"🔄 User {current_user.id} already has active conversation {existing_conversation.id}, sent match notification")
+            logger.debug("search_existing_conversation", user_id=current_user.id, conversation_id=existing_conversation.id)
             
             return SuccessResponse(
                 success=True,
                 message="Đã tìm thấy người phù hợp",
-                data={
-                    "conversation_id": existing_conversation.id,
-                    "conversation_type": existing_conversation.conversation_type,
-                    "chat_url": f"/chat/{existing_conversation.id}",
-                    "matched_user": {
-                        "id": other_user.id,
-                        "nickname": other_user.nickname
-                    }
-                }
+                data=match_data
             )
         
         # Kiểm tra xem user đã đang trong trạng thái searching chưa
-        if current_user.state == "searching":
+        if presence.get(current_user.id) == "searching":
             return SuccessResponse(
                 success=True,
                 message="Đang tìm kiếm...",
@@ -479,80 +558,53 @@ async def start_search(
             )
         
         # Cập nhật trạng thái user
-        current_user.state = "searching"
-        db.commit()
+        presence.set(current_user.id, "searching")
         
         # Tìm kiếm ghép nối
         matching_service = MatchingService(db)
-        match = matching_service.find_match(current_user, search_data.search_type)
+        match = await matching_service.find_match(current_user, search_data.search_type)
         
         if match:
             try:
                 # Tạo conversation
-                conversation = matching_service.create_conversation(
+                conversation = await matching_service.create_conversation(
                     current_user, match, search_data.search_type
                 )
                 
+                # Lập lịch kết thúc khi countdown hết
+                expiry_scheduler.schedule(conversation.id, conversation.get_countdown_deadline())
+                activity_tracker.touch(conversation.id)
+                state = conversation_store.put(conversation, {
+                    current_user.id: current_user.nickname,
+                    match.id: match.nickname
+                })
+                
                 # Thêm vào WebSocket connections
                 manager.add_to_conversation(conversation.id, current_user.id)
                 manager.add_to_conversation(conversation.id, match.id)
                 
                 # Tạo thông báo match cho cả 2 user
-                match_notification_current = {
-                    "type": "match_found",
-                    "data": {
-                        "conversation_id": conversation.id,
-                        "conversation_type": conversation.conversation_type,
-                        "chat_url": f"/chat/{conversation.id}",
-                        "matched_user": {
-                            "id": match.id,
-                            "nickname": match.nickname
-                        }
-                    }
-                }
-                
-                match_notification_other = {
-                    "type": "match_found",
-                    "data": {
-                        "conversation_id": conversation.id,
-                        "conversation_type": conversation.conversation_type,
-                        "chat_url": f"/chat/{conversation.id}",
-                        "matched_user": {
-                            "id": current_user.id,
-                            "nickname": current_user.nickname
-                        }
-                    }
-                }
+                match_data_current = state.get_match_payload(current_user.id)
+                match_data_other = state.get_match_payload(match.id)
                 
                 # Gửi thông báo cho cả 2 user đồng thời
                 await asyncio.gather(
-                    manager.send_personal_message(match_notification_current, current_user.id),
-                    manager.send_personal_message(match_notification_other, match.id),
+                    manager.send_personal_message({"type": "match_found", "data": match_data_current}, current_user.id),
+                    manager.send_personal_message({"type": "match_found", "data": match_data_other}, match.id),
                     return_exceptions=True
                 )
                 
-                print(f"🎯 Match created: User {current_user.id} ({current_user.nickname}) matched with User {match.id} ({match.nickname})")
-                print(f"   Conversation ID: {conversation.id}")
-                print(f"   WebSocket notifications sent to both users")
+                logger.info("match_created", conversation_id=conversation.id, user1_id=current_user.id, user2_id=match.id)
                 
                 return SuccessResponse(
                     success=True,
                     message="Đã tìm thấy người phù hợp",
-                    data={
-                        "conversation_id": conversation.id,
-                        "conversation_type": conversation.conversation_type,
-                        "chat_url": f"/chat/{conversation.id}",
-                        "matched_user": {
-                            "id": match.id,
-                            "nickname": match.nickname
-                        }
-                    }
+                    data=match_data_current
                 )
             except ValueError as e:
                 # Nếu có lỗi khi tạo conversation (ví dụ: user đã được match với người khác)
                 # Quay lại trạng thái searching và tiếp tục tìm kiếm
-                current_user.state = "searching"
-                db.commit()
+                presence.set(current_user.id, "searching")
                 
                 return SuccessResponse(
                     success=True,
@@ -561,8 +613,7 @@ async def start_search(
                 )
             except Exception as e:
                 # Nếu có lỗi khác, quay về trạng thái waiting
-                current_user.state = "waiting"
-                db.commit()
+                presence.set(current_user.id, "waiting")
                 raise HTTPException(
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                     detail=f"Lỗi khi tạo conversation: {str(e)}"
@@ -579,11 +630,7 @@ async def start_search(
         raise
     except Exception as e:
         # Đảm bảo user được đưa về trạng thái waiting nếu có lỗi
-        try:
-            current_user.state = "waiting"
-            db.commit()
-        except:
-            pass
+        presence.set(current_user.id, "waiting")
         
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -594,13 +641,13 @@ async def start_search(
 async def toggle_keep(
     keep_data: KeepRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: DBSession = Depends(get_db)
 ):
     """Nhấn nút Keep"""
-    conversation = db.query(Conversation).filter(
-        Conversation.id == keep_data.conversation_id,
-        (Conversation.user1_id == current_user.id) | (Conversation.user2_id == current_user.id)
-    ).first()
+    # Ghi thẳng xuống database qua conversation store (dùng chung với WebSocket handler)
+    conversation = await conversation_store.set_keep(
+        keep_data.conversation_id, current_user.id, keep_data.keep_status
+    )
     
     if not conversation:
         raise HTTPException(
@@ -608,9 +655,29 @@ async def toggle_keep(
             detail="Không tìm thấy cuộc trò chuyện"
         )
     
-    conversation.set_keep_status(current_user.id, keep_data.keep_status)
-    conversation.last_activity = datetime.utcnow()
-    db.commit()
+    activity_tracker.touch(conversation.id)
+    
+    # Cả 2 đã keep thì không còn deadline, bỏ keep thì lập lịch lại
+    if conversation.is_active:
+        if conversation.both_kept():
+            expiry_scheduler.cancel(conversation.id)
+        else:
+            expiry_scheduler.schedule(conversation.id, conversation.get_countdown_deadline())
+        
+        # Thông báo thay đổi keep cho user còn lại và đồng bộ countdown
+        await manager.send_to_conversation({
+            "type": "keep_status",
+            "data": {
+                "conversation_id": conversation.id,
+                "user_id": current_user.id,
+                "keep_status": keep_data.keep_status,
+                "both_kept": conversation.both_kept()
+            }
+        }, conversation.id, exclude_user_id=current_user.id)
+        await manager.broadcast_countdown_update(
+            conversation.id, conversation,
+            reason="both_kept" if conversation.both_kept() else "keep_toggled"
+        )
     
     return SuccessResponse(
         success=True,
@@ -625,20 +692,16 @@ async def toggle_keep(
 @app.post("/cancel-search", response_model=SuccessResponse)
 async def cancel_search(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: DBSession = Depends(get_db)
 ):
     """Hủy tìm kiếm và quay về trạng thái waiting"""
-    # Kiểm tra xem user có đang trong trạng thái searching không
-    if current_user.state != "searching":
+    # Chỉ hủy khi user đang trong trạng thái searching, cập nhật về waiting
+    if not presence.transition(current_user.id, "searching", "waiting"):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="User không đang trong trạng thái tìm kiếm"
         )
     
-    # Cập nhật trạng thái user về waiting
-    current_user.state = "waiting"
-    db.commit()
-    
     return SuccessResponse(
         success=True,
         message="Đã hủy tìm kiếm"
@@ -648,13 +711,10 @@ async def cancel_search(
 async def end_conversation(
     end_data: EndRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: DBSession = Depends(get_db)
 ):
     """Kết thúc cuộc trò chuyện"""
-    conversation = db.query(Conversation).filter(
-        Conversation.id == end_data.conversation_id,
-        (Conversation.user1_id == current_user.id) | (Conversation.user2_id == current_user.id)
-    ).first()
+    conversation = await db.run(get_user_conversation, end_data.conversation_id, current_user.id)
     
     if not conversation:
         raise HTTPException(
@@ -664,7 +724,10 @@ async def end_conversation(
     
     # Kết thúc conversation
     matching_service = MatchingService(db)
-    matching_service.end_conversation(conversation)
+    await matching_service.end_conversation(conversation)
+    expiry_scheduler.cancel(conversation.id)
+    activity_tracker.forget(conversation.id)
+    conversation_store.discard(conversation.id)
     
     # Gửi thông báo kết thúc cho tất cả user trong conversation
     message_to_send = {
@@ -682,24 +745,110 @@ async def end_conversation(
     
     # Xóa khỏi WebSocket connections
     manager.remove_from_conversation(conversation.id, current_user.id)
+    manager.drop_replay_buffer(conversation.id)
     
     return SuccessResponse(
         success=True,
         message="Đã kết thúc cuộc trò chuyện"
     )
 
+def load_message_history(db: Session, conversation_id: int, user_id: int) -> Optional[List[dict]]:
+    """Toàn bộ tin nhắn của conversation (kể cả phần đã archive), None nếu user không
+    thuộc conversation. Chạy trong thread database."""
+    # Kiểm tra user có trong conversation không
+    conversation = get_user_conversation(db, conversation_id, user_id)
+    if not conversation:
+        return None
+    
+    # Đọc thẳng các cột cần trả về, không dựng ORM object và MessageResponse cho từng row
+    messages = message_rows(db.query(*MESSAGE_COLUMNS).filter(
+        Message.conversation_id == conversation_id
+    ).order_by(Message.created_at.asc()))
+    
+    # Conversation đã kết thúc có thể đã được chuyển sang archive
+    if not conversation.is_active:
+        archived_messages = ArchiveService(db).get_archived_messages(conversation_id)
+        if archived_messages:
+            return archived_message_rows(archived_messages) + messages
+    
+    return messages
+
+def load_message_page(db: Session, conversation_id: int, limit: int,
+                      before_id: Optional[int] = None) -> Tuple[List[dict], bool]:
+    """Tối đa limit tin nhắn mới nhất (cũ hơn tin nhắn before_id nếu có) theo thứ tự
+    tăng dần, kèm cờ còn tin nhắn cũ hơn. Cursor theo (created_at, id) để đi theo
+    index ix_messages_conversation_created."""
+    query = db.query(*MESSAGE_COLUMNS).filter(Message.conversation_id == conversation_id)
+    
+    if before_id is not None:
+        cursor = db.query(Message.created_at).filter(
+            Message.id == before_id,
+            Message.conversation_id == conversation_id
+        ).scalar()
+        if cursor is None:
+            return [], False
+        query = query.filter(or_(
+            Message.created_at < cursor,
+            and_(Message.created_at == cursor, Message.id < before_id)
+        ))
+    
+    messages = message_rows(query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit + 1))
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    return messages, has_more
+
+def load_older_messages(db: Session, conversation_id: int, user_id: int,
+                        before_id: int, limit: int) -> Optional[List[dict]]:
+    """Trang tin nhắn cũ hơn before_id, None nếu user không thuộc conversation"""
+    conversation = get_user_conversation(db, conversation_id, user_id)
+    if not conversation:
+        return None
+    
+    # Archive là một segment nguyên khối, cắt trang từ toàn bộ lịch sử
+    if not conversation.is_active and ArchiveService(db).get_archived_messages(conversation_id):
+        messages = load_message_history(db, conversation_id, user_id)
+        end = next((index for index, message in enumerate(messages) if message["id"] == before_id), 0)
+        return messages[max(0, end - limit):end]
+    
+    return load_message_page(db, conversation_id, limit, before_id)[0]
+
 @app.get("/conversation/{conversation_id}/messages", response_model=List[MessageResponse])
 async def get_messages(
     conversation_id: int,
+    before_id: Optional[int] = None,
+    limit: int = Query(settings.BOOTSTRAP_MESSAGE_LIMIT, ge=1, le=500),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: DBSession = Depends(get_db)
 ):
-    """Lấy danh sách tin nhắn của conversation"""
-    # Kiểm tra user có trong conversation không
-    conversation = db.query(Conversation).filter(
-        Conversation.id == conversation_id,
-        (Conversation.user1_id == current_user.id) | (Conversation.user2_id == current_user.id)
-    ).first()
+    """Lấy danh sách tin nhắn của conversation.
+    
+    Có before_id thì chỉ trả tối đa limit tin nhắn cũ hơn tin nhắn đó (client tải
+    dần lịch sử sau bootstrap), trang ngắn hơn limit nghĩa là đã hết.
+    """
+    if before_id is not None:
+        messages = await db.run(load_older_messages, conversation_id, current_user.id, before_id, limit)
+    else:
+        messages = await db.run(load_message_history, conversation_id, current_user.id)
+    
+    if messages is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Không tìm thấy cuộc trò chuyện"
+        )
+    
+    return FastJSONResponse(messages)
+
+@app.get("/conversation/{conversation_id}/export")
+async def export_messages(
+    conversation_id: int,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user),
+    db: DBSession = Depends(get_db)
+):
+    """Export lịch sử tin nhắn của conversation dạng NDJSON (streaming)"""
+    conversation = await db.run(get_user_conversation, conversation_id, current_user.id)
     
     if not conversation:
         raise HTTPException(
@@ -707,134 +856,111 @@ async def get_messages(
             detail="Không tìm thấy cuộc trò chuyện"
         )
     
-    messages = db.query(Message).filter(
-        Message.conversation_id == conversation_id
-    ).order_by(Message.created_at.asc()).all()
+    return StreamingResponse(
+        iter_messages_ndjson([conversation_id], since, until, chunk_size=settings.EXPORT_CHUNK_SIZE),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="conversation-{conversation_id}.ndjson"'}
+    )
+
+def build_conversation_info(conversation: ConversationState, user_id: int) -> dict:
+    """Thông tin conversation nhìn từ phía user_id: user còn lại, keep và countdown"""
+    other_user_id = conversation.get_other_user_id(user_id)
     
-    return messages
+    return {
+        "conversation_id": conversation.id,
+        "conversation_type": conversation.conversation_type,
+        "matched_user": {
+            "id": other_user_id,
+            "nickname": conversation.nicknames.get(other_user_id)
+        },
+        "keep_status": {
+            "current_user_kept": conversation.get_keep_status(user_id),
+            "both_kept": conversation.both_kept()
+        },
+        "countdown": {
+            **conversation.get_countdown_state(),
+            "time_left": conversation.get_countdown_time_left(),
+            "expired": conversation.is_countdown_expired(),
+            "start_time": conversation.countdown_start_time.isoformat() if conversation.countdown_start_time else None
+        }
+    }
 
 @app.get("/api/conversation/{conversation_id}", response_model=SuccessResponse)
 async def get_conversation_info(
     conversation_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user)
 ):
     """Lấy thông tin conversation và user khác"""
-    try:
-        print(f"🔍 API request: User {current_user.id} ({current_user.username}) requesting conversation {conversation_id}")
-        
-        # Kiểm tra xem user có quyền xem conversation này không
-        conversation = db.query(Conversation).filter(
-            Conversation.id == conversation_id,
-            Conversation.is_active == True,
-            ((Conversation.user1_id == current_user.id) | (Conversation.user2_id == current_user.id))
-        ).first()
-        
-        if not conversation:
-            print(f"❌ Conversation {conversation_id} not found or not active for user {current_user.id}")
-            raise HTTPException(status_code=404, detail="Không tìm thấy conversation")
-        
-        print(f"✅ Found conversation {conversation_id}: User1={conversation.user1_id}, User2={conversation.user2_id}")
-        
-        # Lấy thông tin user khác trong conversation
-        other_user_id = conversation.user2_id if conversation.user1_id == current_user.id else conversation.user1_id
-        other_user = db.query(User).filter(User.id == other_user_id).first()
-        
-        if not other_user:
-            print(f"❌ Other user {other_user_id} not found for conversation {conversation_id}")
-            raise HTTPException(status_code=500, detail="Không tìm thấy thông tin user khác")
-        
-        print(f"✅ Found other user: {other_user.username} (ID: {other_user.id})")
-        
-        # Lấy thông tin keep status
-        current_user_kept = conversation.user1_keep if conversation.user1_id == current_user.id else conversation.user2_keep
-        both_kept = conversation.both_kept()
-        
-        # Lấy thông tin countdown
-        countdown_time_left = conversation.get_countdown_time_left()
-        countdown_expired = conversation.is_countdown_expired()
-        
-        response_data = {
-            "conversation_id": conversation.id,
-            "conversation_type": conversation.conversation_type,
-            "matched_user": {
-                "id": other_user.id,
-                "nickname": other_user.nickname
-            },
-            "keep_status": {
-                "current_user_kept": current_user_kept,
-                "both_kept": both_kept
-            },
-            "countdown": {
-                "time_left": countdown_time_left,
-                "expired": countdown_expired,
-                "start_time": conversation.countdown_start_time.isoformat() if conversation.countdown_start_time else None
-            }
-        }
-        
-        print(f"✅ Successfully returning conversation info for user {current_user.id}")
-        return SuccessResponse(
-            success=True,
-            message="Thông tin conversation",
-            data=response_data
-        )
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"❌ Error in get_conversation_info: {e}")
-        raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
+    # Kiểm tra xem user có quyền xem conversation này không (index trong conversation store)
+    conversation = conversation_store.find_by_user(current_user.id)
+    
+    if not conversation or conversation.id != conversation_id:
+        logger.debug("conversation_info_not_found", user_id=current_user.id, conversation_id=conversation_id)
+        raise HTTPException(status_code=404, detail="Không tìm thấy conversation")
+    
+    return success_response("Thông tin conversation", build_conversation_info(conversation, current_user.id))
+
+@app.get("/api/conversation/{conversation_id}/bootstrap", response_model=SuccessResponse)
+async def get_conversation_bootstrap(
+    conversation_id: int,
+    current_user: User = Depends(get_current_user),
+    db: DBSession = Depends(get_db)
+):
+    """Mọi thứ cần để mở phòng chat trong một request: thông tin conversation,
+    user còn lại, keep, deadline và trang tin nhắn mới nhất.
+    
+    Conversation lấy từ conversation store, chỉ có một query lấy tin nhắn.
+    """
+    conversation = conversation_store.find_by_user(current_user.id)
+    
+    if not conversation or conversation.id != conversation_id:
+        raise HTTPException(status_code=404, detail="Không tìm thấy conversation")
+    
+    messages, has_more = await db.run(load_message_page, conversation_id, settings.BOOTSTRAP_MESSAGE_LIMIT)
+    
+    return success_response("Thông tin phòng chat", {
+        **build_conversation_info(conversation, current_user.id),
+        "messages": messages,
+        "has_more_messages": has_more
+    })
 
 @app.get("/api/conversation/{conversation_id}/countdown", response_model=SuccessResponse)
 async def get_countdown_status(
     conversation_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user)
 ):
     """Lấy thông tin countdown của conversation"""
     try:
-        conversation = db.query(Conversation).filter(
-            Conversation.id == conversation_id,
-            Conversation.is_active == True,
-            ((Conversation.user1_id == current_user.id) | (Conversation.user2_id == current_user.id))
-        ).first()
+        conversation = await conversation_store.get(conversation_id)
         
-        if not conversation:
+        if not conversation or not conversation.has_user(current_user.id):
             raise HTTPException(status_code=404, detail="Không tìm thấy conversation")
         
         countdown_time_left = conversation.get_countdown_time_left()
         countdown_expired = conversation.is_countdown_expired()
         both_kept = conversation.both_kept()
         
-        # Debug logging
-        print(f"🔍 Countdown API request for conversation {conversation_id}:")
-        print(f"   User: {current_user.username} (ID: {current_user.id})")
-        print(f"   Time left: {countdown_time_left}s")
-        print(f"   Expired: {countdown_expired}")
-        print(f"   Both kept: {both_kept}")
-        print(f"   Start time: {conversation.countdown_start_time}")
+        logger.debug("countdown_requested", conversation_id=conversation_id, user_id=current_user.id,
+                     time_left=countdown_time_left, expired=countdown_expired, both_kept=both_kept)
         
-        return SuccessResponse(
-            success=True,
-            message="Thông tin countdown",
-            data={
-                "conversation_id": conversation.id,
-                "time_left": countdown_time_left,
-                "expired": countdown_expired,
-                "both_kept": both_kept,
-                "start_time": conversation.countdown_start_time.isoformat() if conversation.countdown_start_time else None,
-                "debug_info": {
-                    "user_id": current_user.id,
-                    "conversation_type": conversation.conversation_type,
-                    "user1_keep": conversation.user1_keep,
-                    "user2_keep": conversation.user2_keep
-                }
+        return success_response("Thông tin countdown", {
+            **conversation.get_countdown_state(),
+            "conversation_id": conversation.id,
+            "time_left": countdown_time_left,
+            "expired": countdown_expired,
+            "both_kept": both_kept,
+            "start_time": conversation.countdown_start_time.isoformat() if conversation.countdown_start_time else None,
+            "debug_info": {
+                "user_id": current_user.id,
+                "conversation_type": conversation.conversation_type,
+                "user1_keep": conversation.user1_keep,
+                "user2_keep": conversation.user2_keep
             }
-        )
+        })
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error in countdown endpoint: {e}")
+        logger.error("countdown_request_failed", conversation_id=conversation_id, error=str(e))
         raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
 
 @app.websocket("/ws/{user_id}")
@@ -842,69 +968,48 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int):
     """WebSocket endpoint cho real-time communication"""
     # Xác thực user trước khi kết nối WebSocket
     try:
-        # Lấy token từ query parameter hoặc header
-        token = websocket.query_params.get("token")
-        if not token:
-            # Thử lấy từ header
-            auth_header = websocket.headers.get("authorization")
-            if auth_header and auth_header.startswith("Bearer "):
-                token = auth_header[7:]
-        
-        if not token:
-            await websocket.close(code=4001, reason="Missing authentication token")
+        # Vé kết nối lấy từ /api/ws-ticket: chỉ kiểm tra chữ ký và hạn dùng, không query database
+        ticket = websocket.query_params.get("ticket")
+        if not ticket:
+            await websocket.close(code=4001, reason="Missing connection ticket")
             return
         
-        # Verify token
-        from app.auth import verify_token
-        payload = verify_token(token)
-        if not payload:
-            await websocket.close(code=4001, reason="Invalid authentication token")
+        if ticket_verifier.verify(ticket) != user_id:
+            await websocket.close(code=4001, reason="Invalid or expired connection ticket")
             return
         
-        username = payload.get("sub")
-        if not username:
-            await websocket.close(code=4001, reason="Invalid token payload")
-            return
-        
-        # Verify user exists and matches the user_id in URL
-        from app.database import SessionLocal
-        db = SessionLocal()
+        # Thông tin resume: conversation và seq cuối cùng client đã nhận
+        resume_conversation_id = websocket.query_params.get("conversation_id")
+        last_seq = websocket.query_params.get("last_seq")
         try:
-            user = db.query(User).filter(User.username == username, User.id == user_id).first()
-            if not user:
-                await websocket.close(code=4001, reason="User not found or ID mismatch")
-                return
-        finally:
-            db.close()
+            resume_conversation_id = int(resume_conversation_id) if resume_conversation_id else None
+            last_seq = int(last_seq) if last_seq else None
+        except ValueError:
+            resume_conversation_id, last_seq = None, None
         
         # Kết nối WebSocket
         handler = WebSocketHandler()
-        await handler.handle_websocket(websocket, user_id)
+        await handler.handle_websocket(websocket, user_id, resume_conversation_id, last_seq)
         
     except Exception as e:
-        print(f"WebSocket connection error: {e}")
+        logger.error("websocket_connection_failed", user_id=user_id, error=str(e))
         try:
             await websocket.close(code=4000, reason="Internal server error")
         except:
             pass
 
 @app.get("/api/searching-count")
-async def get_searching_count(db: Session = Depends(get_db)):
-    """Lấy số người đang tìm kiếm"""
-    try:
-        # Đếm số user đang trong trạng thái searching
-        searching_users = db.query(User).filter(
-            User.state == "searching"
-        ).count()
-        
-        return {
-            "success": True,
-            "data": {
-                "searching_count": searching_users
-            }
+async def get_searching_count():
+    """Lấy số người đang tìm kiếm (đếm trong presence, không query database).
+    
+    Client đang tìm kiếm nhận số này qua WebSocket, endpoint chỉ dùng cho lần đầu.
+    """
+    return FastJSONResponse({
+        "success": True,
+        "data": {
+            "searching_count": presence.count("searching")
         }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Lỗi khi lấy số người đang tìm kiếm: {str(e)}")
+    }, headers={"Cache-Control": "public, max-age=1"})
 
 @app.get("/health")
 async def health_check():
@@ -913,54 +1018,58 @@ async def health_check():
 
 @app.post("/api/admin/cleanup-expired", response_model=SuccessResponse)
 async def cleanup_expired_conversations_manual(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_admin_user),
+    db: DBSession = Depends(get_db)
 ):
     """Endpoint để manually cleanup các conversation đã hết countdown (cho admin)"""
     try:
-        # Tìm các conversation đã hết countdown và chưa được keep
-        expired_conversations = db.query(Conversation).filter(
-            Conversation.is_active == True,
-            Conversation.user1_keep == False,
-            Conversation.user2_keep == False
-        ).all()
-        
-        cleaned_count = 0
-        matching_service = MatchingService(db)
-        
-        for conversation in expired_conversations:
-            if conversation.is_countdown_expired():
-                # Kết thúc conversation
-                matching_service.end_conversation(conversation)
-                cleaned_count += 1
-                
-                # Gửi thông báo kết thúc cho tất cả user trong conversation
-                message_to_send = {
-                    "type": "conversation_ended",
-                    "data": {
-                        "conversation_id": conversation.id,
-                        "ended_by": "system",
-                        "reason": "countdown_expired",
-                        "redirect_to_waiting": True,
-                        "redirect_url": "/"
-                    }
-                }
-                
-                # Gửi thông báo cho tất cả user trong conversation
-                await manager.send_to_conversation(message_to_send, conversation.id)
-                
-                # Xóa khỏi WebSocket connections
-                manager.remove_from_conversation(conversation.id, conversation.user1_id)
-                manager.remove_from_conversation(conversation.id, conversation.user2_id)
+        expired = await db.run(expire_conversations)
+        await notify_conversations_expired(expired)
         
         return SuccessResponse(
             success=True,
-            message=f"Đã cleanup {cleaned_count} conversation hết countdown"
+            message=f"Đã cleanup {len(expired)} conversation hết countdown"
         )
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi khi cleanup: {str(e)}")
 
+@app.get("/api/admin/metrics", response_model=SuccessResponse)
+async def get_metrics(current_user: User = Depends(get_admin_user)):
+    """Số liệu cache, password hasher và thread pool database của worker này (cho admin)"""
+    return SuccessResponse(
+        success=True,
+        message="Metrics",
+        data={
+            "principal_cache": principal_cache.get_stats(),
+            "password_hasher": password_hasher.get_stats(),
+            "database": get_db_stats()
+        }
+    )
+
+@app.get("/api/admin/jobs", response_model=SuccessResponse)
+async def get_background_jobs(current_user: User = Depends(get_admin_user)):
+    """Trạng thái các background job của worker này (cho admin)"""
+    return SuccessResponse(
+        success=True,
+        message="Trạng thái background jobs",
+        data=job_runner.get_stats()
+    )
+
+@app.get("/api/admin/export")
+async def export_messages_admin(
+    conversation_id: Optional[List[int]] = Query(None),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: User = Depends(get_admin_user)
+):
+    """Export tin nhắn của nhiều conversation theo khoảng thời gian (cho admin, phục vụ compliance)"""
+    return StreamingResponse(
+        iter_messages_ndjson(conversation_id, since, until, chunk_size=settings.EXPORT_CHUNK_SIZE),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="messages-export.ndjson"'}
+    )
+
 if __name__ == "__main__":
     import uvicorn
     import os
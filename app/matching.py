@@ -1,30 +1,46 @@
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 from app.models import User, Conversation
-from typing import List, Optional
+from app import clock
+from app.database import DBSession
+from app.conversation_store import conversation_store
+from app.presence import presence
+from app.log import get_logger
+from typing import List, Optional, Set, Tuple
+from datetime import datetime
 import random
-from datetime import datetime, timedelta, timezone
+
+logger = get_logger(__name__)
+
+def get_user_conversation(db: Session, conversation_id: int, user_id: int) -> Optional[Conversation]:
+    """Conversation (kể cả đã kết thúc) mà user là một trong 2 người tham gia"""
+    return db.query(Conversation).filter(
+        Conversation.id == conversation_id,
+        (Conversation.user1_id == user_id) | (Conversation.user2_id == user_id)
+    ).first()
 
 class MatchingService:
-    def __init__(self, db: Session):
+    def __init__(self, db: DBSession):
         self.db = db
     
-    def find_match(self, user: User, search_type: str) -> Optional[User]:
+    async def find_match(self, user: User, search_type: str) -> Optional[User]:
         """Tìm người phù hợp để ghép nối"""
         try:
-            # Lấy danh sách người có thể match (không phải chính mình)
-            # Chỉ match với những user đang trong trạng thái "searching"
-            potential_matches = self.db.query(User).filter(
-                User.id != user.id,
-                User.state == "searching"
-            ).all()
+            # Kiểm tra lại xem user hiện tại vẫn đang trong trạng thái searching
+            # (để tránh race condition)
+            if presence.get(user.id) != "searching":
+                return None
             
-            if not potential_matches:
+            # Chỉ match với những user đang searching (lấy từ presence, không quét bảng users)
+            candidate_ids = presence.users_in("searching")
+            candidate_ids.discard(user.id)
+            if not candidate_ids:
                 return None
             
-            # Kiểm tra lại xem user hiện tại vẫn đang trong trạng thái searching
-            # (để tránh race condition)
-            current_user = self.db.query(User).filter(User.id == user.id).first()
-            if not current_user or current_user.state != "searching":
+            potential_matches = await self.db.run(self._load_users, candidate_ids)
+            
+            # Trạng thái có thể đã thay đổi trong lúc chờ database
+            if presence.get(user.id) != "searching":
                 return None
             
             # Ưu tiên ghép nối theo sở thích và mong muốn
@@ -34,34 +50,22 @@ class MatchingService:
             
             for potential_match in potential_matches:
                 try:
-                    # Kiểm tra xem đã có cuộc trò chuyện active nào giữa 2 người này chưa
-                    existing_active_conversation = self.db.query(Conversation).filter(
-                        ((Conversation.user1_id == user.id) & (Conversation.user2_id == potential_match.id)) |
-                        ((Conversation.user1_id == potential_match.id) & (Conversation.user2_id == user.id)),
-                        Conversation.is_active == True
-                    ).first()
-                    
-                    # Bỏ qua nếu đang có conversation active với user này
-                    if existing_active_conversation:
-                        continue
-                    
-                    # Kiểm tra lại trạng thái của potential_match (tránh race condition)
-                    refreshed_match = self.db.query(User).filter(User.id == potential_match.id).first()
-                    if not refreshed_match or refreshed_match.state != "searching":
+                    # Bỏ qua user đã thôi tìm kiếm hoặc đã có conversation active (index trong conversation store)
+                    if presence.get(potential_match.id) != "searching" or conversation_store.find_by_user(potential_match.id):
                         continue
                     
                     # Tính điểm phù hợp
-                    compatibility_score = self._calculate_compatibility(user, refreshed_match)
+                    compatibility_score = self._calculate_compatibility(user, potential_match)
                     
                     if compatibility_score >= 0.8:
-                        best_matches.append((refreshed_match, compatibility_score))
+                        best_matches.append((potential_match, compatibility_score))
                     elif compatibility_score >= 0.5:
-                        good_matches.append((refreshed_match, compatibility_score))
+                        good_matches.append((potential_match, compatibility_score))
                     else:
-                        random_matches.append((refreshed_match, compatibility_score))
+                        random_matches.append((potential_match, compatibility_score))
                         
                 except Exception as e:
-                    print(f"Error processing potential match {potential_match.id}: {e}")
+                    logger.error("match_candidate_failed", candidate_id=potential_match.id, error=str(e))
                     continue
             
             # Sắp xếp theo điểm phù hợp
@@ -79,9 +83,13 @@ class MatchingService:
             return None
             
         except Exception as e:
-            print(f"Error in find_match: {e}")
+            logger.error("find_match_failed", user_id=user.id, error=str(e))
             return None
     
+    @staticmethod
+    def _load_users(db: Session, user_ids: Set[int]) -> List[User]:
+        return db.query(User).filter(User.id.in_(user_ids)).all()
+    
     def _calculate_compatibility(self, user1: User, user2: User) -> float:
         """Tính điểm phù hợp giữa 2 người dùng"""
         score = 0.0
@@ -133,99 +141,117 @@ class MatchingService:
         
         return (goal1, goal2) in compatible_pairs or (goal2, goal1) in compatible_pairs
     
-    def create_conversation(self, user1: User, user2: User, conversation_type: str = "chat") -> Conversation:
+    async def create_conversation(self, user1: User, user2: User, conversation_type: str = "chat") -> Conversation:
         """Tạo cuộc trò chuyện mới giữa 2 người dùng"""
+        # Kiểm tra lại xem cả hai user vẫn đang trong trạng thái searching
+        # (để tránh race condition)
+        if presence.get(user1.id) != "searching" or presence.get(user2.id) != "searching":
+            raise ValueError("Một trong hai user không còn trong trạng thái searching")
+        
+        # Giữ chỗ cả 2 user trước khi chờ database để request /search khác không ghép trùng
+        # (presence tự ghi xuống database theo lô)
+        presence.set_many((user1.id, user2.id), "connected")
+        
         try:
-            # Kiểm tra lại xem cả hai user vẫn đang trong trạng thái searching
-            # (để tránh race condition)
-            user1_refreshed = self.db.query(User).filter(User.id == user1.id).first()
-            user2_refreshed = self.db.query(User).filter(User.id == user2.id).first()
-            
-            if not user1_refreshed or not user2_refreshed:
-                raise ValueError("Không tìm thấy một trong hai user")
-            
-            if user1_refreshed.state != "searching" or user2_refreshed.state != "searching":
-                raise ValueError("Một trong hai user không còn trong trạng thái searching")
-            
-            # Kiểm tra xem đã có conversation active nào giữa 2 user này chưa
-            existing_conversation = self.db.query(Conversation).filter(
-                ((Conversation.user1_id == user1.id) & (Conversation.user2_id == user2.id)) |
-                ((Conversation.user1_id == user2.id) & (Conversation.user2_id == user1.id)),
-                Conversation.is_active == True
+            conversation = await self.db.run(
+                self._insert_conversation, user1.id, user2.id, conversation_type, clock.now()
+            )
+        except Exception:
+            # Trả lại trạng thái searching nếu chưa có thay đổi nào khác (logout, ...)
+            presence.transition(user1.id, "connected", "searching")
+            presence.transition(user2.id, "connected", "searching")
+            raise
+        
+        logger.debug("match_users_connected", user1_id=user1.id, user2_id=user2.id)
+        
+        return conversation
+    
+    @staticmethod
+    def _insert_conversation(db: Session, user1_id: int, user2_id: int, conversation_type: str,
+                             countdown_start_time) -> Conversation:
+        try:
+            # Kiểm tra xem đã có conversation active nào giữa 2 user này chưa. Viết bằng IN
+            # (tương đương vì user1_id != user2_id) để dùng được index (is_active, user1_id/
+            # user2_id); dạng (a AND b) OR (b AND a) chỉ dùng được cột is_active
+            pair = (user1_id, user2_id)
+            existing_conversation = db.query(Conversation).filter(
+                Conversation.is_active == True,
+                Conversation.user1_id.in_(pair),
+                Conversation.user2_id.in_(pair)
             ).first()
             
             if existing_conversation:
                 raise ValueError("Đã có conversation active giữa 2 user này")
             
             conversation = Conversation(
-                user1_id=user1.id,
-                user2_id=user2.id,
+                user1_id=user1_id,
+                user2_id=user2_id,
                 conversation_type=conversation_type,
                 is_active=True,
-                countdown_start_time=datetime.now(timezone.utc)  # Set thời gian bắt đầu countdown
+                countdown_start_time=countdown_start_time  # Set thời gian bắt đầu countdown
             )
             
-            self.db.add(conversation)
-            self.db.commit()
-            self.db.refresh(conversation)
-            
-            # Cập nhật trạng thái của cả 2 user
-            user1_refreshed.state = "connected"
-            user2_refreshed.state = "connected"
-            self.db.commit()
-            
-            print(f"🔄 Updated user states: User1 {user1_refreshed.id} -> connected, User2 {user2_refreshed.id} -> connected")
-            
+            db.add(conversation)
+            db.commit()
+            db.refresh(conversation)
             return conversation
             
         except Exception as e:
-            self.db.rollback()
+            db.rollback()
             raise e
     
-    def end_conversation(self, conversation: Conversation):
-        """Kết thúc cuộc trò chuyện"""
+    async def end_conversation(self, conversation: Conversation):
+        """Kết thúc cuộc trò chuyện (conversation phải được nạp bằng cùng DBSession)"""
         try:
-            conversation.is_active = False
-            self.db.commit()
-            
-            # Cập nhật trạng thái của cả 2 user về waiting
-            user1 = self.db.query(User).filter(User.id == conversation.user1_id).first()
-            user2 = self.db.query(User).filter(User.id == conversation.user2_id).first()
-            
-            if user1:
-                user1.state = "waiting"
-            if user2:
-                user2.state = "waiting"
-            
-            self.db.commit()
-            
+            await self.db.run(self._deactivate, conversation)
         except Exception as e:
-            print(f"Error ending conversation {conversation.id}: {e}")
-            self.db.rollback()
-            # Vẫn cố gắng cập nhật trạng thái user ngay cả khi có lỗi
-            try:
-                user1 = self.db.query(User).filter(User.id == conversation.user1_id).first()
-                user2 = self.db.query(User).filter(User.id == conversation.user2_id).first()
-                
-                if user1:
-                    user1.state = "waiting"
-                if user2:
-                    user2.state = "waiting"
-                
-                self.db.commit()
-            except:
-                pass
+            logger.error("end_conversation_failed", conversation_id=conversation.id, error=str(e))
+        
+        # Cập nhật trạng thái của cả 2 user về waiting (kể cả khi có lỗi)
+        presence.set_many((conversation.user1_id, conversation.user2_id), "waiting")
     
-    def cleanup_inactive_conversations(self):
-        """Dọn dẹp các cuộc trò chuyện không hoạt động (sau 15 phút)"""
-        cutoff_time = datetime.utcnow() - timedelta(minutes=15)
+    @staticmethod
+    def _deactivate(db: Session, conversation: Conversation):
+        try:
+            conversation.is_active = False
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    
+    async def cleanup_inactive_conversations(self, conversation_ids: List[int],
+                                             idle_before: datetime) -> List[Tuple[int, int, int]]:
+        """Kết thúc các conversation không hoạt động (danh sách lấy từ activity tracker).
+        
+        Chỉ kết thúc conversation còn active mà cả 2 đã keep: conversation chưa được
+        cả 2 keep đã tự kết thúc khi hết countdown, còn conversation đã keep thì
+        không có deadline nên chỉ kết thúc khi bỏ trống quá lâu. Dùng một lệnh
+        UPDATE cho cả lô; trạng thái user do caller cập nhật qua presence. Trả về
+        danh sách (id, user1_id, user2_id) đã kết thúc.
         
-        inactive_conversations = self.db.query(Conversation).filter(
-            Conversation.is_active == True,
-            Conversation.last_activity < cutoff_time,
-            Conversation.user1_keep == False,
-            Conversation.user2_keep == False
+        Activity tracker chỉ thấy hoạt động ở worker này nên last_activity trong
+        database (worker khác flush định kỳ) cũng phải cũ hơn idle_before.
+        """
+        if not conversation_ids:
+            return []
+        return await self.db.run(self._deactivate_idle, conversation_ids, idle_before)
+    
+    @staticmethod
+    def _deactivate_idle(db: Session, conversation_ids: List[int],
+                         idle_before: datetime) -> List[Tuple[int, int, int]]:
+        rows = db.execute(
+            update(Conversation)
+            .where(
+                Conversation.id.in_(conversation_ids),
+                Conversation.is_active == True,
+                Conversation.user1_keep == True,
+                Conversation.user2_keep == True,
+                Conversation.last_activity < idle_before
+            )
+            .values(is_active=False)
+            .returning(Conversation.id, Conversation.user1_id, Conversation.user2_id)
+            .execution_options(synchronize_session=False)
         ).all()
         
-        for conversation in inactive_conversations:
-            self.end_conversation(conversation) 
\ No newline at end of file
+        db.commit()
+        return [(row.id, row.user1_id, row.user2_id) for row in rows]
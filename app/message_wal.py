@@ -0,0 +1,149 @@
+import asyncio
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy.orm import Session
+from app.log import get_logger
+from app.models import Message
+
+logger = get_logger(__name__)
+
+# Các field của message được ghi vào log
+WAL_FIELDS = ('id', 'conversation_id', 'sender_id', 'content', 'message_type', 'created_at')
+
+
+class MessageWAL:
+    """Append-only log cho các message đã nhận nhưng chưa commit vào database.
+
+    Mỗi dòng là một message dạng JSON. fsync được gom theo lô (group commit):
+    tất cả append trong cùng một cửa sổ fsync_interval chờ chung một lần fsync.
+    """
+
+    def __init__(self, path: str, fsync_interval: float = 0.005, compact_bytes: int = 1024 * 1024):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_bytes = compact_bytes
+        self._file = open(path, "a", encoding="utf-8")
+        # Message đã ghi vào log nhưng chưa commit vào database (id -> record)
+        self._uncommitted: Dict[int, dict] = {}
+        # Future của lô fsync đang gom, các append mới sẽ chờ future này
+        self._sync_future: Optional[asyncio.Future] = None
+        # Số lô đang fsync trong thread; các lô có thể chồng nhau (lô mới bắt đầu
+        # trong khi fsync của lô trước chưa xong)
+        self._syncs_in_flight = 0
+
+    def read_records(self) -> List[dict]:
+        """Đọc toàn bộ record trong log (bỏ qua dòng ghi dở khi crash)"""
+        records = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning("wal_corrupted_line_skipped", path=self.path)
+        return records
+
+    async def append(self, message: dict):
+        """Ghi message vào log và chờ tới khi dữ liệu đã được fsync xuống đĩa"""
+        record = {field: message[field] for field in WAL_FIELDS}
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._uncommitted[record['id']] = record
+
+        if self._sync_future is None:
+            self._sync_future = asyncio.get_running_loop().create_future()
+            asyncio.create_task(self._sync_batch())
+
+        # shield để một append bị cancel không làm hỏng future chung của cả lô
+        await asyncio.shield(self._sync_future)
+
+    async def _sync_batch(self):
+        """Gom các append trong cửa sổ fsync_interval rồi fsync một lần"""
+        await asyncio.sleep(self.fsync_interval)
+
+        future = self._sync_future
+        self._sync_future = None
+        self._syncs_in_flight += 1
+        try:
+            await asyncio.to_thread(os.fsync, self._file.fileno())
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            self._syncs_in_flight -= 1
+
+    def mark_committed(self, message_ids: Iterable[int]):
+        """Đánh dấu các message đã commit vào database và thu gọn log nếu có thể"""
+        for message_id in message_ids:
+            self._uncommitted.pop(message_id, None)
+
+        # Không đụng vào file khi còn lô nào đang fsync trên file descriptor hiện tại
+        if self._syncs_in_flight or self._sync_future is not None:
+            return
+
+        if not self._uncommitted:
+            self.truncate()
+        elif self._file.tell() > self.compact_bytes:
+            self._compact()
+
+    def truncate(self):
+        """Xóa toàn bộ log sau khi dữ liệu đã an toàn trong database"""
+        self._file.truncate(0)
+        self._file.seek(0)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _compact(self):
+        """Ghi lại log chỉ với các message chưa commit"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as tmp:
+            for record in self._uncommitted.values():
+                tmp.write(json.dumps(record, ensure_ascii=False) + "\n")
+            tmp.flush()
+            os.fsync(tmp.fileno())
+
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        self._file.close()
+
+
+def replay_wal(wal: MessageWAL, db: Session) -> int:
+    """Ghi lại vào database các message còn trong log (khi khởi động) rồi truncate log.
+
+    Message id được sinh trước khi ghi log nên replay là idempotent: message nào
+    đã có trong database sẽ được bỏ qua.
+    """
+    records = wal.read_records()
+    if not records:
+        wal.truncate()
+        return 0
+
+    records_by_id = {record['id']: record for record in records}
+    existing_ids = {
+        row[0] for row in db.query(Message.id).filter(Message.id.in_(list(records_by_id))).all()
+    }
+
+    missing = [record for message_id, record in records_by_id.items() if message_id not in existing_ids]
+    db.add_all([
+        Message(
+            id=record['id'],
+            conversation_id=record['conversation_id'],
+            sender_id=record['sender_id'],
+            content=record['content'],
+            message_type=record['message_type'],
+            created_at=datetime.fromisoformat(record['created_at'])
+        )
+        for record in missing
+    ])
+    db.commit()
+
+    # Chỉ truncate sau khi commit thành công
+    wal.truncate()
+    return len(missing)
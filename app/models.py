@@ -1,9 +1,15 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, ForeignKey, JSON
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, Text, ForeignKey, Index, JSON, LargeBinary
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
+from app import clock
+from app.config import settings
+from app.idgen import message_id_generator
+from app.log import get_logger
 import json
-from datetime import datetime, timezone
+from datetime import timedelta, timezone
+
+logger = get_logger(__name__)
 
 class User(Base):
     __tablename__ = "users"
@@ -17,7 +23,7 @@ class User(Base):
     preference = Column(String)  # Nam, Nữ, Tất cả
     goal = Column(String)  # Mục đích tìm kiếm
     interests = Column(Text)  # JSON string của danh sách sở thích
-    state = Column(String, default="waiting")  # waiting, searching, connected
+    state = Column(String, default="waiting", index=True)  # waiting, searching, connected
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
@@ -36,25 +42,19 @@ class User(Base):
         """Chuyển đổi list interests sang JSON string"""
         self.interests = json.dumps(interests_list)
 
-class Conversation(Base):
-    __tablename__ = "conversations"
+class ConversationStateMixin:
+    """Logic keep/countdown dùng chung cho model Conversation và ConversationState trong bộ nhớ.
     
-    id = Column(Integer, primary_key=True, index=True)
-    user1_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    user2_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    conversation_type = Column(String, default="chat")  # chat, voice
-    user1_keep = Column(Boolean, default=False)
-    user2_keep = Column(Boolean, default=False)
-    last_activity = Column(DateTime(timezone=True), server_default=func.now())
-    voice_unlocked = Column(Boolean, default=False)
-    is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
-    countdown_start_time = Column(DateTime(timezone=True), server_default=func.now())  # Thời gian bắt đầu countdown
+    Chỉ cần các attribute id, user1_id, user2_id, user1_keep, user2_keep, countdown_start_time.
+    """
     
-    # Relationships - fixed to avoid ambiguous foreign keys
-    user1 = relationship("User", foreign_keys=[user1_id], back_populates="conversations_as_user1")
-    user2 = relationship("User", foreign_keys=[user2_id], back_populates="conversations_as_user2")
-    messages = relationship("Message", back_populates="conversation")
+    def has_user(self, user_id):
+        """User có phải là một trong 2 người của conversation không"""
+        return user_id == self.user1_id or user_id == self.user2_id
+    
+    def get_other_user_id(self, user_id):
+        """Lấy id của người còn lại trong conversation"""
+        return self.user2_id if user_id == self.user1_id else self.user1_id
     
     def get_keep_status(self, user_id):
         """Lấy trạng thái keep của user"""
@@ -75,10 +75,29 @@ class Conversation(Base):
         """Kiểm tra xem cả hai user đã keep chưa"""
         return self.user1_keep and self.user2_keep
     
+    def get_countdown_deadline(self):
+        """Thời điểm countdown kết thúc (UTC)"""
+        if not self.countdown_start_time:
+            return clock.now() + timedelta(seconds=settings.COUNTDOWN_DURATION)
+        
+        start_time = self.countdown_start_time
+        if start_time.tzinfo is None:
+            start_time = start_time.replace(tzinfo=timezone.utc)
+        return start_time + timedelta(seconds=settings.COUNTDOWN_DURATION)
+    
+    def get_countdown_state(self):
+        """Thông tin countdown gửi cho client, client tự đếm ngược từ deadline"""
+        return {
+            "deadline": self.get_countdown_deadline().isoformat(),
+            "duration": settings.COUNTDOWN_DURATION,
+            "both_kept": bool(self.both_kept()),
+            "server_time": clock.now().isoformat()
+        }
+    
     def get_countdown_time_left(self):
-        """Tính toán thời gian còn lại của countdown (5 phút = 300 giây)"""
+        """Tính toán thời gian còn lại của countdown (mặc định 5 phút = 300 giây)"""
         if not self.countdown_start_time:
-            return 300  # 5 phút mặc định
+            return settings.COUNTDOWN_DURATION
         
         # Đảm bảo sử dụng UTC timezone
         if self.countdown_start_time.tzinfo is None:
@@ -87,16 +106,12 @@ class Conversation(Base):
         else:
             start_time = self.countdown_start_time
         
-        now = datetime.now(timezone.utc)
+        now = clock.now()
         elapsed = (now - start_time).total_seconds()
-        time_left = 300 - elapsed  # 300 giây = 5 phút
+        time_left = settings.COUNTDOWN_DURATION - elapsed
         
-        # Debug log
-        print(f"🔍 Countdown calculation for conversation {self.id}:")
-        print(f"   Start time: {start_time}")
-        print(f"   Now: {now}")
-        print(f"   Elapsed: {elapsed:.2f}s")
-        print(f"   Time left: {time_left:.2f}s")
+        logger.debug("countdown_calculated", conversation_id=self.id, start_time=start_time,
+                     elapsed=round(elapsed, 2), time_left=round(time_left, 2))
         
         return max(0, int(time_left))
     
@@ -105,17 +120,46 @@ class Conversation(Base):
         time_left = self.get_countdown_time_left()
         expired = time_left <= 0
         
-        # Debug log
-        print(f"🔍 Countdown expired check for conversation {self.id}:")
-        print(f"   Time left: {time_left}s")
-        print(f"   Expired: {expired}")
+        logger.debug("countdown_expiry_checked", conversation_id=self.id, time_left=time_left, expired=expired)
         
         return expired
 
+class Conversation(ConversationStateMixin, Base):
+    __tablename__ = "conversations"
+    # Index do migration 0002_hot_indexes tạo, khai báo ở đây để metadata khớp với database
+    __table_args__ = (
+        Index("ix_conversations_active_user1", "is_active", "user1_id"),
+        Index("ix_conversations_active_user2", "is_active", "user2_id"),
+        Index("ix_conversations_active_countdown", "is_active", "countdown_start_time"),
+        Index("ix_conversations_active_last_activity", "is_active", "last_activity"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user1_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user2_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    conversation_type = Column(String, default="chat")  # chat, voice
+    user1_keep = Column(Boolean, default=False)
+    user2_keep = Column(Boolean, default=False)
+    last_activity = Column(DateTime(timezone=True), server_default=func.now())
+    voice_unlocked = Column(Boolean, default=False)
+    is_active = Column(Boolean, default=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    countdown_start_time = Column(DateTime(timezone=True), server_default=func.now())  # Thời gian bắt đầu countdown
+    
+    # Relationships - fixed to avoid ambiguous foreign keys
+    user1 = relationship("User", foreign_keys=[user1_id], back_populates="conversations_as_user1")
+    user2 = relationship("User", foreign_keys=[user2_id], back_populates="conversations_as_user2")
+    messages = relationship("Message", back_populates="conversation")
+
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_conversation_created", "conversation_id", "created_at"),
+    )
     
-    id = Column(Integer, primary_key=True, index=True)
+    # Snowflake id sinh trong process (xem app/idgen.py), SQLite vẫn dùng INTEGER rowid
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, index=True,
+                default=message_id_generator.next_id)
     conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False)
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     content = Column(Text, nullable=False)
@@ -124,4 +168,16 @@ class Message(Base):
     
     # Relationships
     conversation = relationship("Conversation", back_populates="messages")
-    sender = relationship("User", back_populates="messages") 
\ No newline at end of file
+    sender = relationship("User", back_populates="messages")
+
+class MessageArchive(Base):
+    """Tin nhắn của conversation đã kết thúc, nén gzip thành một segment mỗi conversation"""
+    __tablename__ = "message_archives"
+    
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), primary_key=True)
+    message_count = Column(Integer, nullable=False)
+    first_message_at = Column(DateTime(timezone=True))
+    last_message_at = Column(DateTime(timezone=True))
+    codec = Column(String, default="gzip")
+    payload = Column(LargeBinary, nullable=False)  # JSON list các message đã nén
+    archived_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -0,0 +1,137 @@
+from typing import Dict, Iterable, List, Set
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from app.log import get_logger
+from app.models import User
+
+logger = get_logger(__name__)
+
+USER_STATES = ("waiting", "searching", "connected")
+
+
+class PresenceService:
+    """Trạng thái user (waiting / searching / connected) trong bộ nhớ.
+
+    Mọi chuyển trạng thái (/search, /cancel-search, /logout, tạo match, kết thúc
+    conversation) chỉ sửa dict này, không commit trên đường request. Cột
+    users.state chỉ là bản lưu để thống kê: flush() định kỳ ghi các thay đổi
+    bằng một lệnh UPDATE hàng loạt. Khi khởi động, rebuild() dựng lại trạng
+    thái từ conversation đang active thay vì tin các row cũ; user đang tìm kiếm
+    sẽ gửi lại /search khi WebSocket reconnect.
+    """
+
+    def __init__(self):
+        # user_id -> state, user không có trong dict là "waiting"
+        self._states: Dict[int, str] = {}
+        # state -> tập user, để đếm và lấy ứng viên ghép nối trong O(1)
+        self._members: Dict[str, Set[int]] = {state: set() for state in USER_STATES}
+        # Các user có state chưa ghi xuống database
+        self._dirty: Set[int] = set()
+
+    def get(self, user_id: int) -> str:
+        return self._states.get(user_id, "waiting")
+
+    def set(self, user_id: int, state: str):
+        if state not in self._members:
+            raise ValueError(f"Trạng thái không hợp lệ: {state}")
+
+        previous = self._states.get(user_id)
+        if previous == state:
+            return
+        if previous is not None:
+            self._members[previous].discard(user_id)
+
+        self._states[user_id] = state
+        self._members[state].add(user_id)
+        self._dirty.add(user_id)
+
+    def set_many(self, user_ids: Iterable[int], state: str):
+        for user_id in user_ids:
+            self.set(user_id, state)
+
+    def transition(self, user_id: int, expected: str, state: str) -> bool:
+        """Đổi sang state chỉ khi user đang ở trạng thái expected"""
+        if self.get(user_id) != expected:
+            return False
+        self.set(user_id, state)
+        return True
+
+    def count(self, state: str) -> int:
+        return len(self._members[state])
+
+    def get_counts(self) -> Dict[str, int]:
+        return {state: len(members) for state, members in self._members.items()}
+
+    def users_in(self, state: str) -> Set[int]:
+        """Bản sao tập user đang ở trạng thái state"""
+        return set(self._members[state])
+
+    def rebuild(self, db: Session, connected_user_ids: Iterable[int]) -> int:
+        """Dựng lại trạng thái khi khởi động: user trong conversation active là
+        connected, còn lại là waiting. Ghi đè luôn các row users.state cũ.
+        """
+        self._states.clear()
+        for members in self._members.values():
+            members.clear()
+        self._dirty.clear()
+
+        for user_id in connected_user_ids:
+            self.set(user_id, "connected")
+
+        try:
+            # Row searching/connected còn sót từ lần chạy trước không còn đúng
+            db.execute(
+                update(User)
+                .where(User.state.in_(("searching", "connected")))
+                .values(state="waiting")
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        self._write(db, self._take_dirty())
+        return len(self._states)
+
+    def _take_dirty(self) -> List[dict]:
+        dirty = self._dirty
+        self._dirty = set()
+        return [{"id": user_id, "state": self.get(user_id)} for user_id in dirty]
+
+    @staticmethod
+    def _write(db: Session, params: List[dict]):
+        if not params:
+            return
+        try:
+            db.execute(update(User), params)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    async def flush(self) -> int:
+        """Ghi các state đã thay đổi bằng một lệnh UPDATE (executemany theo id).
+
+        Danh sách cần ghi được chốt ở event loop, chỉ lệnh UPDATE chạy trong
+        thread database.
+        """
+        from app.database import run_db
+
+        params = self._take_dirty()
+        if not params:
+            return 0
+
+        try:
+            await run_db(self._write, params)
+        except Exception:
+            # Giữ lại để ghi ở lần flush sau
+            self._dirty |= {row["id"] for row in params}
+            raise
+
+        logger.debug("presence_flushed", users=len(params))
+        return len(params)
+
+
+# Global presence instance
+presence = PresenceService()
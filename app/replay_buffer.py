@@ -0,0 +1,40 @@
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+
+class ConversationReplayBuffer:
+    """Lưu các event gần nhất của một conversation kèm sequence number tăng dần"""
+
+    def __init__(self, max_events: int):
+        # Sequence number của event gần nhất đã phát trong conversation
+        self.seq = 0
+        # (seq, message, exclude_user_id) - deque tự đẩy event cũ ra khi đầy
+        self.events: Deque[Tuple[int, dict, Optional[int]]] = deque(maxlen=max_events)
+
+    def append(self, message: dict, exclude_user_id: Optional[int] = None) -> dict:
+        """Gán seq cho event và lưu vào buffer, trả về message đã có seq"""
+        self.seq += 1
+        sequenced = {**message, "seq": self.seq}
+        self.events.append((self.seq, sequenced, exclude_user_id))
+        return sequenced
+
+    def events_after(self, last_seq: int, user_id: int) -> Optional[List[dict]]:
+        """Lấy các event user chưa nhận (seq > last_seq).
+
+        Trả về None nếu khoảng trống đã bị đẩy ra khỏi buffer, hoặc last_seq lớn
+        hơn seq hiện tại (seq của buffer trước khi server khởi động lại), khi đó
+        client phải tải lại lịch sử qua HTTP và lấy lại seq.
+        """
+        if last_seq > self.seq:
+            return None
+        if last_seq == self.seq:
+            return []
+
+        oldest_seq = self.events[0][0] if self.events else self.seq + 1
+        if oldest_seq > last_seq + 1:
+            return None
+
+        return [
+            message for seq, message, exclude_user_id in self.events
+            if seq > last_seq and exclude_user_id != user_id
+        ]
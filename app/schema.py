@@ -0,0 +1,82 @@
+import os
+from contextlib import contextmanager
+from typing import Optional
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from app.config import settings
+from app.log import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock, chạy một process nên không cần lock
+    fcntl = None
+
+logger = get_logger(__name__)
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic.ini")
+# Revision ứng với schema do Base.metadata.create_all tạo trước khi có migration
+BASELINE_REVISION = "0001"
+
+
+def alembic_config(connection: Optional[Connection] = None) -> Config:
+    config = Config(ALEMBIC_INI)
+    if connection is not None:
+        config.attributes["connection"] = connection
+    return config
+
+
+@contextmanager
+def _migration_lock(connection: Connection):
+    """Chỉ một process chạy migration tại một thời điểm (nhiều worker khởi động cùng lúc)"""
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": settings.DB_MIGRATION_LOCK_KEY})
+        connection.commit()  # lock gắn với session, không cần giữ transaction
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": settings.DB_MIGRATION_LOCK_KEY})
+            connection.commit()
+        return
+
+    database = connection.engine.url.database
+    if fcntl is None or connection.dialect.name != "sqlite" or database in (None, "", ":memory:"):
+        yield
+        return
+
+    # Khác leader lock của job: chờ (blocking) tới khi process kia migrate xong
+    with open(f"{database}.migrate.lock", "a+") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def upgrade_database(engine: Optional[Engine] = None) -> Optional[str]:
+    """Đưa schema lên revision mới nhất (như `alembic upgrade head`), trả về revision hiện tại.
+
+    Database tạo bằng create_all trước khi có migration (có bảng nhưng chưa có
+    alembic_version) được stamp BASELINE_REVISION rồi mới upgrade. Chạy lại khi
+    đã ở head thì không làm gì.
+    """
+    if engine is None:
+        from app.database import engine
+
+    with engine.connect() as connection, _migration_lock(connection):
+        tables = set(inspect(connection).get_table_names())
+        # alembic tự quản lý transaction, connection phải sạch khi giao cho nó
+        connection.commit()
+
+        config = alembic_config(connection)
+        if "alembic_version" not in tables and "users" in tables:
+            logger.info("schema_baseline_stamped", revision=BASELINE_REVISION)
+            command.stamp(config, BASELINE_REVISION)
+        command.upgrade(config, "head")
+
+        revision = connection.execute(text("SELECT version_num FROM alembic_version")).scalar()
+        connection.commit()
+
+    logger.info("schema_upgraded", revision=revision)
+    return revision
@@ -0,0 +1,62 @@
+import json
+from datetime import datetime
+from typing import Any, Iterable, List, Optional
+from starlette.responses import Response
+from app.models import Message
+from app.schemas import MessageResponse
+
+try:
+    import orjson
+except ImportError:  # orjson là tùy chọn, không có thì dùng json chuẩn (chậm hơn, cùng output)
+    orjson = None
+
+# Cột đọc thẳng từ bảng messages, đúng thứ tự field của MessageResponse
+MESSAGE_FIELDS = tuple(MessageResponse.model_fields)
+MESSAGE_COLUMNS = tuple(getattr(Message, field) for field in MESSAGE_FIELDS)
+
+
+def _default(value):
+    # Giống pydantic (response_model): datetime dạng ISO 8601, UTC viết là Z
+    if isinstance(value, datetime):
+        text = value.isoformat()
+        return text[:-6] + "Z" if text.endswith("+00:00") else text
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """Encode JSON giống hệt output mặc định của FastAPI (compact, UTF-8)"""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_UTC_Z)
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default
+    ).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    """JSONResponse cho endpoint nóng: không qua jsonable_encoder/response_model"""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def success_response(message: str, data: Optional[dict] = None) -> FastJSONResponse:
+    """Cùng byte với SuccessResponse(success=True, message=..., data=...)"""
+    return FastJSONResponse({"success": True, "message": message, "data": data})
+
+
+def message_rows(rows: Iterable[tuple]) -> List[dict]:
+    """Row lấy theo MESSAGE_COLUMNS -> dict cùng thứ tự field với MessageResponse"""
+    return [dict(zip(MESSAGE_FIELDS, row)) for row in rows]
+
+
+def archived_message_rows(messages: Iterable[dict]) -> List[dict]:
+    """Tin nhắn từ archive (created_at là chuỗi isoformat) theo thứ tự field của MessageResponse"""
+    rows = []
+    for message in messages:
+        row = {field: message.get(field) for field in MESSAGE_FIELDS}
+        if row["created_at"]:
+            row["created_at"] = _default(datetime.fromisoformat(row["created_at"]))
+        rows.append(row)
+    return rows
@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from typing import Dict, Optional
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+try:
+    import brotli
+except ImportError:  # brotli là tùy chọn, không có thì chỉ phục vụ gzip
+    brotli = None
+
+# Chỉ nén các loại nội dung dạng text
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+SHELL_CACHE_CONTROL = "no-cache"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_ASSET_URL_RE = re.compile(r'(href|src)="/static/([^"?#]+)"')
+
+
+class StaticAsset:
+    """Nội dung file trong bộ nhớ kèm bản nén gzip/brotli dựng sẵn và ETag mạnh.
+
+    Response tự thêm charset=utf-8 cho media type text/.
+    """
+
+    def __init__(self, content: bytes, media_type: str):
+        self.media_type = media_type
+        self.digest = hashlib.sha256(content).hexdigest()
+        # encoding -> (nội dung, etag); ETag khác nhau cho mỗi encoding
+        self.variants: Dict[str, tuple] = {"identity": (content, f'"{self.digest[:32]}"')}
+
+        if media_type.startswith(COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(compressed) < len(content):
+                self.variants["gzip"] = (compressed, f'"{self.digest[:32]}-gz"')
+            if brotli is not None:
+                compressed = brotli.compress(content)
+                if len(compressed) < len(content):
+                    self.variants["br"] = (compressed, f'"{self.digest[:32]}-br"')
+
+    def _choose_encoding(self, accept_encoding: str) -> str:
+        accepted = {token.split(";")[0].strip() for token in accept_encoding.lower().split(",")}
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and encoding in accepted:
+                return encoding
+        return "identity"
+
+    def response(self, request_headers: Headers, cache_control: str) -> Response:
+        """Response cho request, trả về 304 nếu If-None-Match khớp ETag"""
+        encoding = self._choose_encoding(request_headers.get("accept-encoding", ""))
+        body, etag = self.variants[encoding]
+
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+        if len(self.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match:
+            tags = {tag.strip() for tag in if_none_match.split(",")}
+            if "*" in tags or etag in tags:
+                return Response(status_code=304, headers=headers)
+
+        return Response(content=body, media_type=self.media_type, headers=headers)
+
+
+class StaticBundle:
+    """Nạp thư mục static một lần khi khởi động.
+
+    Mỗi file được phục vụ thêm dưới tên có hash nội dung (app.js ->
+    app.<hash>.js) để cache vĩnh viễn; HTML shell (index.html) được dựng sẵn
+    với URL đã hash, dùng chung cho / và /chat/{id} (app.js tự đọc conversation
+    id từ URL).
+    """
+
+    def __init__(self, directory: str, shell_name: str = "index.html"):
+        self.directory = directory
+        # tên gốc -> tên có hash, tên có hash -> asset
+        self._hashed_names: Dict[str, str] = {}
+        self._assets: Dict[str, StaticAsset] = {}
+
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                path = os.path.relpath(os.path.join(root, filename), directory).replace(os.sep, "/")
+                if path == shell_name:
+                    continue
+                with open(os.path.join(root, filename), "rb") as f:
+                    asset = StaticAsset(f.read(), mimetypes.guess_type(path)[0] or "application/octet-stream")
+                stem, extension = os.path.splitext(path)
+                hashed_name = f"{stem}.{asset.digest[:12]}{extension}"
+                self._hashed_names[path] = hashed_name
+                self._assets[hashed_name] = asset
+
+        with open(os.path.join(directory, shell_name), "r", encoding="utf-8") as f:
+            html = _ASSET_URL_RE.sub(self._rewrite_url, f.read())
+        self.shell = StaticAsset(html.encode("utf-8"), "text/html")
+
+    def _rewrite_url(self, match: re.Match) -> str:
+        return f'{match.group(1)}="/static/{self.hashed_name(match.group(2))}"'
+
+    def hashed_name(self, path: str) -> str:
+        return self._hashed_names.get(path, path)
+
+    def get_hashed(self, hashed_name: str) -> Optional[StaticAsset]:
+        return self._assets.get(hashed_name)
+
+
+class HashedStaticFiles(StaticFiles):
+    """StaticFiles phục vụ tên có hash từ bộ nhớ (cache immutable), tên gốc như cũ"""
+
+    def __init__(self, bundle: StaticBundle, **kwargs):
+        super().__init__(directory=bundle.directory, **kwargs)
+        self.bundle = bundle
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        asset = self.bundle.get_hashed(path.replace(os.sep, "/"))
+        if asset is not None and scope["method"] in ("GET", "HEAD"):
+            return asset.response(Headers(scope=scope), IMMUTABLE_CACHE_CONTROL)
+        return await super().get_response(path, scope)
@@ -0,0 +1,72 @@
+import base64
+import hashlib
+import hmac
+from typing import Dict, Optional, Tuple
+from app import clock
+from app.auth import SECRET_KEY
+from app.config import settings
+
+
+class TicketVerifier:
+    """Vé kết nối WebSocket ngắn hạn, ký bằng HMAC-SHA256: "<user_id>.<expires_ms>.<chữ ký>".
+
+    Vé được cấp qua REST (đã xác thực JWT) nên lúc handshake chỉ cần kiểm tra
+    chữ ký và hạn dùng, không query database. HMAC đã nạp sẵn key được giữ lại
+    và copy() cho mỗi lần ký/kiểm tra. Thu hồi (logout) dùng denylist trong bộ
+    nhớ: vé của user cấp trước thời điểm thu hồi bị từ chối; entry tự hết hạn
+    sau ttl vì lúc đó mọi vé cũ đều đã hết hạn.
+    """
+
+    def __init__(self, secret: str, ttl: int = 60):
+        self.ttl = ttl
+        self._ttl_ms = ttl * 1000
+        self._mac = hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+        # user_id -> thời điểm thu hồi (ms)
+        self._revoked: Dict[int, int] = {}
+
+    def _sign(self, payload: str) -> str:
+        mac = self._mac.copy()
+        mac.update(payload.encode("ascii"))
+        return base64.urlsafe_b64encode(mac.digest()[:18]).decode("ascii")
+
+    @staticmethod
+    def _now_ms() -> int:
+        return int(clock.time() * 1000)
+
+    def issue(self, user_id: int) -> Tuple[str, int]:
+        """Cấp vé cho user, trả về (vé, thời điểm hết hạn tính bằng ms)"""
+        expires = self._now_ms() + self._ttl_ms
+        payload = f"{user_id}.{expires}"
+        return f"{payload}.{self._sign(payload)}", expires
+
+    def verify(self, ticket: str) -> Optional[int]:
+        """Trả về user_id nếu vé hợp lệ, chưa hết hạn và chưa bị thu hồi"""
+        try:
+            user_id, expires, signature = ticket.split(".")
+            user_id, expires = int(user_id), int(expires)
+        except (AttributeError, ValueError):
+            return None
+
+        expected = self._sign(f"{user_id}.{expires}")
+        if not hmac.compare_digest(signature.encode("utf-8"), expected.encode("ascii")):
+            return None
+        if expires <= self._now_ms():
+            return None
+
+        revoked_at = self._revoked.get(user_id)
+        if revoked_at is not None and expires - self._ttl_ms <= revoked_at:
+            return None
+        return user_id
+
+    def revoke_user(self, user_id: int):
+        """Thu hồi mọi vé đã cấp cho user (khi đăng xuất)"""
+        now = self._now_ms()
+        self._revoked[user_id] = now
+        # Bỏ các entry đã quá ttl, vé cấp trước đó đều đã hết hạn
+        cutoff = now - self._ttl_ms
+        for revoked_user_id in [uid for uid, revoked_at in self._revoked.items() if revoked_at < cutoff]:
+            del self._revoked[revoked_user_id]
+
+
+# Global ticket verifier instance
+ticket_verifier = TicketVerifier(SECRET_KEY, settings.WS_TICKET_TTL)
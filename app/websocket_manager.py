@@ -1,12 +1,24 @@
 from fastapi import WebSocket, WebSocketDisconnect
-from typing import Dict, List, Set
+from typing import Dict, List, Optional, Set
 import json
 import asyncio
-from datetime import datetime, timezone
-from app.models import User, Conversation, Message
+from datetime import datetime
+from app import clock
+from app.models import ConversationStateMixin, Message
+from app.config import settings
+from app.log import get_logger
+from app.replay_buffer import ConversationReplayBuffer
+from app.idgen import ClockMovedBackwards, message_id_generator
+from app.expiry import expiry_scheduler
+from app.activity import activity_tracker
+from app.conversation_store import ConversationState, conversation_store
+from app.presence import presence
+from app.database import DBSession
+from app.matching import MatchingService, get_user_conversation
 from sqlalchemy.orm import Session
 from collections import defaultdict
-import time
+
+logger = get_logger(__name__)
 
 class ConnectionManager:
     def __init__(self):
@@ -16,26 +28,28 @@ class ConnectionManager:
         self.conversation_connections: Dict[int, Set[int]] = {}
         # Lưu trữ typing status
         self.typing_status: Dict[int, Dict[int, bool]] = {}  # conversation_id -> {user_id: is_typing}
-        # Cache cho conversation info để tránh query database liên tục
-        self.conversation_cache: Dict[int, dict] = {}
+        # Replay buffer theo conversation_id để gửi lại event bị lỡ khi reconnect
+        self.replay_buffers: Dict[int, ConversationReplayBuffer] = {}
         # Message queue để batch processing
         self.message_queue: List[dict] = []
         self.processing_queue = False
-        # Connection pool cho database
-        self.db_pool = []
-        self.max_db_connections = 10
+        self.processing_scheduled = False
+        # Write-ahead log tùy chọn cho message_queue (bật trong startup nếu có MESSAGE_WAL_PATH)
+        self.wal = None
+        # Số người đang tìm kiếm đã gửi lần gần nhất, chỉ gửi lại khi thay đổi
+        self.last_searching_count: Optional[int] = None
     
     async def connect(self, websocket: WebSocket, user_id: int):
         """Kết nối WebSocket cho user"""
         await websocket.accept()
         self.active_connections[user_id] = websocket
-        print(f"✅ User {user_id} connected. Total connections: {len(self.active_connections)}")
+        logger.info("user_connected", user_id=user_id, connections=len(self.active_connections))
     
     def disconnect(self, user_id: int):
         """Ngắt kết nối WebSocket cho user"""
         if user_id in self.active_connections:
             del self.active_connections[user_id]
-            print(f"❌ User {user_id} disconnected. Total connections: {len(self.active_connections)}")
+            logger.info("user_disconnected", user_id=user_id, connections=len(self.active_connections))
         
         # Xóa khỏi tất cả conversation connections
         for conversation_id in list(self.conversation_connections.keys()):
@@ -43,9 +57,6 @@ class ConnectionManager:
                 self.conversation_connections[conversation_id].remove(user_id)
                 if not self.conversation_connections[conversation_id]:
                     del self.conversation_connections[conversation_id]
-                    # Xóa cache khi conversation không còn user nào
-                    if conversation_id in self.conversation_cache:
-                        del self.conversation_cache[conversation_id]
         
         # Xóa typing status
         for conversation_id in list(self.typing_status.keys()):
@@ -61,16 +72,21 @@ class ConnectionManager:
                 await self.active_connections[user_id].send_text(json.dumps(message))
                 return True
             except Exception as e:
-                print(f"❌ Failed to send message to user {user_id}: {e}")
+                logger.warning("send_message_failed", user_id=user_id, error=str(e), every=1.0)
                 # Nếu gửi thất bại, xóa connection
                 self.disconnect(user_id)
                 return False
         else:
-            print(f"⚠️ User {user_id} not connected")
+            logger.debug("user_not_connected", user_id=user_id)
             return False
     
-    async def send_to_conversation(self, message: dict, conversation_id: int, exclude_user_id: int = None):
+    async def send_to_conversation(self, message: dict, conversation_id: int, exclude_user_id: int = None,
+                                   replayable: bool = True):
         """Gửi tin nhắn cho tất cả user trong một conversation với parallel processing"""
+        if replayable:
+            # Gán seq và lưu vào replay buffer để user đang mất kết nối nhận lại sau
+            message = self.record_event(message, conversation_id, exclude_user_id)
+        
         if conversation_id in self.conversation_connections:
             users_in_conversation = self.conversation_connections[conversation_id]
             
@@ -85,16 +101,70 @@ class ConnectionManager:
             results = await asyncio.gather(*tasks, return_exceptions=True)
             
             success_count = sum(1 for result in results if result is True)
-            print(f"📤 Message sent to {success_count}/{len(target_users)} users in conversation {conversation_id}")
+            logger.debug("conversation_broadcast", conversation_id=conversation_id, sent=success_count, targets=len(target_users))
         else:
-            print(f"❌ No users found in conversation {conversation_id}")
+            logger.debug("conversation_broadcast_no_users", conversation_id=conversation_id)
+    
+    def record_event(self, message: dict, conversation_id: int, exclude_user_id: int = None) -> dict:
+        """Gán sequence number cho event và lưu vào replay buffer của conversation"""
+        buffer = self.replay_buffers.get(conversation_id)
+        if buffer is None:
+            buffer = ConversationReplayBuffer(settings.REPLAY_BUFFER_SIZE)
+            self.replay_buffers[conversation_id] = buffer
+        return buffer.append(message, exclude_user_id)
+    
+    def get_conversation_seq(self, conversation_id: int) -> int:
+        """Lấy sequence number hiện tại của conversation"""
+        buffer = self.replay_buffers.get(conversation_id)
+        return buffer.seq if buffer else 0
+    
+    def drop_replay_buffer(self, conversation_id: int):
+        """Xóa replay buffer khi conversation kết thúc"""
+        self.replay_buffers.pop(conversation_id, None)
+    
+    async def replay_events(self, user_id: int, conversation_id: int, last_seq: int):
+        """Gửi lại các event user đã bỏ lỡ kể từ last_seq rồi mới thêm socket vào conversation.
+
+        Client bỏ event có seq <= seq lớn nhất đã nhận, nên broadcast mới không được
+        tới trước các event đang replay: gửi lặp tới khi buffer không còn event sau
+        seq đã gửi, rồi add_to_conversation ngay (không có await ở giữa).
+        """
+        sent = 0
+        while True:
+            buffer = self.replay_buffers.get(conversation_id)
+            missed = buffer.events_after(last_seq, user_id) if buffer else None
+            
+            if missed is None:
+                # Khoảng trống quá cũ hoặc không còn buffer, client phải tải lại lịch sử
+                self.add_to_conversation(conversation_id, user_id)
+                await self.send_personal_message({
+                    "type": "resync_required",
+                    "data": {
+                        "conversation_id": conversation_id,
+                        "seq": self.get_conversation_seq(conversation_id)
+                    }
+                }, user_id)
+                logger.info("replay_resync_required", user_id=user_id, conversation_id=conversation_id, last_seq=last_seq)
+                return
+            
+            if not missed:
+                break
+            
+            for message in missed:
+                if not await self.send_personal_message(message, user_id):
+                    return
+            sent += len(missed)
+            last_seq = missed[-1]["seq"]
+        
+        self.add_to_conversation(conversation_id, user_id)
+        logger.info("replay_sent", user_id=user_id, conversation_id=conversation_id, last_seq=last_seq, events=sent)
     
     def add_to_conversation(self, conversation_id: int, user_id: int):
         """Thêm user vào conversation"""
         if conversation_id not in self.conversation_connections:
             self.conversation_connections[conversation_id] = set()
         self.conversation_connections[conversation_id].add(user_id)
-        print(f"✅ Added user {user_id} to conversation {conversation_id}. Total users: {len(self.conversation_connections[conversation_id])}")
+        logger.debug("conversation_member_added", user_id=user_id, conversation_id=conversation_id, members=len(self.conversation_connections[conversation_id]))
     
     def remove_from_conversation(self, conversation_id: int, user_id: int):
         """Xóa user khỏi conversation"""
@@ -102,9 +172,6 @@ class ConnectionManager:
             self.conversation_connections[conversation_id].discard(user_id)
             if not self.conversation_connections[conversation_id]:
                 del self.conversation_connections[conversation_id]
-                # Xóa cache
-                if conversation_id in self.conversation_cache:
-                    del self.conversation_cache[conversation_id]
     
     def set_typing_status(self, conversation_id: int, user_id: int, is_typing: bool):
         """Set trạng thái typing của user trong conversation"""
@@ -116,44 +183,55 @@ class ConnectionManager:
         """Lấy trạng thái typing của tất cả user trong conversation"""
         return self.typing_status.get(conversation_id, {})
     
-    async def broadcast_countdown_update(self, conversation_id: int):
-        """Broadcast countdown update cho tất cả user trong conversation"""
+    async def broadcast_countdown_update(self, conversation_id: int, conversation: ConversationStateMixin = None,
+                                         reason: str = None):
+        """Broadcast trạng thái countdown khi có thay đổi (keep, cả 2 keep, hết giờ)"""
         try:
-            # Lấy thông tin countdown từ database
-            from app.database import SessionLocal
-            db = SessionLocal()
-            try:
-                conversation = db.query(Conversation).filter(
-                    Conversation.id == conversation_id,
-                    Conversation.is_active == True
-                ).first()
-                
-                if conversation:
-                    countdown_time_left = conversation.get_countdown_time_left()
-                    countdown_expired = conversation.is_countdown_expired()
-                    both_kept = conversation.both_kept()
-                    
-                    countdown_message = {
-                        "type": "countdown_update",
-                        "conversation_id": conversation_id,
-                        "data": {
-                            "time_left": countdown_time_left,
-                            "expired": countdown_expired,
-                            "both_kept": both_kept,
-                            "start_time": conversation.countdown_start_time.isoformat() if conversation.countdown_start_time else None
-                        }
-                    }
-                    
-                    # Broadcast cho tất cả user trong conversation
-                    await self.send_to_conversation(countdown_message, conversation_id)
-                    
-                    print(f"🔄 Countdown update broadcasted for conversation {conversation_id}: {countdown_time_left}s left")
-                    
-            finally:
-                db.close()
+            if conversation is None:
+                conversation = await conversation_store.get(conversation_id)
+            
+            if not conversation:
+                return
+            
+            countdown_time_left = conversation.get_countdown_time_left()
+            countdown_expired = countdown_time_left <= 0
+            
+            countdown_message = {
+                "type": "countdown_update",
+                "conversation_id": conversation_id,
+                "data": {
+                    **conversation.get_countdown_state(),
+                    "reason": reason,
+                    "time_left": countdown_time_left,
+                    "expired": countdown_expired,
+                    "start_time": conversation.countdown_start_time.isoformat() if conversation.countdown_start_time else None
+                }
+            }
+            
+            # Broadcast cho tất cả user trong conversation
+            await self.send_to_conversation(countdown_message, conversation_id)
+            
+            logger.debug("countdown_update_sent", conversation_id=conversation_id, reason=reason, time_left=countdown_time_left)
                 
         except Exception as e:
-            print(f"❌ Error broadcasting countdown update: {e}")
+            logger.error("countdown_update_failed", conversation_id=conversation_id, error=str(e))
+    
+    async def push_searching_count(self):
+        """Gửi số người đang tìm kiếm (đếm trong presence) cho các user đang searching, chỉ khi số này thay đổi"""
+        count = presence.count("searching")
+        if count == self.last_searching_count:
+            return
+        self.last_searching_count = count
+        
+        recipients = [user_id for user_id in presence.users_in("searching") if user_id in self.active_connections]
+        if not recipients:
+            return
+        
+        message = {"type": "searching_count", "data": {"searching_count": count}}
+        await asyncio.gather(
+            *(self.send_personal_message(message, user_id) for user_id in recipients),
+            return_exceptions=True
+        )
     
     async def broadcast_typing_status(self, conversation_id: int, user_id: int, is_typing: bool):
         """Broadcast trạng thái typing cho tất cả user trong conversation"""
@@ -168,33 +246,39 @@ class ConnectionManager:
             }
         }
         
-        await self.send_to_conversation(message, conversation_id, exclude_user_id=user_id)
+        # Typing là trạng thái tạm thời, không cần replay khi reconnect
+        await self.send_to_conversation(message, conversation_id, exclude_user_id=user_id, replayable=False)
     
-    def get_conversation_info(self, conversation_id: int) -> dict:
-        """Lấy thông tin conversation từ cache hoặc database"""
-        if conversation_id in self.conversation_cache:
-            return self.conversation_cache[conversation_id]
-        
-        # Nếu không có trong cache, query database
-        from app.database import SessionLocal
-        db = SessionLocal()
-        try:
-            conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
-            if conversation:
-                info = {
-                    'user1_id': conversation.user1_id,
-                    'user2_id': conversation.user2_id,
-                    'is_active': conversation.is_active,
-                    'user1_keep': conversation.user1_keep,
-                    'user2_keep': conversation.user2_keep
-                }
-                # Cache trong 5 phút
-                self.conversation_cache[conversation_id] = info
-                return info
-        finally:
-            db.close()
+    def schedule_message_processing(self, delay: float = 0):
+        """Lên lịch xử lý message queue nếu chưa có lần xử lý nào đang chờ"""
+        if self.processing_queue or self.processing_scheduled:
+            return
         
-        return None
+        self.processing_scheduled = True
+        asyncio.create_task(self._process_message_queue_after(delay))
+    
+    async def _process_message_queue_after(self, delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+        self.processing_scheduled = False
+        await self.process_message_queue()
+    
+    async def broadcast_chat_message(self, msg: dict):
+        """Gửi tin nhắn chat cho user còn lại trong conversation"""
+        message_to_send = {
+            "type": "chat_message",
+            "data": {
+                "id": msg['id'],
+                "conversation_id": msg['conversation_id'],
+                "sender_id": msg['sender_id'],
+                "content": msg['content'],
+                "message_type": msg['message_type'],
+                "created_at": msg['created_at']
+            }
+        }
+        
+        await self.send_to_conversation(message_to_send, msg['conversation_id'], exclude_user_id=msg['sender_id'])
+        msg['delivered'] = True
     
     async def process_message_queue(self):
         """Xử lý batch messages từ queue"""
@@ -202,6 +286,7 @@ class ConnectionManager:
             return
         
         self.processing_queue = True
+        failed = False
         
         try:
             # Lấy tất cả messages trong queue
@@ -216,60 +301,79 @@ class ConnectionManager:
             for msg in messages_to_process:
                 conversation_messages[msg['conversation_id']].append(msg)
             
-            # Process từng conversation
-            from app.database import SessionLocal
-            db = SessionLocal()
+            # Batch insert trong thread database, event loop tiếp tục phục vụ các kết nối khác
+            from app.database import run_db
             
             try:
-                for conversation_id, messages in conversation_messages.items():
-                    # Batch insert messages
-                    db_messages = []
-                    for msg in messages:
-                        db_message = Message(
-                            conversation_id=conversation_id,
-                            sender_id=msg['sender_id'],
-                            content=msg['content'],
-                            message_type=msg['message_type']
-                        )
-                        db_messages.append(db_message)
-                    
-                    db.add_all(db_messages)
-                    
-                    # Cập nhật last_activity của conversation
-                    conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
-                    if conversation:
-                        conversation.last_activity = datetime.now(timezone.utc)
+                await run_db(self._insert_messages, conversation_messages)
+                logger.debug("message_batch_committed", messages=len(messages_to_process), conversations=len(conversation_messages))
                 
-                db.commit()
-                print(f"✅ Batch processed {len(messages_to_process)} messages")
+                # Dữ liệu đã an toàn trong database, thu gọn WAL
+                if self.wal:
+                    self.wal.mark_committed(msg['id'] for msg in messages_to_process)
                 
-                # Broadcast messages sau khi save thành công
+                # Broadcast messages sau khi save thành công (nếu chưa gửi trước đó)
                 for msg in messages_to_process:
-                    message_to_send = {
-                        "type": "chat_message",
-                        "data": {
-                            "id": msg.get('id'),
-                            "conversation_id": msg['conversation_id'],
-                            "sender_id": msg['sender_id'],
-                            "content": msg['content'],
-                            "message_type": msg['message_type'],
-                            "created_at": msg['created_at']
-                        }
-                    }
-                    
-                    await self.send_to_conversation(message_to_send, msg['conversation_id'], exclude_user_id=msg['sender_id'])
+                    if not msg.get('delivered'):
+                        await self.broadcast_chat_message(msg)
                     
             except Exception as e:
-                print(f"❌ Error processing message queue: {e}")
-                db.rollback()
-            finally:
-                db.close()
+                logger.error("message_batch_failed", messages=len(messages_to_process), error=str(e))
+                failed = True
+                self.requeue_failed_messages(messages_to_process)
                 
         finally:
             self.processing_queue = False
             # Schedule next processing nếu còn messages
             if self.message_queue:
-                asyncio.create_task(self.process_message_queue())
+                if failed:
+                    delay = settings.MESSAGE_RETRY_DELAY
+                elif self.wal:
+                    delay = settings.MESSAGE_WAL_BATCH_INTERVAL
+                else:
+                    delay = 0
+                self.schedule_message_processing(delay)
+    
+    @staticmethod
+    def _insert_messages(db: Session, conversation_messages: Dict[int, List[dict]]):
+        try:
+            for conversation_id, messages in conversation_messages.items():
+                # Batch insert messages
+                db_messages = []
+                for msg in messages:
+                    db_message = Message(
+                        id=msg['id'],
+                        conversation_id=conversation_id,
+                        sender_id=msg['sender_id'],
+                        content=msg['content'],
+                        message_type=msg['message_type'],
+                        created_at=datetime.fromisoformat(msg['created_at'])
+                    )
+                    db_messages.append(db_message)
+                
+                db.add_all(db_messages)
+            
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    
+    def requeue_failed_messages(self, messages: List[dict]):
+        """Đưa batch bị lỗi trở lại đầu queue để thử lại, bỏ qua message lỗi quá nhiều lần"""
+        retry, dropped = [], []
+        for msg in messages:
+            msg['attempts'] = msg.get('attempts', 0) + 1
+            if msg['attempts'] < settings.MESSAGE_MAX_RETRIES:
+                retry.append(msg)
+            else:
+                dropped.append(msg)
+        
+        self.message_queue[:0] = retry
+        
+        if dropped:
+            logger.error("messages_dropped", messages=len(dropped), attempts=settings.MESSAGE_MAX_RETRIES)
+            if self.wal:
+                self.wal.mark_committed(msg['id'] for msg in dropped)
 
 # Global manager instance
 manager = ConnectionManager()
@@ -279,14 +383,16 @@ class WebSocketHandler:
         self.manager = manager
         self.typing_debounce = {}  # Debounce typing events
     
-    async def handle_websocket(self, websocket: WebSocket, user_id: int):
+    async def handle_websocket(self, websocket: WebSocket, user_id: int,
+                               resume_conversation_id: int = None, last_seq: int = None):
         """Xử lý WebSocket connection cho user"""
         await self.manager.connect(websocket, user_id)
         
-        print(f"🔌 WebSocket connected for user {user_id}")
-        
         # Tự động thêm user vào conversation nếu họ đang trong một conversation
-        await self.auto_add_to_conversation(user_id)
+        conversation_id = await self.auto_add_to_conversation(user_id)
+        
+        # Đồng bộ sequence number: replay event bị lỡ hoặc gửi seq hiện tại
+        await self.resume_delivery(user_id, conversation_id, resume_conversation_id, last_seq)
         
         try:
             while True:
@@ -306,89 +412,84 @@ class WebSocketHandler:
                         break
                 
         except WebSocketDisconnect:
-            print(f"🔌 WebSocket disconnected for user {user_id}")
             self.manager.disconnect(user_id)
         except Exception as e:
-            print(f"WebSocket error for user {user_id}: {e}")
+            logger.warning("websocket_error", user_id=user_id, error=str(e))
             self.manager.disconnect(user_id)
     
+    async def resume_delivery(self, user_id: int, conversation_id: int,
+                              resume_conversation_id: int = None, last_seq: int = None):
+        """Replay các event bị lỡ khi reconnect, hoặc báo seq hiện tại cho kết nối mới.
+
+        Socket chỉ được thêm vào conversation ở đây, sau khi đã bắt kịp seq.
+        """
+        if conversation_id is None:
+            if resume_conversation_id is not None and last_seq is not None:
+                # Conversation cũ đã kết thúc hoặc user không còn trong đó
+                await self.manager.send_personal_message({
+                    "type": "resync_required",
+                    "data": {"conversation_id": resume_conversation_id, "seq": 0}
+                }, user_id)
+            return
+        
+        if resume_conversation_id == conversation_id and last_seq is not None:
+            await self.manager.replay_events(user_id, conversation_id, last_seq)
+            return
+        
+        # Lấy seq và thêm vào conversation cùng lúc để không lỡ event nào ở giữa
+        seq = self.manager.get_conversation_seq(conversation_id)
+        self.manager.add_to_conversation(conversation_id, user_id)
+        
+        if resume_conversation_id is not None and last_seq is not None:
+            # Conversation cũ đã kết thúc hoặc user không còn trong đó
+            await self.manager.send_personal_message({
+                "type": "resync_required",
+                "data": {"conversation_id": resume_conversation_id, "seq": 0}
+            }, user_id)
+        
+        await self.manager.send_personal_message({
+            "type": "sync_state",
+            "data": {"conversation_id": conversation_id, "seq": seq}
+        }, user_id)
+    
     async def auto_add_to_conversation(self, user_id: int):
-        """Tự động thêm user vào conversation nếu họ đang trong một conversation"""
+        """Tìm conversation user đang tham gia và gửi lại match_found.
+
+        Socket chưa được thêm vào conversation_connections, resume_delivery làm việc
+        đó sau khi replay xong.
+        """
         try:
-            # Sử dụng cache trước
-            for conversation_id, info in self.manager.conversation_cache.items():
-                if info['user1_id'] == user_id or info['user2_id'] == user_id:
-                    if info['is_active']:
-                        print(f"Auto-adding user {user_id} to conversation {conversation_id} (from cache)")
-                        self.manager.add_to_conversation(conversation_id, user_id)
-                        
-                        # Gửi thông báo match cho user này nếu họ chưa nhận được
-                        await self.send_match_notification_if_needed(user_id, conversation_id)
-                        return
+            # Index user -> conversation trong store, reconnect không cần query database
+            conversation = conversation_store.find_by_user(user_id)
+            if not conversation:
+                logger.debug("no_active_conversation", user_id=user_id)
+                return None
             
-            # Nếu không tìm thấy trong cache, query database
-            from app.database import SessionLocal
-            db = SessionLocal()
+            logger.debug("conversation_auto_joined", user_id=user_id, conversation_id=conversation.id)
+            presence.set(user_id, "connected")
             
-            try:
-                conversation = db.query(Conversation).filter(
-                    Conversation.is_active == True,
-                    ((Conversation.user1_id == user_id) | (Conversation.user2_id == user_id))
-                ).first()
-                
-                if conversation:
-                    print(f"Auto-adding user {user_id} to conversation {conversation.id}")
-                    self.manager.add_to_conversation(conversation.id, user_id)
-                    
-                    # Gửi thông báo match cho user này nếu họ chưa nhận được
-                    await self.send_match_notification_if_needed(user_id, conversation.id)
-                else:
-                    print(f"User {user_id} is not in any active conversation")
-                    
-            finally:
-                db.close()
+            # Gửi thông báo match cho user này nếu họ chưa nhận được
+            await self.send_match_notification_if_needed(user_id, conversation)
+            return conversation.id
                 
         except Exception as e:
-            print(f"Error auto-adding user to conversation: {e}")
+            logger.error("conversation_auto_join_failed", user_id=user_id, error=str(e))
+        
+        return None
     
-    async def send_match_notification_if_needed(self, user_id: int, conversation_id: int):
+    async def send_match_notification_if_needed(self, user_id: int, conversation: ConversationState):
         """Gửi thông báo match cho user nếu họ chưa nhận được"""
         try:
-            from app.database import SessionLocal
-            db = SessionLocal()
+            match_notification = {
+                "type": "match_found",
+                "data": conversation.get_match_payload(user_id)
+            }
             
-            try:
-                conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
-                if not conversation:
-                    return
-                
-                # Xác định user khác trong conversation
-                other_user_id = conversation.user2_id if conversation.user1_id == user_id else conversation.user1_id
-                other_user = db.query(User).filter(User.id == other_user_id).first()
-                
-                if other_user:
-                    # Gửi thông báo match
-                    match_notification = {
-                        "type": "match_found",
-                        "data": {
-                            "conversation_id": conversation_id,
-                            "conversation_type": conversation.conversation_type,
-                            "chat_url": f"/chat/{conversation_id}",
-                            "matched_user": {
-                                "id": other_user.id,
-                                "nickname": other_user.nickname
-                            }
-                        }
-                    }
-                    
-                    await self.manager.send_personal_message(match_notification, user_id)
-                    print(f"📨 Sent match notification to user {user_id} for conversation {conversation_id}")
+            await self.manager.send_personal_message(match_notification, user_id)
+            logger.debug("match_notification_sent", user_id=user_id, conversation_id=conversation.id)
                     
-            finally:
-                db.close()
-                
         except Exception as e:
-            print(f"Error sending match notification: {e}")
+            logger.error("match_notification_failed", user_id=user_id, error=str(e))
     
     async def process_message(self, user_id: int, message_data: dict):
         """Xử lý tin nhắn từ WebSocket"""
@@ -410,27 +511,58 @@ class WebSocketHandler:
         message_type = data.get("message_type", "text")
         
         if not conversation_id or not content:
-            print(f"❌ Invalid chat message data from user {user_id}")
+            logger.warning("chat_message_invalid", user_id=user_id, every=1.0)
             return
         
-        print(f"💬 Processing chat message from user {user_id}")
-        print(f"   Conversation: {conversation_id}")
-        print(f"   Content: {content[:50]}{'...' if len(content) > 50 else ''}")
+        logger.debug("chat_message_received", user_id=user_id, conversation_id=conversation_id, length=len(content))
+        
+        # Gán id ngay khi nhận, không cần chờ insert vào database
+        try:
+            message_id = message_id_generator.next_id()
+        except ClockMovedBackwards as e:
+            # Không gửi ack, client tự gửi lại sau
+            logger.error("message_id_unavailable", conversation_id=conversation_id, error=str(e), every=1.0)
+            return
         
-        # Thêm message vào queue để batch processing
         message_data = {
+            'id': message_id,
             'conversation_id': conversation_id,
             'sender_id': user_id,
             'content': content,
             'message_type': message_type,
-            'created_at': datetime.now(timezone.utc).isoformat()
+            'created_at': clock.now().isoformat()
         }
         
+        # Ghi vào WAL (fsync theo lô) trước khi xác nhận đã nhận message
+        if self.manager.wal:
+            try:
+                await self.manager.wal.append(message_data)
+            except Exception as e:
+                logger.error("wal_append_failed", conversation_id=conversation_id, error=str(e))
+                return
+        
+        # Thêm message vào queue để batch processing
         self.manager.message_queue.append(message_data)
+        activity_tracker.touch(conversation_id)
+        
+        # Báo cho người gửi id thật để thay thế tin nhắn tạm thời
+        await self.manager.send_personal_message({
+            "type": "message_ack",
+            "data": {
+                "client_id": data.get("client_id"),
+                "id": message_data['id'],
+                "conversation_id": conversation_id,
+                "created_at": message_data['created_at']
+            }
+        }, user_id)
         
-        # Trigger batch processing nếu chưa đang xử lý
-        if not self.manager.processing_queue:
-            asyncio.create_task(self.manager.process_message_queue())
+        if self.manager.wal:
+            # Message đã bền vững trên đĩa: gửi ngay, ghi database theo lô lớn hơn
+            await self.manager.broadcast_chat_message(message_data)
+            self.manager.schedule_message_processing(settings.MESSAGE_WAL_BATCH_INTERVAL)
+        else:
+            # Trigger batch processing nếu chưa đang xử lý
+            self.manager.schedule_message_processing()
     
     async def handle_typing(self, user_id: int, data: dict):
         """Xử lý trạng thái typing với debouncing"""
@@ -475,86 +607,79 @@ class WebSocketHandler:
         if not conversation_id:
             return
         
-        # Sử dụng cache trước
-        conversation_info = self.manager.get_conversation_info(conversation_id)
-        if not conversation_info:
-            return
-        
-        # Cập nhật database
-        from app.database import SessionLocal
-        db = SessionLocal()
-        
         try:
-            conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
-            if conversation:
-                conversation.set_keep_status(user_id, keep_status)
-                conversation.last_activity = datetime.now(timezone.utc)
-                db.commit()
-                
-                # Cập nhật cache
-                if conversation_id in self.manager.conversation_cache:
-                    self.manager.conversation_cache[conversation_id].update({
-                        'user1_keep': conversation.user1_keep,
-                        'user2_keep': conversation.user2_keep
-                    })
-                
-                # Gửi thông báo keep cho user khác
-                message_to_send = {
-                    "type": "keep_status",
-                    "data": {
-                        "conversation_id": conversation_id,
-                        "user_id": user_id,
-                        "keep_status": keep_status,
-                        "both_kept": conversation.both_kept()
-                    }
+            # Ghi thẳng xuống database qua conversation store, không query lại
+            conversation = await conversation_store.set_keep(conversation_id, user_id, keep_status)
+            if not conversation:
+                return
+            activity_tracker.touch(conversation_id)
+            
+            # Cả 2 đã keep thì không còn deadline, bỏ keep thì lập lịch lại
+            if conversation.is_active:
+                if conversation.both_kept():
+                    expiry_scheduler.cancel(conversation_id)
+                else:
+                    expiry_scheduler.schedule(conversation_id, conversation.get_countdown_deadline())
+            
+            # Gửi thông báo keep cho user khác
+            message_to_send = {
+                "type": "keep_status",
+                "data": {
+                    "conversation_id": conversation_id,
+                    "user_id": user_id,
+                    "keep_status": keep_status,
+                    "both_kept": conversation.both_kept()
                 }
-                
-                await self.manager.send_to_conversation(message_to_send, conversation_id, exclude_user_id=user_id)
-                
-                # Broadcast countdown update để đồng bộ trạng thái
-                await self.manager.broadcast_countdown_update(conversation_id)
-                
+            }
+            
+            await self.manager.send_to_conversation(message_to_send, conversation_id, exclude_user_id=user_id)
+            
+            # Broadcast countdown update để đồng bộ trạng thái
+            await self.manager.broadcast_countdown_update(
+                conversation_id, conversation,
+                reason="both_kept" if conversation.both_kept() else "keep_toggled"
+            )
+            
         except Exception as e:
-            print(f"❌ Error handling keep: {e}")
-            db.rollback()
-        finally:
-            db.close()
+            logger.error("keep_failed", user_id=user_id, conversation_id=conversation_id, error=str(e))
     
     async def handle_end_conversation(self, user_id: int, data: dict):
-        """Xử lý kết thúc conversation"""
+        """Xử lý kết thúc conversation, cùng luồng với POST /end"""
         conversation_id = data.get("conversation_id")
         
         if not conversation_id:
             return
         
-        # Cập nhật database
-        from app.database import SessionLocal
-        db = SessionLocal()
-        
         try:
-            conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
-            if conversation:
-                # Gửi thông báo kết thúc cho tất cả user trong conversation
-                message_to_send = {
-                    "type": "conversation_ended",
-                    "data": {
-                        "conversation_id": conversation_id,
-                        "ended_by": user_id,
-                        "redirect_to_waiting": True,
-                        "redirect_url": "/"
-                    }
-                }
-                
-                await self.manager.send_to_conversation(message_to_send, conversation_id)
-                
-                # Xóa khỏi cache
-                if conversation_id in self.manager.conversation_cache:
-                    del self.manager.conversation_cache[conversation_id]
+            async with DBSession() as db:
+                # Chỉ 1 trong 2 người tham gia mới được kết thúc conversation
+                conversation = await db.run(get_user_conversation, conversation_id, user_id)
+                if not conversation:
+                    logger.warning("end_conversation_forbidden", user_id=user_id, conversation_id=conversation_id)
+                    return
                 
-                # Xóa khỏi conversation connections
-                self.manager.remove_from_conversation(conversation_id, user_id)
+                await MatchingService(db).end_conversation(conversation)
+            
+            expiry_scheduler.cancel(conversation_id)
+            activity_tracker.forget(conversation_id)
+            conversation_store.discard(conversation_id)
+            
+            # Gửi thông báo kết thúc cho tất cả user trong conversation
+            message_to_send = {
+                "type": "conversation_ended",
+                "data": {
+                    "conversation_id": conversation_id,
+                    "ended_by": user_id,
+                    "redirect_to_waiting": True,
+                    "redirect_url": "/"
+                }
+            }
+            
+            await self.manager.send_to_conversation(message_to_send, conversation_id)
+            
+            # Xóa khỏi conversation connections
+            self.manager.remove_from_conversation(conversation_id, user_id)
+            self.manager.drop_replay_buffer(conversation_id)
                 
         except Exception as e:
-            print(f"❌ Error handling end conversation: {e}")
-        finally:
-            db.close() 
\ No newline at end of file
+            logger.error("end_conversation_failed", user_id=user_id, conversation_id=conversation_id, error=str(e)) 
\ No newline at end of file
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Đo độ trễ event loop khi có tải chat + tìm kiếm đồng thời, trước và sau khi
+chuyển truy vấn database sang thread pool (app/database.py).
+
+Chạy app thật trong process (httpx ASGITransport, không cần server), mỗi user
+ảo lặp: /search -> gửi tin nhắn qua WebSocketHandler -> đọc lịch sử -> /end.
+Một task đo xem sleep(5ms) bị trễ bao lâu so với dự kiến. Mỗi truy vấn SQL
+được cộng thêm --query-delay ms để mô phỏng database ở xa hoặc đang chậm.
+
+  --mode inline    chạy truy vấn ngay trên event loop (cách cũ, trước thay đổi)
+  --mode threaded  chạy truy vấn trong db_executor (hiện tại)
+Không truyền --mode thì chạy cả hai (mỗi mode một process riêng) và so sánh.
+
+Usage: python bench_event_loop.py [--users 40] [--seconds 5] [--query-delay 2]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+PROBE_INTERVAL = 0.005
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_mode(mode: str, users: int, seconds: float, query_delay: float):
+    # Database tạm, phải đặt trước khi import app
+    db_dir = tempfile.mkdtemp(prefix="mapmo-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(db_dir, 'bench.db')}"
+    os.environ["JOB_LEADER_LOCK_PATH"] = os.path.join(db_dir, "jobs.lock")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    import httpx
+    from sqlalchemy import event
+    from app import database
+    from app.auth import create_access_token, hash_password
+    from app.database import SessionLocal, engine
+    from app.models import User
+    from app.main import app
+    from app.websocket_manager import WebSocketHandler
+
+    if mode == "inline":
+        # Cách cũ: hàm database chạy thẳng trên event loop
+        async def run_inline(func, *args):
+            return func(*args)
+        database.run_in_db_thread = run_inline
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def slow_query(*_):
+        time.sleep(query_delay / 1000)
+
+    password_hash = hash_password("password")
+    db = SessionLocal()
+    try:
+        accounts = [
+            User(username=f"bench{i}", password_hash=password_hash, nickname=f"Bench {i}",
+                 gender="Nam", preference="Tất cả", goal="Kết hôn", state="waiting")
+            for i in range(users)
+        ]
+        db.add_all(accounts)
+        db.commit()
+        tokens = {user.id: create_access_token({"sub": user.username, "uid": user.id}) for user in accounts}
+    finally:
+        db.close()
+
+    await app.router.startup()
+    handler = WebSocketHandler()
+    lags, stats = [], {"requests": 0, "matches": 0, "messages": 0}
+    deadline = time.perf_counter() + seconds
+
+    async def probe():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            await asyncio.sleep(PROBE_INTERVAL)
+            lags.append(time.perf_counter() - started - PROBE_INTERVAL)
+
+    async def virtual_user(client: httpx.AsyncClient, user_id: int, token: str):
+        headers = {"Authorization": f"Bearer {token}"}
+        while time.perf_counter() < deadline:
+            response = await client.post("/search", json={"search_type": "chat"}, headers=headers)
+            stats["requests"] += 1
+            data = response.json().get("data") or {}
+            conversation_id = data.get("conversation_id")
+            if not conversation_id:
+                await asyncio.sleep(random.uniform(0.01, 0.05))
+                continue
+
+            stats["matches"] += 1
+            for i in range(5):
+                await handler.handle_chat_message(user_id, {"conversation_id": conversation_id, "content": f"tin nhắn {i}"})
+                stats["messages"] += 1
+                await asyncio.sleep(random.uniform(0.005, 0.02))
+            await client.get(f"/conversation/{conversation_id}/messages", headers=headers)
+            await client.post("/end", json={"conversation_id": conversation_id}, headers=headers)
+            stats["requests"] += 2
+
+    transport = httpx.ASGITransport(app=app)
+    started = time.perf_counter()
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await asyncio.gather(probe(), *(virtual_user(client, uid, tok) for uid, tok in tokens.items()))
+    finally:
+        await app.router.shutdown()
+    wall = time.perf_counter() - started
+
+    print(f"[{mode}] {users} users, {wall:.1f}s, query delay {query_delay:g}ms: "
+          f"{stats['requests'] / wall:,.0f} req/s, {stats['matches']} matches, {stats['messages']} messages")
+    print(f"  event loop lag: p50 {percentile(lags, 0.5) * 1000:.2f}ms, p99 {percentile(lags, 0.99) * 1000:.2f}ms, "
+          f"max {max(lags) * 1000:.2f}ms ({len(lags)} samples)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Event loop lag under concurrent chat and search load")
+    parser.add_argument("--mode", choices=("inline", "threaded"))
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--query-delay", type=float, default=2, help="ms added to every SQL statement")
+    args = parser.parse_args()
+
+    if args.mode:
+        asyncio.run(run_mode(args.mode, args.users, args.seconds, args.query_delay))
+        return
+
+    # Mỗi mode một process để trạng thái trong bộ nhớ (presence, store, ...) không lẫn nhau
+    for mode in ("inline", "threaded"):
+        subprocess.run([
+            sys.executable, __file__, "--mode", mode, "--users", str(args.users),
+            "--seconds", str(args.seconds), "--query-delay", str(args.query_delay)
+        ], check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Mô phỏng vòng đời match -> keep -> expire với đồng hồ ảo (app/clock.py).
+
+Chạy đúng code lập lịch thật (MatchingService, presence, conversation_store,
+expiry_scheduler, expire_conversations) nhưng thời gian chỉ trôi khi benchmark gọi advance(), nên
+hàng giờ traffic được mô phỏng trong vài giây. Dùng database SQLite tạm.
+
+Usage: python bench_lifecycle.py [--hours 6] [--users 200] [--step 10] [--keep-rate 0.005]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+# Database tạm và log ít để không ảnh hưởng kết quả, phải đặt trước khi import app
+_db_dir = tempfile.mkdtemp(prefix="mapmo-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'bench.db')}"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from app import clock  # noqa: E402
+from app.database import wait_db_idle  # noqa: E402
+
+# Truy vấn chạy trong thread database, thời gian ảo chỉ trôi khi chúng đã xong
+simulated_clock = clock.SimulatedClock(drain=wait_db_idle)
+clock.set_clock(simulated_clock)
+
+from app.config import settings  # noqa: E402
+from app.conversation_store import conversation_store  # noqa: E402
+from app.database import DBSession, SessionLocal, run_db  # noqa: E402
+from app.expiry import expire_conversations, expiry_scheduler  # noqa: E402
+from app.main import notify_conversations_expired  # noqa: E402
+from app.matching import MatchingService  # noqa: E402
+from app.models import User  # noqa: E402
+from app.presence import presence  # noqa: E402
+
+
+class LifecycleBenchmark:
+    def __init__(self, users: int, keep_rate: float):
+        self.user_count = users
+        self.keep_rate = keep_rate
+        self.created = 0
+        self.kept = 0
+        self.expired = 0
+        self.lateness = []
+        self.deadlines = {}
+        self.user_ids = set()
+
+    def create_users(self):
+        db = SessionLocal()
+        try:
+            users = [
+                User(username=f"bench{i}", password_hash="-", nickname=f"Bench {i}", state="waiting")
+                for i in range(self.user_count)
+            ]
+            db.add_all(users)
+            db.commit()
+            self.user_ids = {user.id for user in users}
+        finally:
+            db.close()
+
+    async def on_expire(self, conversation_ids):
+        """Callback của expiry scheduler: giống expire_due_conversations, thêm đo độ trễ"""
+        expired = await run_db(lambda db: expire_conversations(db, conversation_ids=conversation_ids))
+
+        now = clock.time()
+        for conversation_id, _, _ in expired:
+            self.lateness.append(now - self.deadlines.pop(conversation_id))
+        self.expired += len(expired)
+
+        await notify_conversations_expired(expired)
+
+    async def match_waiting_users(self):
+        """Ghép cặp ngẫu nhiên các user đang waiting bằng MatchingService thật"""
+        async with DBSession() as db:
+            waiting_ids = self.user_ids - presence.users_in("connected")
+            waiting = await db.run(lambda session: session.query(User).filter(User.id.in_(waiting_ids)).all())
+            random.shuffle(waiting)
+            presence.set_many((user.id for user in waiting), "searching")
+
+            matching_service = MatchingService(db)
+            for user1, user2 in zip(waiting[::2], waiting[1::2]):
+                conversation = await matching_service.create_conversation(user1, user2)
+                deadline = conversation.get_countdown_deadline()
+                expiry_scheduler.schedule(conversation.id, deadline)
+                conversation_store.put(conversation)
+                self.deadlines[conversation.id] = deadline.timestamp()
+                self.created += 1
+
+    async def toggle_keeps(self):
+        """Mỗi bước, một phần user trong conversation đang active nhấn Keep"""
+        for conversation_id in list(self.deadlines):
+            conversation = await conversation_store.get(conversation_id)
+            if not conversation:
+                continue
+            for user_id in (conversation.user1_id, conversation.user2_id):
+                if random.random() < self.keep_rate and not conversation.get_keep_status(user_id):
+                    conversation = await conversation_store.set_keep(conversation_id, user_id, True)
+            if conversation and conversation.both_kept():
+                expiry_scheduler.cancel(conversation_id)
+                self.deadlines.pop(conversation_id, None)
+                self.kept += 1
+
+    async def run(self, hours: float, step: float):
+        self.create_users()
+        expiry_scheduler.start(self.on_expire)
+
+        simulated = hours * 3600
+        started = time.perf_counter()
+        elapsed = 0.0
+        while elapsed < simulated:
+            await self.match_waiting_users()
+            await self.toggle_keeps()
+            await simulated_clock.advance(step)
+            elapsed += step
+        wall = time.perf_counter() - started
+
+        print(f"Simulated {hours:g}h in {wall:.2f}s wall ({simulated / wall:,.0f}x real time)")
+        print(f"  countdown duration: {settings.COUNTDOWN_DURATION}s, step: {step:g}s, users: {self.user_count}")
+        print(f"  conversations created: {self.created}")
+        print(f"  conversations kept by both: {self.kept}")
+        print(f"  conversations expired: {self.expired}")
+        if self.lateness:
+            print(f"  expiry lateness (simulated): max {max(self.lateness):.3f}s, "
+                  f"avg {sum(self.lateness) / len(self.lateness):.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accelerated match/keep/expire lifecycle benchmark")
+    parser.add_argument("--hours", type=float, default=6)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--step", type=float, default=10, help="simulated seconds per step")
+    parser.add_argument("--keep-rate", type=float, default=0.005, help="keep probability per user per step")
+    args = parser.parse_args()
+
+    asyncio.run(LifecycleBenchmark(args.users, args.keep_rate).run(args.hours, args.step))
+
+
+if __name__ == "__main__":
+    main()
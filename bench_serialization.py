@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+So sánh chi phí serialize lịch sử tin nhắn: đường cũ (ORM object -> MessageResponse
+-> jsonable -> json.dumps, đúng như response_model của FastAPI) và đường nhanh
+(đọc cột -> dict -> app.serialization.dumps). Kiểm tra luôn hai output giống hệt nhau.
+
+Usage: python bench_serialization.py [--messages 1000] [--repeat 20]
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import List
+
+# Database tạm, phải đặt trước khi import app
+_db_dir = tempfile.mkdtemp(prefix="mapmo-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'bench.db')}"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+
+from app import serialization  # noqa: E402
+from app.database import SessionLocal, engine  # noqa: E402
+from app.models import Base, Conversation, Message, User  # noqa: E402
+from app.schemas import MessageResponse  # noqa: E402
+from app.serialization import MESSAGE_COLUMNS, dumps, message_rows  # noqa: E402
+
+
+def create_messages(count: int) -> int:
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        users = [User(username=f"bench{i}", password_hash="-", nickname=f"Bench {i}") for i in range(2)]
+        db.add_all(users)
+        db.commit()
+        conversation = Conversation(user1_id=users[0].id, user2_id=users[1].id, is_active=True)
+        db.add(conversation)
+        db.commit()
+        db.add_all([
+            Message(
+                conversation_id=conversation.id,
+                sender_id=users[i % 2].id,
+                content=f"Tin nhắn số {i} — xin chào 👋 \"quote\" \\ backslash"
+            )
+            for i in range(count)
+        ])
+        db.commit()
+        return conversation.id
+    finally:
+        db.close()
+
+
+def measure(func, repeat: int) -> float:
+    func()  # warm up
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message history serialization benchmark")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    conversation_id = create_messages(args.messages)
+    field = create_response_field(name="Response_get_messages", type_=List[MessageResponse])
+    db = SessionLocal()
+
+    def orm_rows():
+        db.expunge_all()
+        return db.query(Message).filter(Message.conversation_id == conversation_id).order_by(Message.created_at.asc()).all()
+
+    def column_rows():
+        return message_rows(db.query(*MESSAGE_COLUMNS).filter(
+            Message.conversation_id == conversation_id
+        ).order_by(Message.created_at.asc()))
+
+    def serialize_old(rows) -> bytes:
+        content = asyncio.run(serialize_response(field=field, response_content=rows, is_coroutine=True))
+        return JSONResponse(content).body
+
+    try:
+        old_rows, new_rows = orm_rows(), column_rows()
+        old_body, new_body = serialize_old(old_rows), dumps(new_rows)
+        assert old_body == new_body, "fast path output differs from response_model output"
+
+        results = {
+            "serialize only (old)": measure(lambda: serialize_old(old_rows), args.repeat),
+            "serialize only (fast)": measure(lambda: dumps(new_rows), args.repeat),
+            "query + serialize (old)": measure(lambda: serialize_old(orm_rows()), args.repeat),
+            "query + serialize (fast)": measure(lambda: dumps(column_rows()), args.repeat),
+        }
+    finally:
+        db.close()
+
+    encoder = "orjson" if serialization.orjson is not None else "json (orjson not installed)"
+    print(f"{args.messages} messages, {len(new_body):,} bytes, encoder: {encoder}, outputs identical")
+    for name, seconds in results.items():
+        print(f"  {name:<26} {seconds * 1000:8.2f} ms/request  {seconds / args.messages * 1e6:7.2f} µs/row")
+
+
+if __name__ == "__main__":
+    main()
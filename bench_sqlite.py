@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+So sánh SQLite profile cũ (SQLITE_PROFILE=legacy: một QueuePool 20+30, không pragma,
+rollback journal) với profile production (WAL + pragma, một connection ghi, pool
+connection chỉ đọc) dưới tải đọc/ghi đồng thời.
+
+Các thread đóng vai thread trong db_executor: writer ghi tin nhắn theo lô 10 dòng
+(như message queue) và cập nhật keep, reader đọc trang tin nhắn mới nhất và user. Mỗi
+profile chạy trong một process riêng trên một database tạm mới.
+
+Usage: python bench_sqlite.py [--readers 8] [--writers 4] [--seconds 5]
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PROFILES = ("legacy", "production")
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_profile(readers: int, writers: int, seconds: float):
+    from sqlalchemy import update
+    from app.database import Base, SessionLocal, engine
+    from app.idgen import message_id_generator
+    from app.models import Conversation, Message, User
+    from app.serialization import MESSAGE_COLUMNS, message_rows
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        users = [User(username=f"bench{i}", password_hash="-", nickname=f"Bench {i}") for i in range(200)]
+        db.add_all(users)
+        db.commit()
+        conversations = [
+            Conversation(user1_id=users[i].id, user2_id=users[i + 1].id, is_active=True)
+            for i in range(0, len(users), 2)
+        ]
+        db.add_all(conversations)
+        db.commit()
+        db.add_all([
+            Message(id=message_id_generator.next_id(), conversation_id=conversation.id,
+                    sender_id=conversation.user1_id, content=f"tin nhắn {i}")
+            for conversation in conversations for i in range(50)
+        ])
+        db.commit()
+        user_ids = [user.id for user in users]
+        pairs = [(conversation.id, conversation.user1_id) for conversation in conversations]
+    finally:
+        db.close()
+
+    deadline = time.perf_counter() + seconds
+    results = {"read": [], "write": [], "read_errors": 0, "write_errors": 0}
+    lock = threading.Lock()
+
+    def read_once(session):
+        conversation_id, _ = random.choice(pairs)
+        # Trang tin nhắn mới nhất như /bootstrap, chi phí đọc không tăng theo số tin nhắn đã ghi
+        message_rows(session.query(*MESSAGE_COLUMNS).filter(
+            Message.conversation_id == conversation_id
+        ).order_by(Message.created_at.desc(), Message.id.desc()).limit(50))
+        session.get(User, random.choice(user_ids))
+
+    def write_once(session):
+        conversation_id, sender_id = random.choice(pairs)
+        if random.random() < 0.2:
+            session.execute(
+                update(Conversation)
+                .where(Conversation.id == conversation_id)
+                .values(user1_keep=random.random() < 0.5)
+                .returning(Conversation.user1_keep, Conversation.user2_keep)
+                .execution_options(synchronize_session=False)
+            ).first()
+        else:
+            session.add_all([
+                Message(id=message_id_generator.next_id(), conversation_id=conversation_id,
+                        sender_id=sender_id, content="xin chào")
+                for _ in range(10)
+            ])
+        session.commit()
+
+    def worker(kind, operation):
+        latencies, errors = [], 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            session = SessionLocal()
+            try:
+                operation(session)
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                session.rollback()
+                errors += 1
+            finally:
+                session.close()
+        with lock:
+            results[kind].extend(latencies)
+            results[f"{kind}_errors"] += errors
+
+    threads = [threading.Thread(target=worker, args=("read", read_once)) for _ in range(readers)]
+    threads += [threading.Thread(target=worker, args=("write", write_once)) for _ in range(writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    profile = os.environ["SQLITE_PROFILE"]
+    print(f"[{profile}] {readers} readers, {writers} writers, {wall:.1f}s")
+    for kind in ("read", "write"):
+        samples = results[kind]
+        print(f"  {kind + 's':<6} {len(samples) / wall:8,.0f}/s  p50 {percentile(samples, 0.5) * 1000:7.2f}ms  "
+              f"p99 {percentile(samples, 0.99) * 1000:7.2f}ms  errors {results[kind + '_errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite read/write concurrency benchmark")
+    parser.add_argument("--profile", choices=PROFILES)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    if args.profile:
+        run_profile(args.readers, args.writers, args.seconds)
+        return
+
+    for profile in PROFILES:
+        # Database tạm mới cho mỗi profile, phải đặt trước khi import app (trong process con)
+        db_dir = tempfile.mkdtemp(prefix="mapmo-bench-")
+        env = dict(os.environ, SQLITE_PROFILE=profile, LOG_LEVEL="WARNING",
+                   DATABASE_URL=f"sqlite:///{os.path.join(db_dir, 'bench.db')}")
+        subprocess.run([
+            sys.executable, __file__, "--profile", profile, "--readers", str(args.readers),
+            "--writers", str(args.writers), "--seconds", str(args.seconds)
+        ], env=env, check=True)
+
+
+if __name__ == "__main__":
+    main()
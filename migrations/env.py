@@ -0,0 +1,54 @@
+from logging.config import fileConfig
+
+from alembic import context
+
+from app.database import Base, engine
+from app import models  # noqa: F401  đăng ký các bảng vào Base.metadata
+
+config = context.config
+target_metadata = Base.metadata
+
+# app.schema.upgrade_database truyền sẵn connection; logging khi đó do app cấu hình
+connection = config.attributes.get("connection")
+if connection is None and config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+
+def _configure(**kwargs):
+    context.configure(
+        target_metadata=target_metadata,
+        # SQLite không ALTER được cột/constraint, alembic dựng lại bảng (batch mode)
+        render_as_batch=engine.dialect.name == "sqlite",
+        compare_type=True,
+        # Mỗi revision một transaction: revision có autocommit_block (CREATE INDEX
+        # CONCURRENTLY) không commit dở dang các revision trước nó
+        transaction_per_migration=True,
+        **kwargs
+    )
+
+
+def run_migrations_offline():
+    """alembic upgrade --sql: in câu lệnh SQL thay vì chạy"""
+    _configure(url=engine.url, literal_binds=True, dialect_opts={"paramstyle": "named"})
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    # Dùng engine của app (engine ghi) để có cùng pragma SQLite / pool như lúc chạy
+    if connection is not None:
+        _configure(connection=connection)
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+
+    with engine.connect() as own_connection:
+        _configure(connection=own_connection)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,82 @@
+"""baseline: schema trước khi có migration (đúng như Base.metadata.create_all của bản
+trước đó tạo ra, messages.id là INTEGER và chưa có message_archives)
+
+Database cũ đã có bảng được stamp revision này thay vì chạy lại (xem app/schema.py),
+nên không được thêm thay đổi schema mới vào đây, hãy tạo revision mới.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("username", sa.String(), nullable=False),
+        sa.Column("password_hash", sa.String(), nullable=False),
+        sa.Column("nickname", sa.String(), nullable=True),
+        sa.Column("dob", sa.DateTime(), nullable=True),
+        sa.Column("gender", sa.String(), nullable=True),
+        sa.Column("preference", sa.String(), nullable=True),
+        sa.Column("goal", sa.String(), nullable=True),
+        sa.Column("interests", sa.Text(), nullable=True),
+        sa.Column("state", sa.String(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_users_id", "users", ["id"])
+    op.create_index("ix_users_username", "users", ["username"], unique=True)
+
+    op.create_table(
+        "conversations",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user1_id", sa.Integer(), nullable=False),
+        sa.Column("user2_id", sa.Integer(), nullable=False),
+        sa.Column("conversation_type", sa.String(), nullable=True),
+        sa.Column("user1_keep", sa.Boolean(), nullable=True),
+        sa.Column("user2_keep", sa.Boolean(), nullable=True),
+        sa.Column("last_activity", sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column("voice_unlocked", sa.Boolean(), nullable=True),
+        sa.Column("is_active", sa.Boolean(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column("countdown_start_time", sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.ForeignKeyConstraint(["user1_id"], ["users.id"]),
+        sa.ForeignKeyConstraint(["user2_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_conversations_id", "conversations", ["id"])
+
+    op.create_table(
+        "messages",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("conversation_id", sa.Integer(), nullable=False),
+        sa.Column("sender_id", sa.Integer(), nullable=False),
+        sa.Column("content", sa.Text(), nullable=False),
+        sa.Column("message_type", sa.String(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.ForeignKeyConstraint(["conversation_id"], ["conversations.id"]),
+        sa.ForeignKeyConstraint(["sender_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_messages_id", "messages", ["id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_id", table_name="messages")
+    op.drop_table("messages")
+    op.drop_index("ix_conversations_id", table_name="conversations")
+    op.drop_table("conversations")
+    op.drop_index("ix_users_username", table_name="users")
+    op.drop_index("ix_users_id", table_name="users")
+    op.drop_table("users")
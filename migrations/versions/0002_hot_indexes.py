@@ -0,0 +1,69 @@
+"""index cho các truy vấn nóng
+
+- users.state: presence.rebuild reset các user còn searching/connected
+- conversations(is_active, user1_id), (is_active, user2_id): conversation active của
+  một user (kiểm tra trùng khi ghép, seed khi khởi động)
+- conversations(is_active, countdown_start_time): expire_conversations mỗi lượt quét
+- conversations(is_active, last_activity): ArchiveService tìm conversation cũ đã kết thúc
+- messages(conversation_id, created_at): lịch sử / bootstrap / archive / export
+
+Chạy online: PostgreSQL dùng CREATE INDEX CONCURRENTLY (không khóa ghi), SQLite chỉ
+giữ lock ghi trong lúc build. Chạy lại nhiều lần an toàn (IF NOT EXISTS).
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    ("ix_users_state", "users", ["state"]),
+    ("ix_conversations_active_user1", "conversations", ["is_active", "user1_id"]),
+    ("ix_conversations_active_user2", "conversations", ["is_active", "user2_id"]),
+    ("ix_conversations_active_countdown", "conversations", ["is_active", "countdown_start_time"]),
+    ("ix_conversations_active_last_activity", "conversations", ["is_active", "last_activity"]),
+    ("ix_messages_conversation_created", "messages", ["conversation_id", "created_at"]),
+)
+
+
+def _drop_invalid_postgres_index(name: str):
+    """CREATE INDEX CONCURRENTLY bị ngắt giữa chừng để lại index INVALID, xóa để build lại"""
+    if op.get_context().as_sql:
+        return
+    invalid = op.get_bind().execute(sa.text(
+        "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+        "WHERE c.relname = :name AND NOT i.indisvalid"
+    ), {"name": name}).first()
+    if invalid:
+        op.drop_index(name, postgresql_concurrently=True, if_exists=True)
+
+
+def upgrade() -> None:
+    if op.get_context().dialect.name == "postgresql":
+        # CONCURRENTLY không chạy được trong transaction
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                _drop_invalid_postgres_index(name)
+                op.create_index(name, table, columns, if_not_exists=True, postgresql_concurrently=True)
+        return
+
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, if_not_exists=True)
+
+
+def downgrade() -> None:
+    if op.get_context().dialect.name == "postgresql":
+        with op.get_context().autocommit_block():
+            for name, table, _ in reversed(INDEXES):
+                op.drop_index(name, table_name=table, if_exists=True, postgresql_concurrently=True)
+        return
+
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
@@ -0,0 +1,54 @@
+"""message_archives và messages.id BIGINT (snowflake id)
+
+- message_archives: segment tin nhắn đã nén của conversation đã kết thúc (ArchiveService)
+- messages.id: snowflake id (app/idgen.py) vượt quá INTEGER 32-bit trên PostgreSQL;
+  SQLite giữ INTEGER vì đó là rowid 64-bit
+
+Database tạo bằng create_all sau khi có ArchiveService đã có sẵn message_archives
+nhưng vẫn được stamp 0001, nên bảng chỉ được tạo khi chưa tồn tại.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def _has_table(name: str) -> bool:
+    if op.get_context().as_sql:
+        return False
+    return sa.inspect(op.get_bind()).has_table(name)
+
+
+def upgrade() -> None:
+    if not _has_table("message_archives"):
+        op.create_table(
+            "message_archives",
+            sa.Column("conversation_id", sa.Integer(), nullable=False),
+            sa.Column("message_count", sa.Integer(), nullable=False),
+            sa.Column("first_message_at", sa.DateTime(timezone=True), nullable=True),
+            sa.Column("last_message_at", sa.DateTime(timezone=True), nullable=True),
+            sa.Column("codec", sa.String(), nullable=True),
+            sa.Column("payload", sa.LargeBinary(), nullable=False),
+            sa.Column("archived_at", sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+            sa.ForeignKeyConstraint(["conversation_id"], ["conversations.id"]),
+            sa.PrimaryKeyConstraint("conversation_id"),
+        )
+
+    if op.get_context().dialect.name != "sqlite":
+        op.alter_column("messages", "id", type_=sa.BigInteger(), existing_type=sa.Integer(),
+                        existing_nullable=False)
+
+
+def downgrade() -> None:
+    if op.get_context().dialect.name != "sqlite":
+        op.alter_column("messages", "id", type_=sa.Integer(), existing_type=sa.BigInteger(),
+                        existing_nullable=False)
+    op.drop_table("message_archives")
@@ -3,7 +3,10 @@ class MapmoApp {
     constructor() {
         this.currentUser = null;
         this.currentConversation = null;
+        this.preloadedMessages = null; // Tin nhắn lấy từ bootstrap, dùng khi render phòng chat
+        this.currentSearchType = null; // Loại tìm kiếm đang chạy, gửi lại khi reconnect
         this.websocket = null;
+        this.websocketConnecting = false; // Đang lấy vé kết nối WebSocket
         this.pendingTempMessage = null; // Tin nhắn tạm thời đang chờ
         this.typingTimeout = null; // Timeout cho typing indicator
         
@@ -13,8 +16,16 @@ class MapmoApp {
         this.countdownDuration = 5 * 60; // 5 phút = 300 giây
         this.countdownTimeLeft = this.countdownDuration;
         this.bothKept = false; // Trạng thái cả 2 người đã keep
-        this.countdownStartTime = null; // Thời gian bắt đầu từ server
-        this.serverSyncInterval = null; // Interval để sync với server
+        this.countdownDeadline = null; // Thời điểm hết countdown (ms, theo đồng hồ server)
+        this.serverClockOffset = 0; // Chênh lệch đồng hồ server - client (ms)
+        this.expiryFallbackTimeout = null; // Hỏi lại server nếu không nhận được thông báo kết thúc
+        
+        // Sequence number của event cuối cùng đã nhận, dùng để resume khi reconnect
+        this.lastSeq = null;
+        this.lastSeqConversationId = null;
+        
+        // Id các tin nhắn đã hiển thị, tránh hiển thị trùng (history + replay + echo)
+        this.renderedMessageIds = new Set();
         
         this.init();
     }
@@ -73,17 +84,28 @@ class MapmoApp {
         }
     }
     
+    fetchConversationBootstrap(conversationId) {
+        // Thông tin conversation, keep, countdown và tin nhắn mới nhất trong một request
+        return fetch(`/api/conversation/${conversationId}/bootstrap`, {
+            headers: {
+                'Authorization': `Bearer ${localStorage.getItem('access_token')}`
+            }
+        });
+    }
+    
     async loadConversationFromUrl(conversationId) {
         // Load conversation từ URL
         try {
-            const response = await fetch(`/api/conversation/${conversationId}`, {
-                headers: {
-                    'Authorization': `Bearer ${localStorage.getItem('access_token')}`
-                }
-            });
+            const response = await this.fetchConversationBootstrap(conversationId);
             
             if (response.ok) {
                 const data = await response.json();
+                // showChatInterface dùng luôn tin nhắn này, không cần request thêm
+                this.preloadedMessages = {
+                    conversationId: conversationId,
+                    messages: data.data.messages,
+                    hasMore: data.data.has_more_messages
+                };
                 this.currentConversation = {
                     conversation_id: conversationId,
                     conversation_type: data.data.conversation_type,
@@ -96,17 +118,11 @@ class MapmoApp {
                     this.setBothKeptStatus(data.data.keep_status.both_kept);
                 }
                 
-                // Cập nhật thông tin countdown từ server
+                // Cập nhật thông tin countdown từ server (deadline tuyệt đối)
                 if (data.data.countdown) {
-                    this.countdownTimeLeft = data.data.countdown.time_left;
-                    this.countdownStartTime = data.data.countdown.start_time;
+                    this.applyCountdownState(data.data.countdown);
                     
-                    console.log('📊 Countdown info from server:', {
-                        time_left: this.countdownTimeLeft,
-                        start_time: this.countdownStartTime,
-                        expired: data.data.countdown.expired,
-                        both_kept: data.data.countdown.both_kept
-                    });
+                    console.log('📊 Countdown info from server:', data.data.countdown);
                     
                     // Nếu countdown đã hết thời gian, kết thúc conversation
                     if (data.data.countdown.expired && !this.bothKept) {
@@ -116,11 +132,6 @@ class MapmoApp {
                         }, 2000);
                         return;
                     }
-                    
-                    // Nếu cả 2 đã keep, dừng countdown
-                    if (data.data.countdown.both_kept) {
-                        this.setBothKeptStatus(true);
-                    }
                 }
                 
                 this.showChatInterface();
@@ -495,12 +506,6 @@ class MapmoApp {
     }
     
     showMainInterface() {
-        // Dừng interval cập nhật số người đang tìm kiếm nếu có
-        if (this.searchingCountInterval) {
-            clearInterval(this.searchingCountInterval);
-            this.searchingCountInterval = null;
-        }
-        
         const container = document.querySelector('.container');
         container.innerHTML = `
             <div class="welcome-section">
@@ -529,6 +534,7 @@ class MapmoApp {
     }
     
     async startSearch(searchType) {
+        this.currentSearchType = searchType;
         // Hiển thị màn hình tìm kiếm ngay lập tức
         await this.showSearching(searchType);
         
@@ -551,6 +557,7 @@ class MapmoApp {
                 } else if (data.data.conversation_id) {
                     // Nếu có conversation_id, có nghĩa là đã match
                     this.currentConversation = data.data;
+                    this.applyCountdownState(data.data.countdown);
                     this.showChatInterface();
                 }
             } else {
@@ -620,14 +627,9 @@ class MapmoApp {
             this.showMainInterface();
         });
         
-        // Lấy số người đang tìm kiếm
+        // Lấy số người đang tìm kiếm một lần, sau đó server đẩy qua WebSocket khi số này thay đổi
         await this.updateSearchingCount();
         
-        // Cập nhật số người đang tìm kiếm mỗi 5 giây
-        this.searchingCountInterval = setInterval(async () => {
-            await this.updateSearchingCount();
-        }, 5000);
-        
         // Kết nối WebSocket để nhận thông báo match
         if (!this.websocket || this.websocket.readyState !== WebSocket.OPEN) {
             this.connectWebSocket();
@@ -635,12 +637,6 @@ class MapmoApp {
     }
     
     async showChatInterface() {
-        // Dừng interval cập nhật số người đang tìm kiếm nếu có
-        if (this.searchingCountInterval) {
-            clearInterval(this.searchingCountInterval);
-            this.searchingCountInterval = null;
-        }
-        
         // Tạo URL riêng cho phòng chat
         const chatUrl = `/chat/${this.currentConversation.conversation_id}`;
         window.history.pushState({ conversationId: this.currentConversation.conversation_id }, '', chatUrl);
@@ -676,6 +672,7 @@ class MapmoApp {
         `;
         
         // Load lịch sử tin nhắn
+        this.renderedMessageIds.clear();
         await this.loadMessageHistory();
         
         this.connectWebSocket();
@@ -687,43 +684,58 @@ class MapmoApp {
     
     async loadMessageHistory() {
         try {
-            const response = await fetch(`/conversation/${this.currentConversation.conversation_id}/messages`, {
-                headers: {
-                    'Authorization': `Bearer ${localStorage.getItem('access_token')}`
-                }
-            });
+            const conversationId = this.currentConversation.conversation_id;
+            const preloaded = this.preloadedMessages;
+            this.preloadedMessages = null;
+            let messages = null;
+            let hasMore = false;
             
-            if (response.ok) {
-                const messages = await response.json();
+            if (preloaded && preloaded.conversationId === conversationId) {
+                messages = preloaded.messages;
+                hasMore = preloaded.hasMore;
+            } else {
+                const response = await this.fetchConversationBootstrap(conversationId);
                 
-                // Xóa loading indicator
-                const loadingElement = document.getElementById('loadingMessages');
-                if (loadingElement) {
-                    loadingElement.remove();
+                if (!response.ok) {
+                    console.error('❌ Lỗi khi load lịch sử tin nhắn:', response.status);
+                    // Xóa loading indicator và hiển thị lỗi
+                    const loadingElement = document.getElementById('loadingMessages');
+                    if (loadingElement) {
+                        loadingElement.innerHTML = '<div style="color: #ff6b6b;">❌ Không thể tải tin nhắn</div>';
+                    }
+                    return;
                 }
                 
-                // Hiển thị tin nhắn cũ
-                if (messages.length > 0) {
-                    console.log(`📚 Loaded ${messages.length} tin nhắn từ lịch sử`);
-                    messages.forEach(message => {
-                        this.addMessage(message);
-                    });
-                } else {
-                    console.log('📚 Không có tin nhắn cũ');
-                    // Hiển thị thông báo nếu không có tin nhắn
-                    const chatMessages = document.getElementById('chatMessages');
-                    const noMessagesDiv = document.createElement('div');
-                    noMessagesDiv.style.cssText = 'text-align: center; padding: 20px; color: #666; font-style: italic;';
-                    noMessagesDiv.textContent = 'Chưa có tin nhắn nào. Hãy bắt đầu cuộc trò chuyện! 💬';
-                    chatMessages.appendChild(noMessagesDiv);
-                }
+                const data = await response.json();
+                messages = data.data.messages;
+                hasMore = data.data.has_more_messages;
+            }
+            
+            // Bootstrap chỉ có trang mới nhất, tải dần các trang cũ hơn
+            if (hasMore && messages.length > 0) {
+                messages = (await this.fetchOlderMessages(conversationId, messages[0].id)).concat(messages);
+            }
+            
+            // Xóa loading indicator
+            const loadingElement = document.getElementById('loadingMessages');
+            if (loadingElement) {
+                loadingElement.remove();
+            }
+            
+            // Hiển thị tin nhắn cũ
+            if (messages.length > 0) {
+                console.log(`📚 Loaded ${messages.length} tin nhắn từ lịch sử`);
+                messages.forEach(message => {
+                    this.addMessage(message);
+                });
             } else {
-                console.error('❌ Lỗi khi load lịch sử tin nhắn:', response.status);
-                // Xóa loading indicator và hiển thị lỗi
-                const loadingElement = document.getElementById('loadingMessages');
-                if (loadingElement) {
-                    loadingElement.innerHTML = '<div style="color: #ff6b6b;">❌ Không thể tải tin nhắn</div>';
-                }
+                console.log('📚 Không có tin nhắn cũ');
+                // Hiển thị thông báo nếu không có tin nhắn
+                const chatMessages = document.getElementById('chatMessages');
+                const noMessagesDiv = document.createElement('div');
+                noMessagesDiv.style.cssText = 'text-align: center; padding: 20px; color: #666; font-style: italic;';
+                noMessagesDiv.textContent = 'Chưa có tin nhắn nào. Hãy bắt đầu cuộc trò chuyện! 💬';
+                chatMessages.appendChild(noMessagesDiv);
             }
         } catch (error) {
             console.error('❌ Lỗi khi load lịch sử tin nhắn:', error);
@@ -735,7 +747,85 @@ class MapmoApp {
         }
     }
     
-    connectWebSocket() {
+    async fetchOlderMessages(conversationId, beforeId) {
+        // Lùi từng trang theo cursor before_id, trang ngắn hơn pageSize là đã hết
+        const pageSize = 50;
+        let older = [];
+        
+        while (true) {
+            const response = await fetch(
+                `/conversation/${conversationId}/messages?before_id=${beforeId}&limit=${pageSize}`, {
+                headers: {
+                    'Authorization': `Bearer ${localStorage.getItem('access_token')}`
+                }
+            });
+            
+            if (!response.ok) {
+                console.error('❌ Lỗi khi load tin nhắn cũ:', response.status);
+                return older;
+            }
+            
+            const page = await response.json();
+            older = page.concat(older);
+            
+            if (page.length < pageSize) {
+                return older;
+            }
+            beforeId = page[0].id;
+        }
+    }
+    
+    async resumeSearch() {
+        try {
+            const response = await fetch('/search', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Authorization': `Bearer ${localStorage.getItem('access_token')}`
+                },
+                body: JSON.stringify({ search_type: this.currentSearchType })
+            });
+            
+            const data = await response.json();
+            
+            // Match được trả về ngay thì xử lý như startSearch, còn lại chờ WebSocket
+            if (response.ok && data.data.conversation_id) {
+                this.currentConversation = data.data;
+                this.applyCountdownState(data.data.countdown);
+                this.showChatInterface();
+            }
+        } catch (error) {
+            console.error('Error resuming search:', error);
+        }
+    }
+    
+    async fetchWebSocketTicket() {
+        // Vé kết nối ngắn hạn, server kiểm tra vé khi handshake mà không cần query database
+        const response = await fetch('/api/ws-ticket', {
+            method: 'POST',
+            headers: {
+                'Authorization': `Bearer ${localStorage.getItem('access_token')}`
+            }
+        });
+        
+        if (response.status === 401) {
+            return { unauthorized: true };
+        }
+        if (!response.ok) {
+            throw new Error(`Ticket request failed: ${response.status}`);
+        }
+        
+        const data = await response.json();
+        return { ticket: data.data.ticket };
+    }
+    
+    async connectWebSocket() {
+        // Không mở thêm kết nối nếu đã có kết nối đang hoạt động hoặc đang lấy vé
+        if (this.websocketConnecting || (this.websocket && (this.websocket.readyState === WebSocket.OPEN ||
+                               this.websocket.readyState === WebSocket.CONNECTING))) {
+            return;
+        }
+        
         // Sử dụng URL động thay vì hardcode localhost
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
         const host = window.location.host;
@@ -746,15 +836,48 @@ class MapmoApp {
             return;
         }
         
-        // Thêm token vào URL query parameter
-        const wsUrl = `${protocol}//${host}/ws/${this.currentUser.id}?token=${encodeURIComponent(token)}`;
+        let ticketResult;
+        this.websocketConnecting = true;
+        try {
+            ticketResult = await this.fetchWebSocketTicket();
+        } catch (error) {
+            console.error('Error fetching WebSocket ticket:', error);
+            this.attemptReconnection();
+            return;
+        } finally {
+            this.websocketConnecting = false;
+        }
+        
+        if (ticketResult.unauthorized) {
+            this.showError('Phiên đăng nhập đã hết hạn');
+            setTimeout(() => {
+                this.handleLogout();
+            }, 2000);
+            return;
+        }
+        
+        // Thêm vé kết nối vào URL query parameter
+        let wsUrl = `${protocol}//${host}/ws/${this.currentUser.id}?ticket=${encodeURIComponent(ticketResult.ticket)}`;
+        
+        // Gửi seq cuối cùng để server chỉ replay các event bị lỡ
+        if (this.lastSeq !== null && this.lastSeqConversationId !== null) {
+            wsUrl += `&conversation_id=${this.lastSeqConversationId}&last_seq=${this.lastSeq}`;
+        }
         
         this.websocket = new WebSocket(wsUrl);
         
         this.websocket.onopen = () => {
             console.log('✅ WebSocket connected');
+            const isReconnect = this.reconnectionAttempts > 0;
             // Reset reconnection attempts on successful connection
             this.reconnectionAttempts = 0;
+            
+            // Server giữ trạng thái tìm kiếm trong bộ nhớ, sau khi server khởi động lại
+            // cần gửi lại yêu cầu tìm kiếm nếu vẫn đang ở màn hình searching
+            if (isReconnect && this.currentSearchType &&
+                document.querySelector('.searching-container') !== null) {
+                this.resumeSearch();
+            }
         };
         
         this.websocket.onmessage = async (event) => {
@@ -767,6 +890,14 @@ class MapmoApp {
                     return;
                 }
                 
+                // Bỏ qua event trùng (đã nhận trước khi reconnect)
+                if (data.seq !== undefined) {
+                    if (this.lastSeq !== null && data.seq <= this.lastSeq) {
+                        return;
+                    }
+                    this.lastSeq = data.seq;
+                }
+                
                 await this.handleWebSocketMessage(data);
             } catch (error) {
                 console.error('Error parsing WebSocket message:', error);
@@ -825,13 +956,16 @@ class MapmoApp {
     
     async handleWebSocketMessage(data) {
         try {
-            const message = JSON.parse(data);
+            const message = typeof data === 'string' ? JSON.parse(data) : data;
             console.log('📨 WebSocket message received:', message);
             
             switch (message.type) {
                 case 'chat_message':
                     this.handleRealMessage(message.data);
                     break;
+                case 'message_ack':
+                    this.handleMessageAck(message.data);
+                    break;
                 case 'match_found':
                     await this.handleMatchFound(message.data);
                     break;
@@ -847,6 +981,15 @@ class MapmoApp {
                 case 'countdown_update':
                     this.handleCountdownUpdate(message.data);
                     break;
+                case 'sync_state':
+                    this.handleSyncState(message.data);
+                    break;
+                case 'resync_required':
+                    await this.handleResyncRequired(message.data);
+                    break;
+                case 'searching_count':
+                    this.setSearchingCount(message.data.searching_count);
+                    break;
                 default:
                     console.log('⚠️ Unknown message type:', message.type);
             }
@@ -855,21 +998,37 @@ class MapmoApp {
         }
     }
     
-    handleCountdownUpdate(data) {
-        console.log('🔄 Countdown update received:', data);
+    handleSyncState(data) {
+        // Kết nối mới: lấy seq hiện tại của conversation làm mốc
+        this.lastSeqConversationId = data.conversation_id;
+        this.lastSeq = data.seq;
+    }
+    
+    async handleResyncRequired(data) {
+        // Khoảng trống quá cũ để replay, tải lại lịch sử qua HTTP
+        console.log('🔁 Resync required:', data);
         
-        // Cập nhật thông tin countdown từ server
-        if (data.time_left !== undefined) {
-            this.countdownTimeLeft = data.time_left;
-        }
-        if (data.start_time) {
-            this.countdownStartTime = data.start_time;
+        if (!this.currentConversation ||
+            this.currentConversation.conversation_id !== data.conversation_id) {
+            return;
         }
-        if (data.both_kept !== undefined) {
-            this.setBothKeptStatus(data.both_kept);
+        
+        const chatMessages = document.getElementById('chatMessages');
+        if (chatMessages) {
+            chatMessages.querySelectorAll('.message').forEach(element => element.remove());
         }
+        this.renderedMessageIds.clear();
         
-        // Cập nhật hiển thị
+        this.lastSeqConversationId = data.conversation_id;
+        this.lastSeq = data.seq;
+        await this.loadMessageHistory();
+    }
+    
+    handleCountdownUpdate(data) {
+        // Server chỉ gửi khi trạng thái thay đổi: keep, cả 2 keep, hết giờ
+        console.log('🔄 Countdown update received:', data);
+        
+        this.applyCountdownState(data);
         this.updateCountdownDisplay();
         
         // Nếu countdown đã hết thời gian và chưa keep, kết thúc
@@ -879,6 +1038,20 @@ class MapmoApp {
         }
     }
     
+    handleMessageAck(ackData) {
+        // Server đã gán id thật cho tin nhắn tạm thời
+        const tempElement = document.querySelector(`[data-temp-id="${ackData.client_id}"]`);
+        if (tempElement) {
+            tempElement.removeAttribute('data-temp-id');
+            tempElement.setAttribute('data-message-id', ackData.id);
+        }
+        this.renderedMessageIds.add(ackData.id);
+        
+        if (this.pendingTempMessage && this.pendingTempMessage.id === ackData.client_id) {
+            this.pendingTempMessage = null;
+        }
+    }
+    
     handleRealMessage(messageData) {
         // Nếu có tin nhắn tạm thời đang chờ và nội dung giống nhau, xóa tin nhắn tạm thời
         if (this.pendingTempMessage && 
@@ -902,18 +1075,26 @@ class MapmoApp {
     async handleMatchFound(matchData) {
         console.log('🎯 Match found notification received:', matchData);
         
+        // Đã ở trong phòng chat này (ví dụ sau khi reconnect), không cần render lại
+        if (this.currentConversation &&
+            this.currentConversation.conversation_id === matchData.conversation_id &&
+            document.getElementById('chatMessages')) {
+            return;
+        }
+        
+        // Conversation mới, reset mốc seq
+        if (this.lastSeqConversationId !== matchData.conversation_id) {
+            this.lastSeq = null;
+            this.lastSeqConversationId = null;
+        }
+        
         // Lưu thông tin conversation
         this.currentConversation = matchData;
+        this.applyCountdownState(matchData.countdown);
         
         // Hiển thị thông báo match thành công
         this.showSuccess(`Đã kết nối với ${matchData.matched_user?.nickname || 'người lạ'}! 🎉`);
         
-        // Dừng interval cập nhật số người đang tìm kiếm nếu có
-        if (this.searchingCountInterval) {
-            clearInterval(this.searchingCountInterval);
-            this.searchingCountInterval = null;
-        }
-        
         // Kiểm tra xem user có đang ở trang tìm kiếm không
         const isCurrentlySearching = document.querySelector('.searching-container') !== null;
         console.log('🔍 User currently searching:', isCurrentlySearching);
@@ -958,12 +1139,22 @@ class MapmoApp {
         const chatMessages = document.getElementById('chatMessages');
         const isOwnMessage = message.sender_id === this.currentUser.id;
         
+        // Bỏ qua tin nhắn đã hiển thị (id do server sinh, duy nhất)
+        if (!message.pending && message.id) {
+            if (this.renderedMessageIds.has(message.id)) {
+                return;
+            }
+            this.renderedMessageIds.add(message.id);
+        }
+        
         const messageElement = document.createElement('div');
         messageElement.className = `message ${isOwnMessage ? 'sent' : 'received'}`;
         
         // Thêm data-temp-id nếu là tin nhắn tạm thời
-        if (message.id && message.id > 1000000000000) { // ID tạm thời từ Date.now()
+        if (message.pending) {
             messageElement.setAttribute('data-temp-id', message.id);
+        } else if (message.id) {
+            messageElement.setAttribute('data-message-id', message.id);
         }
         
         // Xử lý thời gian - chuyển đổi từ UTC sang múi giờ local
@@ -1003,6 +1194,7 @@ class MapmoApp {
         // Hiển thị tin nhắn ngay lập tức cho user gửi
         const tempMessage = {
             id: Date.now(), // ID tạm thời
+            pending: true,
             conversation_id: this.currentConversation.conversation_id,
             sender_id: this.currentUser.id,
             content: content,
@@ -1024,7 +1216,8 @@ class MapmoApp {
             data: {
                 conversation_id: this.currentConversation.conversation_id,
                 content: content,
-                message_type: 'text'
+                message_type: 'text',
+                client_id: tempMessage.id
             }
         });
     }
@@ -1106,8 +1299,9 @@ class MapmoApp {
             });
             
             if (response.ok) {
+                const data = await response.json();
                 this.keepStatus = !this.keepStatus;
-                this.updateKeepStatus({ keep_status: this.keepStatus, both_kept: false });
+                this.updateKeepStatus({ keep_status: this.keepStatus, both_kept: data.data.both_kept });
             }
         } catch (error) {
             this.showError('Lỗi khi cập nhật Keep');
@@ -1241,105 +1435,69 @@ class MapmoApp {
     }
     
     // Countdown timer methods
-    startCountdown() {
-        console.log('🚀 Starting countdown with:', {
-            countdownStartTime: this.countdownStartTime,
-            countdownTimeLeft: this.countdownTimeLeft,
-            bothKept: this.bothKept
-        });
+    applyCountdownState(countdown) {
+        // Lưu deadline tuyệt đối từ server, client tự tính thời gian còn lại
+        if (!countdown) return;
         
-        // Nếu đã có thông tin từ server, sử dụng thời gian từ server
-        if (this.countdownStartTime) {
-            this.countdownTimeLeft = this.calculateTimeLeftFromServer();
-            console.log('📊 Using server time, calculated time left:', this.countdownTimeLeft);
-        } else {
-            // Nếu chưa có start time, sync với server trước
-            console.log('📊 No start time available, syncing with server first');
-            this.syncCountdownWithServer().then(() => {
-                // Sau khi sync, tính toán lại thời gian
-                if (this.countdownStartTime) {
-                    this.countdownTimeLeft = this.calculateTimeLeftFromServer();
-                    console.log('📊 After sync, calculated time left:', this.countdownTimeLeft);
-                } else {
-                    this.countdownTimeLeft = this.countdownDuration;
-                    console.log('📊 Using default duration after sync:', this.countdownTimeLeft);
-                }
-                this.updateCountdownDisplay();
-            });
-            return; // Thoát sớm, sẽ tiếp tục sau khi sync
+        if (countdown.server_time) {
+            this.serverClockOffset = new Date(countdown.server_time).getTime() - Date.now();
         }
-        
-        this.updateCountdownDisplay();
-        
-        // Clear interval cũ nếu có
-        if (this.countdownInterval) {
-            clearInterval(this.countdownInterval);
+        if (countdown.deadline) {
+            this.countdownDeadline = new Date(countdown.deadline).getTime();
         }
-        if (this.serverSyncInterval) {
-            clearInterval(this.serverSyncInterval);
+        if (countdown.duration) {
+            this.countdownDuration = countdown.duration;
+        }
+        if (countdown.both_kept !== undefined) {
+            this.setBothKeptStatus(countdown.both_kept);
         }
         
-        this.countdownInterval = setInterval(() => {
-            this.countdownTimeLeft--;
-            this.updateCountdownDisplay();
-            
-            if (this.countdownTimeLeft <= 0) {
-                this.endCountdown();
-            }
-        }, 1000);
-        
-        // Sync với server mỗi 15 giây để đảm bảo đồng bộ (giảm từ 30s xuống 15s)
-        this.serverSyncInterval = setInterval(() => {
-            this.syncCountdownWithServer();
-        }, 15000);
-        
-        // Sync ngay lập tức sau 2 giây để đảm bảo đồng bộ ban đầu
-        setTimeout(() => {
-            this.syncCountdownWithServer();
-        }, 2000);
+        this.countdownTimeLeft = this.calculateTimeLeft();
     }
     
-    calculateTimeLeftFromServer() {
-        if (!this.countdownStartTime) {
-            console.log('⚠️ No countdown start time available');
+    calculateTimeLeft() {
+        if (!this.countdownDeadline) {
             return this.countdownDuration;
         }
         
-        try {
-            const startTime = new Date(this.countdownStartTime);
-            const now = new Date();
-            
-            // Đảm bảo cả hai thời gian đều có timezone info
-            if (startTime.toString() === 'Invalid Date') {
-                console.error('❌ Invalid start time format:', this.countdownStartTime);
-                return this.countdownDuration;
-            }
-            
-            console.log('🕐 Time calculation:', {
-                startTime: startTime.toISOString(),
-                now: now.toISOString(),
-                startTimeLocal: startTime.toString(),
-                nowLocal: now.toString()
-            });
-            
-            // Tính toán thời gian đã trôi qua (tính bằng milliseconds)
-            const elapsed = Math.floor((now.getTime() - startTime.getTime()) / 1000);
-            const timeLeft = this.countdownDuration - elapsed;
-            
-            console.log('⏱️ Time calculation result:', {
-                elapsed: elapsed,
-                timeLeft: timeLeft,
-                duration: this.countdownDuration
+        const serverNow = Date.now() + this.serverClockOffset;
+        return Math.max(0, Math.ceil((this.countdownDeadline - serverNow) / 1000));
+    }
+    
+    startCountdown() {
+        this.stopCountdown();
+        
+        if (this.bothKept) {
+            this.updateCountdownDisplay();
+            return;
+        }
+        
+        if (!this.countdownDeadline) {
+            // Chưa có deadline (ví dụ thông báo match cũ), lấy một lần từ server
+            console.log('📊 No deadline available, fetching countdown once');
+            this.syncCountdownWithServer().then(() => {
+                if (this.countdownDeadline && !this.countdownInterval) {
+                    this.startCountdown();
+                }
             });
-            
-            return Math.max(0, timeLeft);
-        } catch (error) {
-            console.error('❌ Error calculating time left from server:', error);
-            return this.countdownDuration;
+            return;
+        }
+        
+        this.tickCountdown();
+        this.countdownInterval = setInterval(() => this.tickCountdown(), 1000);
+    }
+    
+    tickCountdown() {
+        this.countdownTimeLeft = this.calculateTimeLeft();
+        this.updateCountdownDisplay();
+        
+        if (this.countdownTimeLeft <= 0) {
+            this.endCountdown();
         }
     }
     
     async syncCountdownWithServer() {
+        // Chỉ dùng khi thiếu deadline hoặc không nhận được thông báo kết thúc, không polling
         if (!this.currentConversation) return;
         
         try {
@@ -1351,49 +1509,13 @@ class MapmoApp {
             
             if (response.ok) {
                 const data = await response.json();
-                const serverTimeLeft = data.data.time_left;
-                const serverExpired = data.data.expired;
-                const serverBothKept = data.data.both_kept;
-                const serverStartTime = data.data.start_time;
-                
-                console.log('🔄 Countdown sync with server:', {
-                    serverTimeLeft: serverTimeLeft,
-                    localTimeLeft: this.countdownTimeLeft,
-                    serverExpired: serverExpired,
-                    serverBothKept: serverBothKept,
-                    serverStartTime: serverStartTime
-                });
-                
-                // Cập nhật trạng thái keep
-                this.setBothKeptStatus(serverBothKept);
-                
-                // Cập nhật start time nếu chưa có hoặc khác với server
-                if (serverStartTime) {
-                    if (!this.countdownStartTime || this.countdownStartTime !== serverStartTime) {
-                        this.countdownStartTime = serverStartTime;
-                        console.log('📊 Updated countdown start time from server');
-                    }
-                }
-                
-                // Nếu countdown đã hết thời gian và chưa keep, kết thúc ngay lập tức
-                if (serverExpired && !this.bothKept) {
-                    console.log('❌ Countdown expired on server, ending conversation immediately');
-                    this.endCountdown();
-                    return;
-                }
-                
-                // Sync thời gian nếu chênh lệch > 3 giây (giảm từ 5s xuống 3s)
-                if (Math.abs(this.countdownTimeLeft - serverTimeLeft) > 3) {
-                    console.log(`🔄 Syncing countdown: local=${this.countdownTimeLeft}s, server=${serverTimeLeft}s`);
-                    this.countdownTimeLeft = serverTimeLeft;
-                    this.updateCountdownDisplay();
-                }
+                this.applyCountdownState(data.data);
+                this.updateCountdownDisplay();
                 
-                // Nếu thời gian còn lại <= 0, kết thúc ngay
-                if (this.countdownTimeLeft <= 0 && !this.bothKept) {
-                    console.log('❌ Countdown time left <= 0, ending conversation');
-                    this.endCountdown();
-                    return;
+                // Server xác nhận đã hết giờ mà conversation vẫn chưa đóng, kết thúc ngay
+                if (data.data.expired && !this.bothKept) {
+                    console.log('❌ Countdown expired on server, ending conversation');
+                    this.endConversation();
                 }
             } else if (response.status === 404) {
                 // Conversation không tồn tại, kết thúc
@@ -1409,7 +1531,6 @@ class MapmoApp {
             }
         } catch (error) {
             console.error('❌ Error syncing countdown with server:', error);
-            // Không làm gì nếu có lỗi network, tiếp tục với countdown local
         }
     }
     
@@ -1418,9 +1539,9 @@ class MapmoApp {
             clearInterval(this.countdownInterval);
             this.countdownInterval = null;
         }
-        if (this.serverSyncInterval) {
-            clearInterval(this.serverSyncInterval);
-            this.serverSyncInterval = null;
+        if (this.expiryFallbackTimeout) {
+            clearTimeout(this.expiryFallbackTimeout);
+            this.expiryFallbackTimeout = null;
         }
     }
     
@@ -1462,15 +1583,23 @@ class MapmoApp {
         this.stopCountdown();
         this.showError('Hết thời gian! Cuộc trò chuyện sẽ kết thúc.');
         
-        // Kết thúc conversation ngay lập tức khi countdown hết
-        this.endConversation();
+        // Server kết thúc conversation đúng deadline và gửi conversation_ended,
+        // chỉ hỏi lại server một lần nếu không nhận được thông báo
+        this.expiryFallbackTimeout = setTimeout(() => {
+            this.expiryFallbackTimeout = null;
+            this.syncCountdownWithServer();
+        }, 5000);
     }
     
     setBothKeptStatus(bothKept) {
+        const wasBothKept = this.bothKept;
         this.bothKept = bothKept;
         if (bothKept) {
             this.stopCountdown();
             this.updateCountdownDisplay();
+        } else if (wasBothKept && document.getElementById('chatMessages')) {
+            // Một người bỏ keep, countdown chạy tiếp theo deadline cũ
+            this.startCountdown();
         }
     }
     
@@ -1479,17 +1608,18 @@ class MapmoApp {
             const response = await fetch('/api/searching-count');
             if (response.ok) {
                 const data = await response.json();
-                const countElement = document.getElementById('searchingCount');
-                if (countElement) {
-                    countElement.textContent = data.data.searching_count;
-                }
+                this.setSearchingCount(data.data.searching_count);
             }
         } catch (error) {
             console.error('Lỗi khi cập nhật số người đang tìm kiếm:', error);
-            const countElement = document.getElementById('searchingCount');
-            if (countElement) {
-                countElement.textContent = '?';
-            }
+            this.setSearchingCount('?');
+        }
+    }
+    
+    setSearchingCount(count) {
+        const countElement = document.getElementById('searchingCount');
+        if (countElement) {
+            countElement.textContent = count;
         }
     }
 }
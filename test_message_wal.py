@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Kiểm tra message WAL (app/message_wal.py): group commit, replay khi khởi động và
+thu gọn log, kể cả khi hai lô fsync chồng nhau.
+
+fsync được thay bằng hàm đếm / chặn được để kiểm soát thứ tự; database tạm tạo
+bằng alembic như test_query_plans.py.
+
+Chạy: python test_message_wal.py
+  hoặc pytest test_message_wal.py
+"""
+
+import asyncio
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Database tạm, phải đặt trước khi import app
+_db_dir = tempfile.mkdtemp(prefix="mapmo-wal-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'wal.db')}"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from app import clock  # noqa: E402
+from app.database import SessionLocal  # noqa: E402
+from app.message_wal import MessageWAL, replay_wal  # noqa: E402
+from app.models import Conversation, Message, User  # noqa: E402
+from app.schema import upgrade_database  # noqa: E402
+
+upgrade_database()
+
+_real_fsync = os.fsync
+
+
+@contextmanager
+def patched_fsync(fake):
+    os.fsync = fake
+    try:
+        yield
+    finally:
+        os.fsync = _real_fsync
+
+
+def new_wal(**kwargs) -> MessageWAL:
+    return MessageWAL(os.path.join(tempfile.mkdtemp(dir=_db_dir), "messages.wal"), **kwargs)
+
+
+def new_conversation():
+    """(conversation_id, sender_id) để message replay thỏa foreign key"""
+    db = SessionLocal()
+    try:
+        users = [User(username=f"wal{os.urandom(4).hex()}", password_hash="-") for _ in range(2)]
+        db.add_all(users)
+        db.commit()
+        conversation = Conversation(user1_id=users[0].id, user2_id=users[1].id)
+        db.add(conversation)
+        db.commit()
+        return conversation.id, users[0].id
+    finally:
+        db.close()
+
+
+_next_id = [10 ** 12]
+
+
+def make_message(conversation_id: int = 1, sender_id: int = 1, content: str = "xin chào") -> dict:
+    _next_id[0] += 1
+    return {
+        "id": _next_id[0],
+        "conversation_id": conversation_id,
+        "sender_id": sender_id,
+        "content": content,
+        "message_type": "text",
+        "created_at": clock.now().isoformat()
+    }
+
+
+def test_group_commit_shares_one_fsync():
+    calls = []
+
+    def counting_fsync(fd):
+        calls.append(fd)
+        _real_fsync(fd)
+
+    async def scenario():
+        wal = new_wal(fsync_interval=0.01)
+        messages = [make_message() for _ in range(20)]
+        await asyncio.gather(*(wal.append(message) for message in messages))
+        wal.close()
+        return wal, messages
+
+    with patched_fsync(counting_fsync):
+        wal, messages = asyncio.run(scenario())
+
+    assert len(calls) == 1, f"{len(messages)} append cùng cửa sổ phải chung 1 fsync, có {len(calls)}"
+    assert [record["id"] for record in wal.read_records()] == [message["id"] for message in messages]
+
+
+def test_replay_inserts_missing_messages_once():
+    conversation_id, sender_id = new_conversation()
+
+    async def write():
+        wal = new_wal()
+        messages = [make_message(conversation_id, sender_id, f"tin {i}") for i in range(3)]
+        for message in messages:
+            await wal.append(message)
+        wal.close()
+        return wal.path, messages
+
+    path, messages = asyncio.run(write())
+
+    # Một message đã kịp commit trước khi crash, replay không được ghi trùng
+    db = SessionLocal()
+    try:
+        first = messages[0]
+        db.add(Message(id=first["id"], conversation_id=conversation_id, sender_id=sender_id,
+                       content=first["content"], message_type="text"))
+        db.commit()
+
+        wal = MessageWAL(path)
+        assert replay_wal(wal, db) == 2
+        assert wal.read_records() == []
+        assert replay_wal(wal, db) == 0
+        wal.close()
+
+        stored = db.query(Message.id).filter(Message.conversation_id == conversation_id).all()
+        assert sorted(row[0] for row in stored) == sorted(message["id"] for message in messages)
+    finally:
+        db.close()
+
+
+def test_mark_committed_truncates_or_compacts():
+    async def scenario():
+        wal = new_wal(compact_bytes=0)
+        messages = [make_message() for _ in range(3)]
+        for message in messages:
+            await wal.append(message)
+
+        # Còn message chưa commit: log thu gọn chỉ còn các message đó
+        wal.mark_committed([messages[0]["id"]])
+        assert [record["id"] for record in wal.read_records()] == [messages[1]["id"], messages[2]["id"]]
+
+        # Append sau khi thu gọn vẫn ghi vào file mới
+        extra = make_message()
+        await wal.append(extra)
+        assert wal.read_records()[-1]["id"] == extra["id"]
+
+        # Commit hết thì log rỗng
+        wal.mark_committed([messages[1]["id"], messages[2]["id"], extra["id"]])
+        assert wal.read_records() == []
+        wal.close()
+
+    asyncio.run(scenario())
+
+
+def test_compaction_waits_for_overlapping_fsync():
+    """Lô 1 xong trong khi fsync của lô 2 còn chạy: chưa được đóng/thay file"""
+    started = [threading.Event(), threading.Event()]
+    release = [threading.Event(), threading.Event()]
+    calls = []
+
+    def blocking_fsync(fd):
+        index = len(calls)
+        calls.append(fd)
+        if index < 2:
+            started[index].set()
+            release[index].wait(5)
+        _real_fsync(fd)
+
+    async def wait_for(event: threading.Event):
+        while not event.is_set():
+            await asyncio.sleep(0.001)
+
+    async def scenario():
+        wal = new_wal(fsync_interval=0.001, compact_bytes=0)
+        first, second, pending = make_message(), make_message(), make_message()
+
+        first_append = asyncio.create_task(wal.append(first))
+        await wait_for(started[0])
+        second_append = asyncio.create_task(wal.append(second))
+        await wait_for(started[1])
+        wal._uncommitted[pending["id"]] = pending
+
+        release[0].set()
+        await first_append
+
+        # Lô 2 vẫn đang fsync: không được thu gọn log
+        file_before = wal._file
+        wal.mark_committed([first["id"]])
+        assert wal._file is file_before and not file_before.closed
+
+        release[1].set()
+        await second_append
+
+        # Hết lô đang chạy thì thu gọn như bình thường
+        wal.mark_committed([second["id"]])
+        assert [record["id"] for record in wal.read_records()] == [pending["id"]]
+        wal.close()
+
+    with patched_fsync(blocking_fsync):
+        asyncio.run(scenario())
+
+
+def main():
+    failed = 0
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_") and callable(test):
+            try:
+                test()
+                print(f"✅ {name}")
+            except AssertionError as e:
+                failed += 1
+                print(f"❌ {name}: {e}")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,9 +19,13 @@ class PerformanceTest:
         start_time = time.time()
         
         try:
-            # Connect WebSocket
-            ws_url = f"{self.base_url.replace('http', 'ws')}/ws/{user_id}?token={token}"
             async with aiohttp.ClientSession() as session:
+                # Lấy vé kết nối rồi connect WebSocket
+                async with session.post(f"{self.base_url}/api/ws-ticket",
+                                        headers={"Authorization": f"Bearer {token}"}) as response:
+                    ticket = (await response.json())["data"]["ticket"]
+                
+                ws_url = f"{self.base_url.replace('http', 'ws')}/ws/{user_id}?ticket={ticket}"
                 async with session.ws_connect(ws_url) as ws:
                     connect_time = time.time() - start_time
                     
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Kiểm tra các truy vấn nóng dùng đúng index do migration tạo (EXPLAIN QUERY PLAN trên SQLite).
+
+Database tạm được tạo bằng alembic (import app.main chạy upgrade_database), sau đó
+chạy chính các hàm của app và bắt plan của từng câu lệnh SQL chúng gửi đi. Thêm
+truy vấn nóng mới hoặc đổi điều kiện WHERE/ORDER BY thì cập nhật file này.
+
+Chạy: python test_query_plans.py   (in plan của từng truy vấn)
+  hoặc pytest test_query_plans.py
+"""
+
+import os
+import tempfile
+from datetime import timedelta
+from typing import List, Tuple
+
+# Database tạm, phải đặt trước khi import app
+_db_dir = tempfile.mkdtemp(prefix="mapmo-plans-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'plans.db')}"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from sqlalchemy import event  # noqa: E402
+
+from app import clock  # noqa: E402
+from app.archive import ArchiveService  # noqa: E402
+from app.database import SessionLocal, engine, read_engine  # noqa: E402
+from app.expiry import expire_conversations  # noqa: E402
+from app.main import load_message_history, load_message_page  # noqa: E402
+from app.matching import MatchingService  # noqa: E402
+from app.models import Conversation, Message, User  # noqa: E402
+from app.presence import presence  # noqa: E402
+
+Plans = List[Tuple[str, List[str]]]
+
+
+def capture_plans(func, *args) -> Plans:
+    """Chạy func(db, *args), trả về [(sql, các dòng plan)] của mọi câu lệnh nó gửi đi"""
+    plans: Plans = []
+
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        if executemany or not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            return
+        cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        plans.append((statement, [row[3] for row in cursor.fetchall()]))
+
+    engines = {engine, read_engine}
+    for target in engines:
+        event.listen(target, "before_cursor_execute", explain)
+    db = SessionLocal()
+    try:
+        func(db, *args)
+    finally:
+        db.close()
+        for target in engines:
+            event.remove(target, "before_cursor_execute", explain)
+    return plans
+
+
+def plan_for(plans: Plans, fragment: str) -> str:
+    for statement, lines in plans:
+        if fragment in statement:
+            return "\n".join(lines)
+    raise AssertionError(f"không có câu lệnh nào chứa {fragment!r}: {[s for s, _ in plans]}")
+
+
+def assert_uses_index(plan: str, index_name: str):
+    assert f"INDEX {index_name}" in plan, f"không dùng {index_name}:\n{plan}"
+
+
+def new_users(count: int) -> List[int]:
+    db = SessionLocal()
+    try:
+        users = [User(username=f"plan{os.urandom(4).hex()}", password_hash="-") for _ in range(count)]
+        db.add_all(users)
+        db.commit()
+        return [user.id for user in users]
+    finally:
+        db.close()
+
+
+def new_conversation() -> Tuple[int, int]:
+    """Conversation đã kết thúc có một tin nhắn, trả về (conversation_id, user1_id)"""
+    user1_id, user2_id = new_users(2)
+    db = SessionLocal()
+    try:
+        conversation = Conversation(user1_id=user1_id, user2_id=user2_id, is_active=False)
+        db.add(conversation)
+        db.commit()
+        db.add(Message(conversation_id=conversation.id, sender_id=user1_id, content="xin chào"))
+        db.commit()
+        return conversation.id, user1_id
+    finally:
+        db.close()
+
+
+def newest_message_id(conversation_id: int) -> int:
+    db = SessionLocal()
+    try:
+        return db.query(Message.id).filter(Message.conversation_id == conversation_id).order_by(Message.id.desc()).scalar()
+    finally:
+        db.close()
+
+
+def test_presence_reset_uses_state_index():
+    plans = capture_plans(presence.rebuild, [])
+    assert_uses_index(plan_for(plans, "UPDATE users SET state"), "ix_users_state")
+
+
+def test_active_pair_check_uses_user_index():
+    plans = capture_plans(MatchingService._insert_conversation, *new_users(2), "chat", clock.now())
+    plan = plan_for(plans, "FROM conversations")
+    # Planner chọn index theo user1_id hoặc user2_id, cả hai đều thu hẹp về vài row
+    assert "INDEX ix_conversations_active_user" in plan, plan
+
+
+def test_expiry_sweep_uses_countdown_index():
+    plans = capture_plans(expire_conversations)
+    assert_uses_index(plan_for(plans, "UPDATE conversations"), "ix_conversations_active_countdown")
+
+
+def test_archive_scan_uses_last_activity_index():
+    plans = capture_plans(lambda db: ArchiveService(db).find_archivable_conversations(timedelta(days=7), 100))
+    assert_uses_index(plan_for(plans, "FROM messages JOIN conversations"), "ix_conversations_active_last_activity")
+
+
+def test_message_history_uses_index_order():
+    conversation_id, user1_id = new_conversation()
+    for plans in (
+        capture_plans(load_message_history, conversation_id, user1_id),
+        capture_plans(load_message_page, conversation_id, 50),
+        capture_plans(load_message_page, conversation_id, 50, newest_message_id(conversation_id)),
+    ):
+        plan = plan_for(plans, "ORDER BY")
+        assert_uses_index(plan, "ix_messages_conversation_created")
+        # Thứ tự lấy thẳng từ index, không sort lại
+        assert "TEMP B-TREE" not in plan, plan
+
+
+def main():
+    conversation_id, user1_id = new_conversation()
+    queries = {
+        "presence.rebuild": capture_plans(presence.rebuild, []),
+        "matching._insert_conversation": capture_plans(
+            MatchingService._insert_conversation, *new_users(2), "chat", clock.now()),
+        "expire_conversations": capture_plans(expire_conversations),
+        "archive.find_archivable_conversations": capture_plans(
+            lambda db: ArchiveService(db).find_archivable_conversations(timedelta(days=7), 100)),
+        "load_message_history": capture_plans(load_message_history, conversation_id, user1_id),
+        "load_message_page": capture_plans(load_message_page, conversation_id, 50),
+        "load_message_page(before_id)": capture_plans(
+            load_message_page, conversation_id, 50, newest_message_id(conversation_id)),
+    }
+    for name, plans in queries.items():
+        print(f"== {name}")
+        for statement, lines in plans:
+            print("  " + " ".join(statement.split())[:110])
+            for line in lines:
+                print(f"    {line}")
+
+    failed = 0
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_") and callable(test):
+            try:
+                test()
+                print(f"✅ {name}")
+            except AssertionError as e:
+                failed += 1
+                print(f"❌ {name}: {e}")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()